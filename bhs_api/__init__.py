@@ -11,6 +11,7 @@ from flask.ext.cors import CORS
 from flask.ext.mail import Mail
 from flask.ext.security import Security, MongoEngineUserDatastore
 from bhs_api.utils import get_conf
+from bhs_api.cache import ItemCache
 
 SEARCH_CHUNK_SIZE = 15
 # Create app
@@ -106,6 +107,8 @@ def create_app(testing=False, live=False):
                                       db=0)
     except AttributeError:
         app.redis = None
+    app.item_cache = ItemCache(app.redis, app.config['CACHING_TTL'],
+                               logger=app.logger)
 
     return app, conf
 
@@ -0,0 +1,208 @@
+"""
+A two tier cache for the finished, serialized items served by `fetch_items`.
+
+Every worker keeps a small LRU in front of the shared redis cache. When
+migration updates an item it calls `publish_invalidation` with the item's
+slugs - the redis keys are deleted and the slugs are published on
+`INVALIDATE_CHANNEL` so all the workers drop them from their LRU.
+Items that can't be shown (Forbidden / NotFound) are cached too, with a much
+shorter TTL.
+"""
+import os
+import time
+import logging
+import threading
+import cPickle
+from collections import OrderedDict
+
+import redis
+
+KEY_PREFIX = 'item:'
+INVALIDATE_CHANNEL = 'item_cache:invalidate'
+NEGATIVE_TTL = 60
+LRU_SIZE = 2000
+# how long to skip redis after failing to reach it
+REDIS_RETRY_INTERVAL = 30
+
+
+class LRU(object):
+    ''' a size bounded least recently used cache with optional per key
+        expiry
+    '''
+
+    def __init__(self, size=LRU_SIZE):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            # re-insert to make it the most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ItemCache(object):
+    ''' cache of items by their full slug. values are either the serialized
+        item or a dict with the `error_code` and `msg` of a failed fetch.
+    '''
+
+    def __init__(self, redis_client, ttl, negative_ttl=NEGATIVE_TTL,
+                 lru_size=LRU_SIZE, logger=None):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lru = LRU(lru_size)
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats = {'lru_hits': 0, 'redis_hits': 0, 'misses': 0}
+        self._redis_down_until = 0
+        self._listener_pid = None
+
+    def get_many(self, slugs):
+        ''' returns a dict of slug -> cached value for all the cached slugs '''
+        self._ensure_listening()
+        slugs = map(to_unicode, slugs)
+        rv = {}
+        for slug in slugs:
+            cached = self.lru.get(slug)
+            if cached is not None:
+                rv[slug] = cPickle.loads(cached)
+        self.stats['lru_hits'] += len(rv)
+
+        missing = [slug for slug in slugs if slug not in rv]
+        if missing and self._redis_available():
+            try:
+                values = self.redis.mget([get_key(slug) for slug in missing])
+            except redis.RedisError as e:
+                self._redis_failed(e)
+            else:
+                for slug, cached in zip(missing, values):
+                    if cached is not None:
+                        rv[slug] = cPickle.loads(cached)
+                        self.lru.set(slug, cached, self._get_ttl(rv[slug]))
+                        self.stats['redis_hits'] += 1
+        self.stats['misses'] += len(slugs) - len(rv)
+        return rv
+
+    def set_many(self, values):
+        ''' cache a dict of slug -> item or error dict '''
+        pipe = self.redis.pipeline(transaction=False) \
+            if self._redis_available() else None
+        for slug, value in values.items():
+            slug = to_unicode(slug)
+            cached = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            ttl = self._get_ttl(value)
+            self.lru.set(slug, cached, ttl)
+            if pipe:
+                pipe.set(get_key(slug), cached, ex=ttl)
+        if pipe:
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                self._redis_failed(e)
+
+    def invalidate(self, slugs):
+        ''' drop the slugs from this worker's LRU and from redis. other
+            workers are told about it with `publish_invalidation`
+        '''
+        slugs = [to_unicode(slug) for slug in slugs if slug]
+        self._drop_local(slugs)
+        if slugs and self._redis_available():
+            try:
+                self.redis.delete(*[get_key(slug) for slug in slugs])
+            except redis.RedisError as e:
+                self._redis_failed(e)
+
+    def _drop_local(self, slugs):
+        for slug in slugs:
+            self.lru.delete(to_unicode(slug))
+
+    def _get_ttl(self, value):
+        return self.negative_ttl if 'error_code' in value else self.ttl
+
+    def _redis_available(self):
+        return self.redis is not None and self._redis_down_until < time.time()
+
+    def _redis_failed(self, e):
+        self.logger.warn('item cache failed to reach redis: {}'.format(e))
+        self._redis_down_until = time.time() + REDIS_RETRY_INTERVAL
+
+    def _ensure_listening(self):
+        ''' start listening for invalidations. done lazily to make sure every
+            forked worker has its own listener.
+        '''
+        if self.redis is None or self._listener_pid == os.getpid():
+            return
+        if self._listener_pid:
+            # we've been forked, the parent's LRU can't be trusted
+            self.lru.clear()
+        self._listener_pid = os.getpid()
+        listener = threading.Thread(target=self._listen)
+        listener.daemon = True
+        listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                # we might have missed some invalidations while disconnected
+                self.lru.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._drop_local(cPickle.loads(message['data']))
+            except redis.RedisError as e:
+                self.logger.debug('item cache listener disconnected: {}'
+                                  .format(e))
+                time.sleep(REDIS_RETRY_INTERVAL)
+
+
+def to_unicode(slug):
+    return slug.decode('utf8') if isinstance(slug, str) else slug
+
+
+def get_key(slug):
+    return KEY_PREFIX + to_unicode(slug).encode('utf8')
+
+
+def publish_invalidation(redis_client, slugs):
+    ''' remove the `slugs` from the shared cache and tell all the workers to
+        drop them from their LRU
+    '''
+    slugs = [to_unicode(slug) for slug in slugs if slug]
+    if not redis_client or not slugs:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.delete(*[get_key(slug) for slug in slugs])
+    pipe.publish(INVALIDATE_CHANNEL, cPickle.dumps(slugs))
+    try:
+        pipe.execute()
+    except redis.RedisError as e:
+        # the cached items will expire with their ttl
+        logging.error('failed to invalidate cached items {}: {}'
+                      .format(slugs, e))
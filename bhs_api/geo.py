@@ -0,0 +1,118 @@
+"""
+Queries of the places' `geometry`, served by its 2dsphere index.
+
+A map viewport is a lat/lng box. The 2dsphere index treats polygon edges as
+great circles, so the box is sent as polygons with a vertex every `MAX_EDGE`
+degrees along the parallels, padded by `PADDING` to cover the bulge of the
+edges, and the points are then filtered exactly in python. The queries hint
+the 2dsphere index, so their cost follows the number of places in the box
+and not the size of the collection.
+"""
+import pymongo
+from bson.objectid import ObjectId
+from bson.son import SON
+from bson.errors import InvalidId
+
+from bhs_api.item import VISIBLE_FILTER
+
+PLACES_LIMIT = 1000
+GEO_INDEX = [('geometry', pymongo.GEOSPHERE)]
+PLACE_FIELDS = {'Header': True, 'Slug': True, 'geometry': True,
+                'PlaceTypeDesc': True}
+MAX_EDGE = 10
+# keeps every polygon well within a hemisphere
+MAX_POLYGON_SPAN = 90
+PADDING = 0.2
+# all the vertices on a pole would be the same point
+MAX_LAT = 89.9
+
+
+class Box(object):
+    ''' a lat/lng box, the box crosses the antimeridian when sw_lng > ne_lng '''
+
+    def __init__(self, sw_lat, sw_lng, ne_lat, ne_lng):
+        if sw_lat > ne_lat:
+            raise ValueError('sw_lat must not be greater than ne_lat')
+        self.sw_lat = max(sw_lat, -90.0)
+        self.ne_lat = min(ne_lat, 90.0)
+        self.sw_lng = _normalize_lng(sw_lng)
+        if ne_lng - sw_lng >= 360:
+            self.lng_span = 360.0
+        else:
+            self.lng_span = (ne_lng - sw_lng) % 360
+
+    def contains(self, lng, lat):
+        return (self.sw_lat <= lat <= self.ne_lat and
+                (lng - self.sw_lng) % 360 <= self.lng_span)
+
+    def get_geometries(self):
+        ''' returns geojson polygons that together cover the box '''
+        south = max(self.sw_lat - PADDING, -MAX_LAT)
+        north = min(self.ne_lat + PADDING, MAX_LAT)
+        span = min(self.lng_span + 2 * PADDING, 360.0)
+        west = self.sw_lng - (span - self.lng_span) / 2
+        polygons = int(span // MAX_POLYGON_SPAN) + 1
+        return [_get_polygon(west + span * i / polygons, span / polygons,
+                             south, north)
+                for i in range(polygons)]
+
+
+def _get_polygon(west, span, south, north):
+    steps = int(span // MAX_EDGE) + 1
+    lngs = [_normalize_lng(west + span * i / steps) for i in range(steps + 1)]
+    ring = [[lng, south] for lng in lngs] + \
+           [[lng, north] for lng in reversed(lngs)]
+    ring.append(ring[0])
+    return {'type': 'Polygon', 'coordinates': [ring]}
+
+
+def _normalize_lng(lng):
+    return (lng + 180) % 360 - 180
+
+
+def get_box_filter(box):
+    ''' a single `$geoWithin`, an `$or` of polygons can't be hinted as a
+        whole
+    '''
+    polygons = box.get_geometries()
+    if len(polygons) == 1:
+        geometry = polygons[0]
+    else:
+        geometry = {'type': 'MultiPolygon',
+                    'coordinates': [polygon['coordinates']
+                                    for polygon in polygons]}
+    return {'geometry': {'$geoWithin': {'$geometry': geometry}}}
+
+
+def find_places_in_box(db, box, after=None, limit=PLACES_LIMIT):
+    ''' returns a list of up to `limit` visible places in the box, sorted by
+        their id, and the continuation token of the next page or None.
+        raises ValueError for a bad `after` token.
+    '''
+    filters = get_box_filter(box)
+    filters.update(VISIBLE_FILTER)
+    filters['Header.En'] = {'$nin': [None, '']}
+    if after:
+        try:
+            filters['_id'] = {'$gt': ObjectId(after)}
+        except (InvalidId, TypeError):
+            raise ValueError('bad continuation token')
+    points = []
+    # the padded polygons match a few places out of the box, keep querying
+    # until the page is full of exact matches or the places run out
+    while len(points) <= limit:
+        cursor = db['places'].find(filters, PLACE_FIELDS,
+                                   modifiers={'$hint': SON(GEO_INDEX)}) \
+                             .sort('_id', 1).limit(limit + 1)
+        docs = list(cursor)
+        points.extend(doc for doc in docs
+                      if box.contains(*doc['geometry']['coordinates'][:2]))
+        if len(docs) <= limit:
+            break
+        filters['_id'] = {'$gt': docs[-1]['_id']}
+    if len(points) > limit:
+        points = points[:limit]
+        next_token = str(points[-1]['_id'])
+    else:
+        next_token = None
+    return points, next_token
@@ -0,0 +1,146 @@
+"""
+Geocoding of the places, with a persistent cache.
+
+The results are cached in the `GEOCODE_COLLECTION` of the data db, keyed by
+the normalized english header, so re-migrating a place never calls the
+geocoder again. Queries with no result are cached too and retried after
+`NEGATIVE_TTL`. Failed requests are not cached.
+
+The geocoder backend is picked by the `geocoder` conf key, `opencage` by
+default. The `stub` backend answers locally, for tests and benchmarks.
+"""
+import re
+import time
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+
+import requests
+from flask import current_app
+
+GEOCODE_COLLECTION = 'geocodes'
+NEGATIVE_TTL = timedelta(days=30)
+
+
+class GeocodeError(Exception):
+    ''' the geocoder failed, the query should be retried later '''
+
+
+class OpenCageGeocoder(object):
+    url = 'https://api.opencagedata.com/geocode/v1/geojson'
+
+    def __init__(self, conf):
+        self.key = conf.opencage_key
+
+    def geocode(self, query):
+        ''' returns the geojson geometry of a query or None if not found '''
+        params = {'q': query.encode('utf-8'), 'key': self.key}
+        try:
+            response = requests.get(self.url, params=params)
+        except requests.RequestException as e:
+            raise GeocodeError(str(e))
+        if response.status_code != 200:
+            raise GeocodeError('opencage returned {} for {}'.format(
+                               response.status_code, query.encode('utf-8')))
+        features = response.json()['features']
+        return features[0]['geometry'] if features else None
+
+
+class StubGeocoder(object):
+    ''' a local geocoder that takes `delay` seconds to return a point made
+        of the query's hash
+    '''
+
+    def __init__(self, conf=None, delay=0):
+        self.delay = delay
+        self.calls = 0
+
+    def geocode(self, query):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        h = hash(query)
+        return {'type': 'Point',
+                'coordinates': [h % 360 - 180.0, h % 180 - 90.0]}
+
+
+GEOCODERS = {
+    'opencage': OpenCageGeocoder,
+    'stub': StubGeocoder,
+}
+
+
+def create_geocoder(conf):
+    return GEOCODERS[getattr(conf, 'geocoder', 'opencage')](conf)
+
+
+def get_geocoder():
+    ''' returns the geocoder of the current app, created on first use '''
+    app = current_app._get_current_object()
+    geocoder = getattr(app, 'geocoder', None)
+    if geocoder is None:
+        geocoder = app.geocoder = create_geocoder(app.conf)
+    return geocoder
+
+
+def normalize_query(query):
+    query = unicodedata.normalize('NFKC', query)
+    return re.sub(r'\s+', u' ', query).strip().lower()
+
+
+def geocode(db, geocoder, query):
+    ''' returns the geometry of a query, from the cache when possible.
+        raises GeocodeError when the geocoder fails.
+    '''
+    if isinstance(query, str):
+        query = query.decode('utf-8')
+    key = normalize_query(query)
+    if not key:
+        return None
+    cached = db[GEOCODE_COLLECTION].find_one({'_id': key})
+    if cached and (cached['geometry'] or
+                   cached['updated_at'] > datetime.utcnow() - NEGATIVE_TTL):
+        return cached['geometry']
+    geometry = geocoder.geocode(query)
+    db[GEOCODE_COLLECTION].replace_one(
+        {'_id': key},
+        {'_id': key, 'geometry': geometry, 'updated_at': datetime.utcnow()},
+        upsert=True)
+    return geometry
+
+
+def geocode_place(doc, db=None, geocoder=None):
+    ''' tries to get the geo of a place, returns None if fails '''
+    header = (doc.get('Header') or {}).get('En')
+    if not header:
+        return None
+    if db is None:
+        db = current_app.data_db
+    if geocoder is None:
+        geocoder = get_geocoder()
+    try:
+        return geocode(db, geocoder, header)
+    except GeocodeError as e:
+        current_app.logger.error(u'failed to geocode {}: {}'.format(header, e))
+        return None
+
+
+class RateLimitedGeocoder(object):
+    ''' wraps a geocoder to make at most `rate` calls per second, from any
+        number of threads
+    '''
+
+    def __init__(self, geocoder, rate):
+        self.geocoder = geocoder
+        self.interval = 1.0 / rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def geocode(self, query):
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return self.geocoder.geocode(query)
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Daitch-Mokotoff soundex for Hebrew, ported from `hebrew_dm_server.js`
+(c) Stephen P. Morse, 2003.
+
+`encode` returns exactly what the node server computed by
+`SoundexWithoutDuplicateConsonantRule(FixVav(name), " ")`, including its
+quirks, so codes already stored in the db keep matching.
+"""
+import threading
+
+ALEF = u'א'
+BAIS = u'ב'
+GIMEL = u'ג'
+DALET = u'ד'
+HAY = u'ה'
+VAV = u'ו'
+ZAYIN = u'ז'
+KHESS = u'ח'
+TESS = u'ט'
+YUD = u'י'
+KHAF2 = u'ך'
+KAF = u'כ'
+LAMED = u'ל'
+MEM2 = u'ם'
+MEM = u'מ'
+NUN2 = u'ן'
+NUN = u'נ'
+SAMEKH = u'ס'
+AYIN = u'ע'
+FAY2 = u'ף'
+PAY = u'פ'
+TSADI2 = u'ץ'
+TSADI = u'צ'
+KUF = u'ק'
+RAISH = u'ר'
+SHIN = u'ש'
+TAF = u'ת'
+
+FIRST_LETTER = ALEF
+LAST_LETTER = TAF
+# letters that count as a following vowel in the rules
+VOWELS = ALEF + AYIN + VAV
+NOT_CODED = '999'
+CODE_LENGTH = 6
+SEPARATOR = ' '
+
+# (letters, at the start, before a vowel, any other case)
+RULES = [
+    (ZAYIN + DALET + ZAYIN, '2', '4', '4'),
+    (SAMEKH + TESS + SHIN, '2', '4', '4'),
+    (SAMEKH + TESS + ZAYIN, '2', '4', '4'),
+    (SAMEKH + TAF + ZAYIN, '2', '4', '4'),
+    (SAMEKH + TAF + SHIN, '2', '4', '4'),
+    (SHIN + TESS + SHIN, '2', '4', '4'),
+    (SHIN + TESS + ZAYIN, '2', '4', '4'),
+    (SHIN + TAF + SHIN, '2', '4', '4'),
+    (SHIN + TAF + ZAYIN, '2', '4', '4'),
+    (YUD + YUD + AYIN, '1', '1', '1'),
+    (YUD + YUD + HAY, '1', '1', '1'),
+    (DALET + SAMEKH, '4', '4', '4'),
+    (DALET + SHIN, '4', '4', '4'),
+    (DALET + ZAYIN, '4', '4', '4'),
+    (KHESS + SAMEKH, '5', '54', '54'),
+    (TESS + SHIN, '4', '4', '4'),
+    (KHESS + SHIN, '5', '54', '54'),
+    (KAF + SAMEKH, '5', '54', '54'),
+    (KAF + SHIN, '5', '54', '54'),
+    (MEM + NUN, '66', '66', '66'),
+    (MEM + NUN2, '66', '66', '66'),
+    (NUN + MEM, '66', '66', '66'),
+    (NUN + MEM2, '66', '66', '66'),
+    (PAY + BAIS, '7', '7', '7'),
+    (KUF + SAMEKH, '5', '54', '54'),
+    (KUF + SHIN, '5', '54', '54'),
+    (SAMEKH + DALET, '2', '43', '43'),
+    (SAMEKH + TESS, '2', '43', '43'),
+    (SAMEKH + TAF, '2', '43', '43'),
+    (SHIN + DALET, '2', '43', '43'),
+    (SHIN + TESS, '2', '43', '43'),
+    (SHIN + TAF, '2', '43', '43'),
+    (TAF + SHIN, '4', '4', '4'),
+    (ZAYIN + SHIN, '4', '4', '4'),
+    (ALEF + VAV, '0', '7', '999'),
+    (YUD + VAV, '1', '999', '999'),
+    (YUD + ALEF, '1', '1', '1'),
+    (ALEF, '0', '999', '999'),
+    (BAIS, '7', '7', '7'),
+    (GIMEL, '5', '5', '5'),
+    (DALET, '3', '3', '3'),
+    (HAY, '5', '5', '999'),
+    (VAV, '7', '7', '7'),
+    (ZAYIN, '4', '4', '4'),
+    (KHESS, '5', '5', '5'),
+    (TESS, '3', '3', '3'),
+    (YUD, '1', '1', '999'),
+    (KAF, '5', '5', '5'),
+    (KHAF2, '5', '5', '5'),
+    (LAMED, '8', '8', '8'),
+    (MEM, '6', '6', '6'),
+    (MEM2, '6', '6', '6'),
+    (NUN, '6', '6', '6'),
+    (NUN2, '6', '6', '6'),
+    (SAMEKH, '4', '4', '4'),
+    (AYIN, '0', '999', '999'),
+    (PAY, '7', '7', '7'),
+    (FAY2, '7', '7', '7'),
+    (TSADI, '4', '4', '4'),
+    (TSADI2, '4', '4', '4'),
+    (KUF, '5', '5', '5'),
+    (RAISH, '9', '9', '9'),
+    (SHIN, '4', '4', '4'),
+    (TAF, '3', '3', '3'),
+]
+
+# the sephardic alternatives, these rules branch the code in two
+BRANCHING_RULES = {
+    YUD + ALEF: ('1', '999', '999'),
+    YUD + VAV: ('1', '1', '1'),
+    # vowel VAV can never appear at the beginning of a word
+    VAV: ('7', '999', '999'),
+}
+
+# the rules that can start at every letter, longest first as in `RULES`
+_RULES_BY_LETTER = {}
+for _rule in RULES:
+    _RULES_BY_LETTER.setdefault(_rule[0][0], []).append(_rule)
+
+CACHE_SIZE = 100000
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def encode(name):
+    ''' returns the space separated DM codes of a hebrew name '''
+    if isinstance(name, str):
+        name = name.decode('utf8')
+    try:
+        return _cache[name]
+    except KeyError:
+        pass
+    code = _soundex_without_duplicate_consonant_rule(_fix_vav(name))
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[name] = code
+    return code
+
+
+def encode_many(names):
+    ''' returns a list with the codes of all the `names`, in the same order '''
+    codes = {}
+    for name in names:
+        if name not in codes:
+            codes[name] = encode(name)
+    return [codes[name] for name in names]
+
+
+def _char_at(text, i):
+    return text[i] if 0 <= i < len(text) else u''
+
+
+def _fix_vav(rawtext):
+    ''' force single VAV to be a vowel (i.e., replace with an AYIN) when it's
+        preceded by BAIS or PAY or followed by MEM or NUN and double VAV to be
+        a consonant (i.e., replace with a BAIS).
+        double YUD is forced to be a vowel and never "YI".
+    '''
+    text = []
+    length = len(rawtext)
+    i = 0
+    while i < length:
+        ch = rawtext[i]
+        prev_char = _char_at(rawtext, i - 1)
+        next_char = _char_at(rawtext, i + 1)
+        next_next_char = _char_at(rawtext, i + 2)
+        if ch == VAV:
+            if next_char == VAV:
+                ch = BAIS
+                i += 1
+            elif next_char in (MEM, MEM2, NUN, NUN2):
+                ch = AYIN
+            elif prev_char in (BAIS, PAY):
+                ch = AYIN
+        elif ch == YUD and next_char == YUD:
+            if i == length - 3 and next_next_char == HAY:
+                # YUD YUD HAY at the end is left for the rules (generates a 1)
+                ch = YUD + YUD + HAY
+                i += 2
+            elif i <= length - 3 and next_next_char == AYIN:
+                ch = YUD + YUD + AYIN
+                i += 2
+            else:
+                ch = AYIN
+                i += 1
+        text.append(ch)
+        i += 1
+    return u''.join(text)
+
+
+def _is_vowel(ch):
+    return ch in (ALEF, AYIN, YUD)
+
+
+def _is_letter(ch):
+    return FIRST_LETTER <= ch <= LAST_LETTER
+
+
+def _soundex_without_duplicate_consonant_rule(rawtext):
+    ''' the duplicate consonant rule is suspended by adding alternates with a
+        vowel between every two consonants, which is probably the case in
+        hebrew
+    '''
+    combined = u''
+    for text in rawtext.split(u' '):
+        alternates = [u'']
+        last = len(text) - 1
+        for i, ch in enumerate(text):
+            if not _is_letter(ch):
+                continue
+            alternates = [alternate + ch for alternate in alternates]
+            if i != last and not _is_vowel(ch) and not _is_vowel(text[i+1]):
+                if ch == VAV and text[i+1] == VAV:
+                    continue
+                # don't use alef -- see the ALEF VAV branching rule
+                alternates += [alternate + AYIN for alternate in alternates]
+        if alternates[0]:
+            codes = SEPARATOR.join(map(_soundex, alternates)).split(SEPARATOR)
+        else:
+            codes = [u'']
+        if combined:
+            # words with no letters leave a separator only when they
+            # follow a coded word
+            combined += SEPARATOR
+        combined += SEPARATOR.join(_unique(sorted(codes)))
+    return combined
+
+
+def _unique(sorted_codes):
+    rv = []
+    for code in sorted_codes:
+        if not rv or rv[-1] != code:
+            rv.append(code)
+    return rv
+
+
+def _soundex(word):
+    ''' the DM codes of a word made only of hebrew letters '''
+    codes = [u'']
+    last_codes = [u'']
+    first = True
+    pos = 0
+    length = len(word)
+    while pos < length:
+        for letters, start, before_vowel, other in _RULES_BY_LETTER[word[pos]]:
+            if word.startswith(letters, pos):
+                break
+        branch = BRANCHING_RULES.get(letters)
+        if branch:
+            codes += codes
+            last_codes += last_codes
+        pos += len(letters)
+
+        if first:
+            first = False
+            codes[0] = last_codes[0] = start
+            if branch:
+                codes[1] = last_codes[1] = branch[0]
+            continue
+
+        dim = len(codes)
+        half = dim / 2 if dim > 1 else 1
+        followed_by_vowel = pos < length and word[pos] in VOWELS
+        code = before_vowel if followed_by_vowel else other
+        if branch:
+            branch_code = branch[1] if followed_by_vowel else branch[2]
+        for ii in range(half):
+            if code != NOT_CODED and code != last_codes[ii]:
+                last_codes[ii] = code
+                codes[ii] += code
+            elif other == NOT_CODED:
+                last_codes[ii] = u''
+        for ii in range(half, dim):
+            if branch and branch_code != NOT_CODED \
+                    and branch_code != last_codes[ii]:
+                last_codes[ii] = branch_code
+                codes[ii] += branch_code
+            # added for dm hebrew, occurs only when a vowel is in the
+            # branching case (e.g., the VAV in hebrew)
+            elif branch and branch_code == NOT_CODED:
+                last_codes[ii] = u''
+            elif not branch and code != NOT_CODED \
+                    and code != last_codes[ii]:
+                last_codes[ii] = code
+                codes[ii] += code
+            elif other == NOT_CODED:
+                last_codes[ii] = u''
+
+    rv = u''
+    for code in codes:
+        code = (code + u'000000')[:CODE_LENGTH]
+        if code not in rv:
+            rv = rv + SEPARATOR + code if rv else code
+    return rv
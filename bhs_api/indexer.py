@@ -0,0 +1,143 @@
+"""
+Buffered bulk indexing to elasticsearch.
+
+`update_es` adds its index and update actions to the `BulkIndexer` of the
+elasticsearch client instead of making a request per document. The buffer
+is sent in one bulk request when it holds `MAX_ACTIONS` actions, when its
+oldest action waited `MAX_INTERVAL` seconds, when `flush` is called - the
+celery tasks flush when they end - and at process exit.
+The errors are reported per action, `pop_indexed_types` tells which doc
+types had docs indexed.
+"""
+import atexit
+import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import elasticsearch
+
+MAX_ACTIONS = 500
+MAX_INTERVAL = 5
+
+_indexers = weakref.WeakKeyDictionary()
+_indexers_lock = threading.Lock()
+
+
+class BulkIndexer(object):
+
+    def __init__(self, es, max_actions=MAX_ACTIONS, max_interval=MAX_INTERVAL,
+                 logger=None):
+        self.es = es
+        self.max_actions = max_actions
+        self.max_interval = max_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.indexed = 0
+        self.failed = 0
+        self._indexed_types = set()
+        self._actions = []
+        self._first_added = None
+        self._lock = threading.Lock()
+
+    def index(self, index, doc_type, id, body):
+        self._add({'index': {'_index': index, '_type': doc_type, '_id': id}},
+                  body)
+
+    def update(self, index, doc_type, id, doc):
+        self._add({'update': {'_index': index, '_type': doc_type, '_id': id}},
+                  {'doc': doc})
+
+    def _add(self, action, source):
+        with self._lock:
+            self._actions.append((action, source))
+            if self._first_added is None:
+                self._first_added = time.time()
+            if (len(self._actions) >= self.max_actions or
+                    time.time() - self._first_added >= self.max_interval):
+                actions = self._take()
+            else:
+                actions = None
+        if actions:
+            self._send(actions)
+
+    def _take(self):
+        actions, self._actions = self._actions, []
+        self._first_added = None
+        return actions
+
+    def flush(self):
+        ''' sends the buffered actions, returns a list of (action, error) for
+            the actions that failed
+        '''
+        with self._lock:
+            actions = self._take()
+        return self._send(actions) if actions else []
+
+    def _send(self, actions):
+        body = []
+        for action, source in actions:
+            body.append(action)
+            body.append(source)
+        try:
+            res = self.es.bulk(body=body)
+        except elasticsearch.ElasticsearchException as e:
+            errors = [(action, str(e)) for action, source in actions]
+        else:
+            errors = []
+            if res.get('errors'):
+                for (action, source), item in zip(actions, res['items']):
+                    result = item.values()[0]
+                    if 'error' in result:
+                        errors.append((action, result['error']))
+        for action, error in errors:
+            op, meta = action.items()[0]
+            self.logger.error('failed to {} {}/{}/{}: {}'.format(
+                op, meta['_index'], meta['_type'], meta['_id'], error))
+        failed = set(id(action) for action, error in errors)
+        with self._lock:
+            self.indexed += len(actions) - len(errors)
+            self.failed += len(errors)
+            self._indexed_types.update(action.values()[0]['_type']
+                                       for action, source in actions
+                                       if id(action) not in failed)
+        return errors
+
+    def pop_indexed_types(self):
+        ''' returns the doc types indexed since the last call '''
+        with self._lock:
+            types, self._indexed_types = self._indexed_types, set()
+        return types
+
+
+def get_indexer(es):
+    ''' returns the bulk indexer of an elasticsearch client '''
+    with _indexers_lock:
+        indexer = _indexers.get(es)
+        if indexer is None:
+            indexer = _indexers[es] = BulkIndexer(es)
+            atexit.register(indexer.flush)
+    return indexer
+
+
+@contextmanager
+def bulk_load(indexer, index):
+    ''' disables the refresh of the index during a large load, then flushes
+        the indexer and restores the refresh interval
+    '''
+    settings = indexer.es.indices.get_settings(index=index,
+                                               name='index.refresh_interval')
+    # the key is the index name, even when `index` is an alias
+    index_settings = next(iter(settings.values()), {})
+    interval = index_settings.get('settings', {}).get('index', {}) \
+                             .get('refresh_interval')
+    indexer.es.indices.put_settings(index=index,
+                                    body={'index': {'refresh_interval': '-1'}})
+    try:
+        yield indexer
+    finally:
+        indexer.flush()
+        # None resets the interval to the default
+        indexer.es.indices.put_settings(
+            index=index, body={'index': {'refresh_interval': interval}})
+        indexer.es.indices.refresh(index=index)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import re
 import urllib
+import datetime
 import elasticsearch
 from werkzeug.exceptions import NotFound, Forbidden
 from flask import current_app
@@ -8,6 +9,8 @@ from slugify import Slugify
 from bhs_api import phonetic
 from bhs_api.fsearch import clean_person
 from bhs_api.utils import uuids_to_str
+from bhs_api.cache import to_unicode
+from bhs_api.indexer import get_indexer
 from copy import deepcopy
 from bhs_api.fsearch import is_living_person
 
@@ -18,6 +21,16 @@ SHOW_FILTER = {'StatusDesc': 'Completed',
                '$or': [{'UnitText1.En': {'$nin': [None, '']}},
                        {'UnitText1.He': {'$nin': [None, '']}}]}
 
+# migration stores the result of `doc_show_filter` in the `visible` field,
+# so the read paths can use a single indexed equality instead of SHOW_FILTER
+VISIBLE_FILTER = {'visible': True}
+# the item pages also show the docs that were written before migration set
+# `visible`, using the show filter
+ITEM_VISIBLE_FILTER = {'$or': [VISIBLE_FILTER,
+                               dict(SHOW_FILTER, visible={'$exists': False})]}
+# fields used only by mongo queries and the migration, not indexed
+MONGO_FIELDS = ('visible', 'dms_codes', 'content_hash')
+
 
 def get_show_metadata(collection_name, doc):
     if collection_name == "persons":
@@ -37,6 +50,46 @@ def get_show_metadata(collection_name, doc):
                     "UnitText1": doc.get("UnitText1", {})}
 
 
+def get_show_filter(collection_name):
+    ''' returns a mongo query matching the docs that pass `doc_show_filter`,
+        used for backfilling the `visible` field
+    '''
+    if collection_name == "persons":
+        return {'$or': [{'deceased': True}, get_dead_by_age_filter()]}
+    else:
+        return SHOW_FILTER
+
+
+def get_visible_filter(collection_name):
+    ''' returns a mongo query for the visible docs of a collection.
+        a person's `visible` flag is frozen at migration while the living
+        person rule depends on the current year, so persons that got old
+        enough since are matched by their birth year
+    '''
+    if collection_name == "persons":
+        return {'$or': [VISIBLE_FILTER, get_dead_by_age_filter()]}
+    else:
+        return VISIBLE_FILTER
+
+
+def get_dead_by_age_filter():
+    # see `is_living_person` - int(birth_year) <= this year - 100
+    dead_year = datetime.datetime.now().year - 99
+    return {'birth_year': {'$lt': dead_year}}
+
+
+def is_visible(collection_name, doc):
+    ''' use the `visible` field precomputed at migration, falling back to
+        `doc_show_filter` for docs that were not migrated or backfilled yet.
+        persons are always checked with `doc_show_filter` as their rule
+        depends on the current year
+    '''
+    if 'visible' in doc and collection_name != "persons":
+        return doc['visible']
+    else:
+        return doc_show_filter(collection_name, doc)
+
+
 def doc_show_filter(collection_name, doc):
     show_metadata = get_show_metadata(collection_name, doc)
     if collection_name == "persons":
@@ -133,59 +186,155 @@ def _make_serializable(obj):
     return obj
 
 def fetch_items(slug_list, db=None):
-
+    '''
+    Gets a list of items based on their slugs and returns them in the same
+    order. The items are fetched with a single query per collection and
+    items that can't be returned are replaced with a dict holding the slug,
+    an error_code and a msg.
+    When using the app's data db, the results are cached in `app.item_cache`.
+    '''
     if not db:
         db = current_app.data_db
+    if db is current_app.data_db:
+        cache = getattr(current_app, 'item_cache', None)
+    else:
+        cache = None
 
-    rv = []
-    for slug in slug_list:
+    rv = [None] * len(slug_list)
+    # group the slugs by collection, keeping their position in the list
+    by_collection = {}
+    for i, slug in enumerate(slug_list):
         try:
-            item = fetch_item(slug, db)
-            rv.append(item)
-        except (Forbidden, NotFound) as e:
-            rv.append({'slug': slug, 'error_code': e.code, 'msg': e.description})
+            parsed = _parse_slug(slug)
+        except NotFound as e:
+            rv[i] = {'slug': slug, 'error_code': e.code, 'msg': e.description}
+        else:
+            by_collection.setdefault(parsed.collection, []).append((i, slug, to_unicode(parsed.full)))
+
+    if cache:
+        found = cache.get_many([full for slugs in by_collection.values()
+                                     for i, slug, full in slugs])
+    else:
+        found = {}
+    for collection, slugs in by_collection.items():
+        missing = set(full for i, slug, full in slugs if full not in found)
+        if missing:
+            fetched = _fetch_collection_items(collection,
+                                              map(Slug, missing),
+                                              db)
+            if cache:
+                cache.set_many(fetched)
+            found.update(fetched)
+        for i, slug, full in slugs:
+            item = found[full]
+            if 'error_code' in item:
+                rv[i] = dict(item, slug=slug)
+            else:
+                rv[i] = item
     return rv
 
 
-def fetch_item(slug, db=None):
-    """
-    Gets an item based on slug and returns it
-    If slug is bad or item is not found, raises an exception.
+def _fetch_collection_items(collection, slugs, db):
+    ''' get the items for a list of `Slug`s from a single collection using one
+        query for the items and one for all the movies' video urls.
+        returns a dict with the full slug as key and the enriched item or a
+        dict with the `error_code` and `msg` explaining why it can't be
+        returned as value.
+    '''
+    slug_queries = {}
+    for slug in slugs:
+        slug_queries[slug.full] = get_item_query(slug)
+    values_by_field = {}
+    for query in slug_queries.values():
+        for field, value in query.items():
+            values_by_field.setdefault(field, set()).add(value)
+    query = {'$or': [{field: {'$in': list(values)}}
+                     for field, values in values_by_field.items()]}
+
+    items_by_slug = {}
+    for item in db[collection].find(query):
+        for lang, value in item.get('Slug', {}).items():
+            items_by_slug[('Slug.{}'.format(lang), value)] = item
+
+    rv = {}
+    for full_slug, slug_query in slug_queries.items():
+        item = items_by_slug.get(slug_query.items()[0])
+        if not item:
+            rv[full_slug] = _get_error(NotFound())
+        elif collection == 'persons':
+            rv[full_slug] = clean_person(item)
+        elif not is_visible(collection, item):
+            rv[full_slug] = _get_error(Forbidden(_get_filter_failed_msg(slug_query, item)))
+        else:
+            rv[full_slug] = item
+
+    video_urls = None
+    if collection == 'movies':
+        video_ids = [item['MovieFileId'] for item in rv.values()
+                     if 'error_code' not in item]
+        video_urls = get_video_urls(video_ids, db)
+
+    for full_slug, item in rv.items():
+        if 'error_code' in item:
+            continue
+        if collection == 'movies' and item['MovieFileId'] not in video_urls:
+            current_app.logger.debug('No video for {}'.format(full_slug))
+            rv[full_slug] = _get_error(NotFound('No video URL was found for this movie item.'))
+        else:
+            item = enrich_item(item, db, video_urls=video_urls)
+            rv[full_slug] = _make_serializable(item)
+    return rv
 
-    """
-    if not db:
-        db = current_app.data_db
 
+def _get_error(e):
+    return {'error_code': e.code, 'msg': e.description}
+
+
+def _parse_slug(slug):
+    ''' returns a `Slug` object or raises NotFound if the slug is bad '''
     try:
-        slug = Slug(slug)
+        return Slug(slug)
     except ValueError:
         raise NotFound, "missing an underscore in item's slug"
     except KeyError:
         raise NotFound, "bad collection name in slug"
 
+
+def fetch_item(slug, db=None):
+    """
+    Gets an item based on slug and returns it
+    If slug is bad or item is not found, raises an exception.
+
+    """
     #TODO: handle ugc
-    if slug.collection == 'ugc':
-        item = dictify(Ugc.objects(id=_id).first())
-        if item:
-            item = enrich_item(item, db)
-            item_id = item['_id']
-            item = item['ugc'] # Getting the dict out from  mongoengine
-            item['_id'] = item_id
-            if type(item['_id']) == dict and '$oid' in item['_id']:
-                item['_id'] = item['_id']['$oid']
-            return _make_serializable(item)
+    item = fetch_items([slug], db)[0]
+    if 'error_code' in item:
+        if item['error_code'] == Forbidden.code:
+            raise Forbidden(item['msg'])
         else:
-            raise NotFound
-    else:
-        item = get_item(slug, db)
-        item = enrich_item(item, db)
-        return _make_serializable(item)
-        return item
+            raise NotFound(item['msg'])
+    return item
 
-def enrich_item(item, db=None, collection_name=None):
+def enrich_items(items, db=None):
+    ''' enrich a list of (item, collection name) pairs, fetching the video
+        urls of all the movies with a single query
+    '''
+    if not db:
+        db = current_app.data_db
+    video_ids = [item['MovieFileId'] for item, collection_name in items
+                 if 'MovieFileId' in item]
+    video_urls = get_video_urls(video_ids, db) if video_ids else {}
+    for item, collection_name in items:
+        enrich_item(item, db, collection_name, video_urls=video_urls)
+
+
+def enrich_item(item, db=None, collection_name=None, video_urls=None):
+    ''' add the media urls to the item.
+        `video_urls` is an optional dict of pre-fetched video urls, as returned
+        by `get_video_urls`, used to save a query per movie.
+    '''
     if not db:
         db = current_app.data_db
-    ''' and the media urls to the item '''
     pictures = item.get('Pictures', None)
     if pictures:
         main_image_id = None
@@ -209,7 +358,10 @@ def enrich_item(item, db=None, collection_name=None):
     if video_id_key in item:
         # Try to fetch the video URL
         video_id = item[video_id_key]
-        video_url = get_video_url(video_id, db)
+        if video_urls is None:
+            video_url = get_video_url(video_id, db)
+        else:
+            video_url = video_urls.get(video_id)
         if video_url:
             item['video_url'] = video_url
         else:
@@ -263,14 +415,14 @@ def get_item(slug, db=None):
 def _filter_doc(query, collection, db):
     search_query = query.copy()
     if collection != 'persons':
-        search_query.update(SHOW_FILTER)
+        search_query.update(ITEM_VISIBLE_FILTER)
     item = db[collection].find_one(search_query)
     if item:
         if collection == 'movies':
             video_id = item['MovieFileId']
             video_url = get_video_url(video_id, db)
             if not video_url:
-                current_app.logger.debug('No video for {}'.format(slug))
+                current_app.logger.debug('No video for {}'.format(query))
                 return None
             else:
                 return item
@@ -281,40 +433,52 @@ def _filter_doc(query, collection, db):
     else:
         item = db[collection].find_one(query)
         if item:
-            msg = ['filter failed for {}'.format(unicode(query))]
-            if item['StatusDesc'] != 'Completed':
-                msg.append("Status Description is not 'Completed'")
-            if item['RightsDesc'] != 'Full':
-                msg.append("The  Rights of the Item are not 'Full'")
-            if item['DisplayStatusDesc'] == 'Internal Use':
-                msg.append("Display Status is 'Internal Use'")
-            if item['UnitText1']['En'] in [None, ''] and \
-               item['UnitText1']['He'] in [None, '']:
-                msg.append('Empty Text (description) in both Heabrew and English')
-            raise Forbidden('\n'.join(msg))
+            raise Forbidden(_get_filter_failed_msg(query, item))
         else:
             raise NotFound
 
+def _get_filter_failed_msg(query, item):
+    msg = ['filter failed for {}'.format(unicode(query))]
+    if item.get('StatusDesc') != 'Completed':
+        msg.append("Status Description is not 'Completed'")
+    if item.get('RightsDesc') != 'Full':
+        msg.append("The  Rights of the Item are not 'Full'")
+    if item.get('DisplayStatusDesc') == 'Internal Use':
+        msg.append("Display Status is 'Internal Use'")
+    unit_text = item.get('UnitText1') or {}
+    if unit_text.get('En') in [None, ''] and \
+       unit_text.get('He') in [None, '']:
+        msg.append('Empty Text (description) in both Heabrew and English')
+    return '\n'.join(msg)
+
 def get_collection_name(doc):
     slug = Slug(get_item_slug(doc))
     return slug.collection
 
 def get_video_url(video_id, db):
+    video_url = get_video_urls([video_id], db).get(video_id)
+    if not video_url:
+        current_app.logger.debug('Video URL was not found for {}'.format(video_id))
+    return video_url
+
+def get_video_urls(video_ids, db):
+    ''' returns a dict of video id -> url for the `video_ids` that have a
+        video we can show, using a single query
+    '''
     video_bucket_url = current_app.config['VIDEO_BUCKET_URL']
     collection = db['movies']
     # Search only within the movies filtered by rights, display status and work status
-    video = collection.find_one({'MovieFileId': video_id,
-                                 'RightsDesc': 'Full',
-                                 'StatusDesc': 'Completed',
-                                 'DisplayStatusDesc': {'$nin': ['Internal Use']},
-                                 'MoviePath': {'$nin': [None, 'None']}})
-    if video:
-        extension = 'mp4'
-        url = '{}/{}.{}'.format(video_bucket_url, video_id, extension)
-        return url
-    else:
-        current_app.logger.debug('Video URL was not found for {}'.format(video_id))
-        return None
+    videos = collection.find({'MovieFileId': {'$in': list(set(video_ids))},
+                              'RightsDesc': 'Full',
+                              'StatusDesc': 'Completed',
+                              'DisplayStatusDesc': {'$nin': ['Internal Use']},
+                              'MoviePath': {'$nin': [None, 'None']}},
+                             {'MovieFileId': True})
+    extension = 'mp4'
+    return {video['MovieFileId']: '{}/{}.{}'.format(video_bucket_url,
+                                                    video['MovieFileId'],
+                                                    extension)
+            for video in videos}
 
 
 def search_by_header(string, collection, starts_with=True, db=None):
@@ -334,7 +498,7 @@ def search_by_header(string, collection, starts_with=True, db=None):
     lang_header = 'Header.{}'.format(lang)
     unit_text = 'UnitText1.{}'.format(lang)
     # Search only for non empty docs with right status
-    show_filter = SHOW_FILTER.copy()
+    show_filter = ITEM_VISIBLE_FILTER.copy()
     show_filter[unit_text] = {"$nin": [None, '']}
     header_search_ex = {lang_header: header_regex}
     header_search_ex.update(show_filter)
@@ -421,6 +585,13 @@ def get_doc_id(collection_name, doc):
     return doc[id_field]
 
 
+def strip_mongo_fields(body):
+    ''' removes the fields used only by mongo queries and the migration '''
+    for field in MONGO_FIELDS:
+        if field in body:
+            del body[field]
+
+
 def update_es(collection_name, doc, is_new, es_index_name=None, es=None, app=None):
     app = current_app if not app else app
     es_index_name = app.es_data_db_index_name if not es_index_name else es_index_name
@@ -439,6 +610,7 @@ def update_es(collection_name, doc, is_new, es_index_name=None, es=None, app=Non
         # _id field is internal to mongo
         if '_id' in body:
             del body['_id']
+        strip_mongo_fields(body)
         # id field has special meaning in elasticsearch
         if 'id' in body:
             del body['id']
@@ -462,12 +634,14 @@ def update_es(collection_name, doc, is_new, es_index_name=None, es=None, app=Non
             doc_id = "{}_{}_{}".format(body["tree_num"], body["tree_version"], body["person_id"])
         else:
             doc_id = get_doc_id(collection_name, body)
+        uuids_to_str(body)
+        # the indexer sends the docs in bulk, errors are logged when it flushes
+        indexer = get_indexer(es)
         if is_new:
-            uuids_to_str(body)
-            es.index(index=es_index_name, doc_type=collection_name, id=doc_id, body=body)
-            return True, "indexed successfully (inserted)"
+            indexer.index(es_index_name, collection_name, doc_id, body)
+            return True, "queued for indexing (inserted)"
         else:
-            es.update(index=es_index_name, doc_type=collection_name, id=doc_id, body=body)
-            return True, "indexed successfully (updated)"
+            indexer.update(es_index_name, collection_name, doc_id, body)
+            return True, "queued for indexing (updated)"
     else:
         return True, "item should not be shown - so not indexed"
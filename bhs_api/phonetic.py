@@ -4,14 +4,15 @@
 import argparse
 import subprocess
 import re
-from itertools import groupby
-import requests
-import urllib2
+from itertools import groupby, product
 
 import pymongo
 
 import unicodedata
 
+from bhs_api import hebrew_dm
+from bhs_api.cache import LRU
+
 
 def is_hebrew(string):
     'A hacky way to check if our string is in Hebrew - check the 1rst char'
@@ -34,10 +35,10 @@ def is_hebrew(string):
         return False
 
 def get_hebrew_dms(name):
-    ''' use the dms server to tturn a hebrew name into phonetic code '''
-    escaped_name = urllib2.quote(name.encode('utf8'))
-    r = requests.get('http://localhost:8765?n=' + escaped_name)
-    return r.text
+    ''' turn a hebrew name into phonetic code '''
+    # the codes stored in the db came from the dms server's response, which
+    # ended with a newline
+    return hebrew_dm.encode(name) + u'\n'
 
 def get_english_dms(string):
     'Using code from https://github.com/chrislit/abydos/blob/master/abydos/phonetic.py'
@@ -99,36 +100,127 @@ def get_exact_phonetic_matches(string, collection_obj):
 
     return found
 
+def get_dms_codes(soundex):
+    '''Get the codes out of a dms in the BHP database format.
+    get_dms_codes('ZZ H194860 H197486 ZZ ') ==> ['194860', '197486']
+    '''
+    return re.findall(r'\d+', soundex or '')
+
+def get_header_dms_codes(header_soundex):
+    '''Index the codes of a UnitHeaderDMSoundex by language, migration stores
+    them in the multikey indexed `dms_codes` field.
+    '''
+    return {lang: get_dms_codes(soundex)
+            for lang, soundex in (header_soundex or {}).items()}
+
 def get_similar_strings(string, collection_obj):
-    'Searches in the UnitHeaderDMSoundex.Lang field of bhp6 compatible db'
+    'Searches in the dms_codes.Lang field of bhp6 compatible db'
     if is_hebrew(string):
         lang = 'He'
         # Get rid of whitespaces inside Hebrew strings
         string = string.replace(' ', '')
     else:
         lang = 'En'
-    dms = get_dms(string)
+    codes = get_dms_codes(get_dms(string))
+    unit_text = 'UnitText1.{}'.format(lang)
+    header = 'Header.{}'.format(lang)
+    # see bhs_api.item.VISIBLE_FILTER
+    dms_search_ex = {'visible': True,
+                     unit_text: {"$nin": ['', None]},
+                     'dms_codes.{}'.format(lang): {'$in': codes}}
+    projection = {'_id': 0, header: 1}
     found = []
-    for dms_value in dms.split(' '):
-        dms_regex = re.compile(dms_value)
-        unit_text = 'UnitText1.{}'.format(lang)
-        header = 'Header.{}'.format(lang)
-        show_filter = {'StatusDesc': 'Completed',
-                       'RightsDesc': 'Full',
-                       'DisplayStatusDesc':  {'$nin': ['Internal Use']},
-                       unit_text: {"$nin": ['', None]}}
-        dms_field = 'UnitHeaderDMSoundex.{}'.format(lang)
-        dms_search_ex = {dms_field: dms_regex}
-        dms_search_ex.update(show_filter)
-        projection = {'_id': 0, header: 1}
-        cursor = collection_obj.find(dms_search_ex, projection)
-        for doc in cursor:
-            header = doc['Header'][lang]
-            if header:
-                found.append(header.lower())
+    for doc in collection_obj.find(dms_search_ex, projection):
+        header = doc['Header'][lang]
+        if header:
+            found.append(header.lower())
 
     return found
 
+DMS_TABLE = {'STCH': (2, 4, 4), 'DRZ': (4, 4, 4), 'ZH': (4, 4, 4),
+             'ZHDZH': (2, 4, 4), 'DZH': (4, 4, 4), 'DRS': (4, 4, 4),
+             'DZS': (4, 4, 4), 'SCHTCH': (2, 4, 4), 'SHTSH': (2, 4, 4),
+             'SZCZ': (2, 4, 4), 'TZS': (4, 4, 4), 'SZCS': (2, 4, 4),
+             'STSH': (2, 4, 4), 'SHCH': (2, 4, 4), 'D': (3, 3, 3),
+             'H': (5, 5, '_'), 'TTSCH': (4, 4, 4), 'THS': (4, 4, 4),
+             'L': (8, 8, 8), 'P': (7, 7, 7), 'CHS': (5, 54, 54),
+             'T': (3, 3, 3), 'X': (5, 54, 54), 'OJ': (0, 1, '_'),
+             'OI': (0, 1, '_'), 'SCHTSH': (2, 4, 4), 'OY': (0, 1, '_'),
+             'Y': (1, '_', '_'), 'TSH': (4, 4, 4), 'ZDZ': (2, 4, 4),
+             'TSZ': (4, 4, 4), 'SHT': (2, 43, 43), 'SCHTSCH': (2, 4, 4),
+             'TTSZ': (4, 4, 4), 'TTZ': (4, 4, 4), 'SCH': (4, 4, 4),
+             'TTS': (4, 4, 4), 'SZD': (2, 43, 43), 'AI': (0, 1, '_'),
+             'PF': (7, 7, 7), 'TCH': (4, 4, 4), 'PH': (7, 7, 7),
+             'TTCH': (4, 4, 4), 'SZT': (2, 43, 43), 'ZDZH': (2, 4, 4),
+             'EI': (0, 1, '_'), 'G': (5, 5, 5), 'EJ': (0, 1, '_'),
+             'ZD': (2, 43, 43), 'IU': (1, '_', '_'), 'K': (5, 5, 5),
+             'O': (0, '_', '_'), 'SHTCH': (2, 4, 4), 'S': (4, 4, 4),
+             'TRZ': (4, 4, 4), 'SHD': (2, 43, 43), 'DSH': (4, 4, 4),
+             'CSZ': (4, 4, 4), 'EU': (1, 1, '_'), 'TRS': (4, 4, 4),
+             'ZS': (4, 4, 4), 'STRZ': (2, 4, 4), 'UY': (0, 1, '_'),
+             'STRS': (2, 4, 4), 'CZS': (4, 4, 4),
+             'MN': ('6_6', '6_6', '6_6'), 'UI': (0, 1, '_'),
+             'UJ': (0, 1, '_'), 'UE': (0, '_', '_'), 'EY': (0, 1, '_'),
+             'W': (7, 7, 7), 'IA': (1, '_', '_'), 'FB': (7, 7, 7),
+             'STSCH': (2, 4, 4), 'SCHT': (2, 43, 43),
+             'NM': ('6_6', '6_6', '6_6'), 'SCHD': (2, 43, 43),
+             'B': (7, 7, 7), 'DSZ': (4, 4, 4), 'F': (7, 7, 7),
+             'N': (6, 6, 6), 'CZ': (4, 4, 4), 'R': (9, 9, 9),
+             'U': (0, '_', '_'), 'V': (7, 7, 7), 'CS': (4, 4, 4),
+             'Z': (4, 4, 4), 'SZ': (4, 4, 4), 'TSCH': (4, 4, 4),
+             'KH': (5, 5, 5), 'ST': (2, 43, 43), 'KS': (5, 54, 54),
+             'SH': (4, 4, 4), 'SC': (2, 4, 4), 'SD': (2, 43, 43),
+             'DZ': (4, 4, 4), 'ZHD': (2, 43, 43), 'DT': (3, 3, 3),
+             'ZSH': (4, 4, 4), 'DS': (4, 4, 4), 'TZ': (4, 4, 4),
+             'TS': (4, 4, 4), 'TH': (3, 3, 3), 'TC': (4, 4, 4),
+             'A': (0, '_', '_'), 'E': (0, '_', '_'), 'I': (0, '_', '_'),
+             'AJ': (0, 1, '_'), 'M': (6, 6, 6), 'Q': (5, 5, 5),
+             'AU': (0, 7, '_'), 'IO': (1, '_', '_'), 'AY': (0, 1, '_'),
+             'IE': (1, '_', '_'), 'ZSCH': (4, 4, 4),
+             'CH':((5, 4), (5, 4), (5, 4)),
+             'CK':((5, 45), (5, 45), (5, 45)),
+             'C':((5, 4), (5, 4), (5, 4)),
+             'J':((1, 4), ('_', 4), ('_', 4)),
+             'RZ':((94, 4), (94, 4), (94, 4)),
+             'RS':((94, 4), (94, 4), (94, 4))}
+
+DMS_VOWELS = frozenset('AEIJOUY')
+DMS_LETTERS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+DMS_CACHE_SIZE = 50000
+
+
+def _compile_dms_table():
+    ''' build a prefix trie of the codes' substrings, one per leading letter.
+        the longest substring in the trie is the one that gets coded.
+        each node is a dict of the next letter to a child node and a `None`
+        key holding the substring's length and its positional code variants
+        (first, pre-vocalic, elsewhere), as tuples of alternative codes.
+    '''
+    trie = {}
+    for sstr, dm_val in DMS_TABLE.items():
+        node = trie
+        for c in sstr:
+            node = node.setdefault(c, {})
+        variants = []
+        for val in dm_val:
+            if isinstance(val, tuple):
+                variants.append(tuple(unicode(v) for v in val))
+            else:
+                variants.append((unicode(val),))
+        node[None] = (len(sstr), tuple(variants))
+    return trie
+
+_dms_trie = _compile_dms_table()
+_dms_cache = LRU(DMS_CACHE_SIZE)
+
+
+def _normalize_dms_word(word):
+    ''' uppercase, normalize, decompose, and filter non-A-Z '''
+    word = unicodedata.normalize('NFKD', unicode(word.upper()))
+    word = word.replace(u'\xdf', 'SS')
+    return ''.join([c for c in word if c in DMS_LETTERS])
+
+
 def dm_soundex(word, maxlength=6, reverse=False, zero_pad=True):
     """Return the Daitch-Mokotoff Soundex values of a word as a set
         A collection is necessary since there can be multiple values for a
@@ -142,137 +234,82 @@ def dm_soundex(word, maxlength=6, reverse=False, zero_pad=True):
     zero_pad -- pad the end of the return value with 0s to achieve a maxlength
         string
     """
-    _dms_table = {'STCH': (2, 4, 4), 'DRZ': (4, 4, 4), 'ZH': (4, 4, 4),
-                  'ZHDZH': (2, 4, 4), 'DZH': (4, 4, 4), 'DRS': (4, 4, 4),
-                  'DZS': (4, 4, 4), 'SCHTCH': (2, 4, 4), 'SHTSH': (2, 4, 4),
-                  'SZCZ': (2, 4, 4), 'TZS': (4, 4, 4), 'SZCS': (2, 4, 4),
-                  'STSH': (2, 4, 4), 'SHCH': (2, 4, 4), 'D': (3, 3, 3),
-                  'H': (5, 5, '_'), 'TTSCH': (4, 4, 4), 'THS': (4, 4, 4),
-                  'L': (8, 8, 8), 'P': (7, 7, 7), 'CHS': (5, 54, 54),
-                  'T': (3, 3, 3), 'X': (5, 54, 54), 'OJ': (0, 1, '_'),
-                  'OI': (0, 1, '_'), 'SCHTSH': (2, 4, 4), 'OY': (0, 1, '_'),
-                  'Y': (1, '_', '_'), 'TSH': (4, 4, 4), 'ZDZ': (2, 4, 4),
-                  'TSZ': (4, 4, 4), 'SHT': (2, 43, 43), 'SCHTSCH': (2, 4, 4),
-                  'TTSZ': (4, 4, 4), 'TTZ': (4, 4, 4), 'SCH': (4, 4, 4),
-                  'TTS': (4, 4, 4), 'SZD': (2, 43, 43), 'AI': (0, 1, '_'),
-                  'PF': (7, 7, 7), 'TCH': (4, 4, 4), 'PH': (7, 7, 7),
-                  'TTCH': (4, 4, 4), 'SZT': (2, 43, 43), 'ZDZH': (2, 4, 4),
-                  'EI': (0, 1, '_'), 'G': (5, 5, 5), 'EJ': (0, 1, '_'),
-                  'ZD': (2, 43, 43), 'IU': (1, '_', '_'), 'K': (5, 5, 5),
-                  'O': (0, '_', '_'), 'SHTCH': (2, 4, 4), 'S': (4, 4, 4),
-                  'TRZ': (4, 4, 4), 'SHD': (2, 43, 43), 'DSH': (4, 4, 4),
-                  'CSZ': (4, 4, 4), 'EU': (1, 1, '_'), 'TRS': (4, 4, 4),
-                  'ZS': (4, 4, 4), 'STRZ': (2, 4, 4), 'UY': (0, 1, '_'),
-                  'STRS': (2, 4, 4), 'CZS': (4, 4, 4),
-                  'MN': ('6_6', '6_6', '6_6'), 'UI': (0, 1, '_'),
-                  'UJ': (0, 1, '_'), 'UE': (0, '_', '_'), 'EY': (0, 1, '_'),
-                  'W': (7, 7, 7), 'IA': (1, '_', '_'), 'FB': (7, 7, 7),
-                  'STSCH': (2, 4, 4), 'SCHT': (2, 43, 43),
-                  'NM': ('6_6', '6_6', '6_6'), 'SCHD': (2, 43, 43),
-                  'B': (7, 7, 7), 'DSZ': (4, 4, 4), 'F': (7, 7, 7),
-                  'N': (6, 6, 6), 'CZ': (4, 4, 4), 'R': (9, 9, 9),
-                  'U': (0, '_', '_'), 'V': (7, 7, 7), 'CS': (4, 4, 4),
-                  'Z': (4, 4, 4), 'SZ': (4, 4, 4), 'TSCH': (4, 4, 4),
-                  'KH': (5, 5, 5), 'ST': (2, 43, 43), 'KS': (5, 54, 54),
-                  'SH': (4, 4, 4), 'SC': (2, 4, 4), 'SD': (2, 43, 43),
-                  'DZ': (4, 4, 4), 'ZHD': (2, 43, 43), 'DT': (3, 3, 3),
-                  'ZSH': (4, 4, 4), 'DS': (4, 4, 4), 'TZ': (4, 4, 4),
-                  'TS': (4, 4, 4), 'TH': (3, 3, 3), 'TC': (4, 4, 4),
-                  'A': (0, '_', '_'), 'E': (0, '_', '_'), 'I': (0, '_', '_'),
-                  'AJ': (0, 1, '_'), 'M': (6, 6, 6), 'Q': (5, 5, 5),
-                  'AU': (0, 7, '_'), 'IO': (1, '_', '_'), 'AY': (0, 1, '_'),
-                  'IE': (1, '_', '_'), 'ZSCH': (4, 4, 4),
-                  'CH':((5, 4), (5, 4), (5, 4)),
-                  'CK':((5, 45), (5, 45), (5, 45)),
-                  'C':((5, 4), (5, 4), (5, 4)),
-                  'J':((1, 4), ('_', 4), ('_', 4)),
-                  'RZ':((94, 4), (94, 4), (94, 4)),
-                  'RS':((94, 4), (94, 4), (94, 4))}
-
-    _dms_order = {'A':('AI', 'AJ', 'AU', 'AY', 'A'), 'B':('B'),
-                  'C':('CHS', 'CSZ', 'CZS', 'CH', 'CK', 'CS', 'CZ', 'C'),
-                  'D':('DRS', 'DRZ', 'DSH', 'DSZ', 'DZH', 'DZS', 'DS', 'DT',
-                       'DZ', 'D'), 'E':('EI', 'EJ', 'EU', 'EY', 'E'),
-                  'F':('FB', 'F'), 'G':('G'), 'H':('H'),
-                  'I':('IA', 'IE', 'IO', 'IU', 'I'), 'J':('J'),
-                  'K':('KH', 'KS', 'K'), 'L':('L'), 'M':('MN', 'M'),
-                  'N':('NM', 'N'), 'O':('OI', 'OJ', 'OY', 'O'),
-                  'P':('PF', 'PH', 'P'), 'Q':('Q'), 'R':('RS', 'RZ', 'R'),
-                  'S':('SCHTSCH', 'SCHTCH', 'SCHTSH', 'SHTCH', 'SHTSH', 'STSCH',
-                       'SCHD', 'SCHT', 'SHCH', 'STCH', 'STRS', 'STRZ', 'STSH',
-                       'SZCS', 'SZCZ', 'SCH', 'SHD', 'SHT', 'SZD', 'SZT', 'SC',
-                       'SD', 'SH', 'ST', 'SZ', 'S'),
-                  'T':('TTSCH', 'TSCH', 'TTCH', 'TTSZ', 'TCH', 'THS', 'TRS',
-                       'TRZ', 'TSH', 'TSZ', 'TTS', 'TTZ', 'TZS', 'TC', 'TH',
-                       'TS', 'TZ', 'T'), 'U':('UE', 'UI', 'UJ', 'UY', 'U'),
-                  'V':('V'), 'W':('W'), 'X':('X'), 'Y':('Y'),
-                  'Z':('ZHDZH', 'ZDZH', 'ZSCH', 'ZDZ', 'ZHD', 'ZSH', 'ZD', 'ZH',
-                       'ZS', 'Z')}
-
-    _vowels = tuple('AEIJOUY')
-    dms = [''] # initialize empty code list
+    return set(_dm_soundex(word, maxlength, reverse, zero_pad))
+
 
+def dm_soundex_many(words, maxlength=6, reverse=False, zero_pad=True):
+    ''' returns a list with the `dm_soundex` of every word '''
+    return [set(_dm_soundex(word, maxlength, reverse, zero_pad))
+            for word in words]
+
+
+def _dm_soundex(word, maxlength, reverse, zero_pad):
+    ''' returns the cached frozenset of the word's codes '''
     # Require a maxlength of at least 6 and not more than 64
     if maxlength is not None:
         maxlength = min(max(6, maxlength), 64)
     else:
         maxlength = 64
 
-    # uppercase, normalize, decompose, and filter non-A-Z
-    word = unicodedata.normalize('NFKD', unicode(word.upper()))
-    word = word.replace(u'ß', 'SS')
-    word = ''.join([c for c in word if c in
-                    tuple('ABCDEFGHIJKLMNOPQRSTUVWXYZ')])
+    word = _normalize_dms_word(word)
 
     # Nothing to convert, return base case
     if not word:
         if zero_pad:
-            return set(['0'*maxlength])
+            return frozenset(['0'*maxlength])
         else:
-            return set(['0'])
+            return frozenset(['0'])
 
     # Reverse word if computing Reverse Soundex
     if reverse:
         word = word[::-1]
 
+    key = (word, maxlength, zero_pad)
+    dms = _dms_cache.get(key)
+    if dms is None:
+        dms = frozenset(_encode_dms(word, maxlength, zero_pad))
+        _dms_cache.set(key, dms)
+    return dms
+
+
+def _encode_dms(word, maxlength, zero_pad):
+    ''' yields the codes of a normalized word '''
+    # the alternative codes of each substring, the codes are all the
+    # combinations
+    parts = []
     pos = 0
-    while pos < len(word):
-        # Iterate through _dms_order, which specifies the possible substrings
-        # for which codes exist in the Daitch-Mokotoff coding
-        for sstr in _dms_order[word[pos]]:
-            if word[pos:].startswith(sstr):
-                # Having determined a valid substring start, retrieve the code
-                dm_val = _dms_table[sstr]
-
-                # Having retried the code (triple), determine the correct
-                # positional variant (first, pre-vocalic, elsewhere)
-                if pos == 0:
-                    dm_val = dm_val[0]
-                elif (pos+len(sstr) < len(word) and
-                      word[pos+len(sstr)] in _vowels):
-                    dm_val = dm_val[1]
-                else:
-                    dm_val = dm_val[2]
-
-                # Build the code strings
-                if isinstance(dm_val, tuple):
-                    dms = [_ + unicode(dm_val[0]) for _ in dms] \
-                            + [_ + unicode(dm_val[1]) for _ in dms]
-                else:
-                    dms = [_ + unicode(dm_val) for _ in dms]
-                pos += len(sstr)
-                break
-
-    # Filter out double letters and _ placeholders
-    dms = [''.join([c for c in _delete_consecutive_repeats(_) if c != '_'])
-           for _ in dms]
-
-    # Trim codes and return set
-    if zero_pad:
-        dms = [(_ + ('0'*maxlength))[:maxlength] for _ in dms]
-    else:
-        dms = [_[:maxlength] for _ in dms]
-    return set(dms)
+    length = len(word)
+    while pos < length:
+        # find the longest substring starting at `pos` that has a code
+        node = _dms_trie
+        match = None
+        i = pos
+        while i < length and word[i] in node:
+            node = node[word[i]]
+            i += 1
+            if None in node:
+                match = node[None]
+        sstr_len, variants = match
+
+        # determine the correct positional variant (first, pre-vocalic,
+        # elsewhere)
+        if pos == 0:
+            parts.append(variants[0])
+        elif pos+sstr_len < length and word[pos+sstr_len] in DMS_VOWELS:
+            parts.append(variants[1])
+        else:
+            parts.append(variants[2])
+        pos += sstr_len
+
+    for codes in product(*parts):
+        # Filter out double letters and _ placeholders
+        dms = ''.join(codes)
+        dms = ''.join([c for c in _delete_consecutive_repeats(dms) if c != '_'])
+        # Trim codes
+        if zero_pad:
+            yield (dms + ('0'*maxlength))[:maxlength]
+        else:
+            yield dms[:maxlength]
 
 def _delete_consecutive_repeats(word):
     """Return word with all contiguous repeating characters collapsed to
@@ -0,0 +1,215 @@
+"""
+Completion suggestions for the search box, with a redis cache in front of
+elasticsearch.
+
+Autocomplete traffic is dominated by short prefixes, so `warm_suggestions`
+precomputes the suggestions of the most frequent 1-3 letter header prefixes
+of every collection. It should run after the index is updated, the
+warmed suggestions expire with the rest of the cache in case it doesn't.
+`clear_suggestions` drops the cached suggestions, the celery tasks drop the
+ones of the collections they indexed docs of. With no redis
+configured the suggestions aren't cached.
+"""
+import re
+import cPickle
+from collections import Counter
+
+import redis
+from flask import current_app
+
+from bhs_api import phonetic
+from bhs_api.item import VISIBLE_FILTER
+from bhs_api.utils import SEARCHABLE_COLLECTIONS
+
+KEY_PREFIX = 'suggest:'
+SIZE = 7
+HOT_PREFIX_LENGTH = 3
+HOT_PREFIXES = 50
+
+
+def get_lang(string):
+    return "He" if phonetic.is_hebrew(string) else "En"
+
+
+def get_completion_all_collections(string, size=SIZE):
+    '''Search all the collections for completion options in a single
+    elasticsearch request, using a named suggester per collection.
+    Returns a tuple of (text_completion_results, phonetic_results, took)
+    where the results are dicts of collection -> array of up to `size` results.
+    '''
+    lang = get_lang(string)
+    q = {
+        "_source": ["Slug", "Header"],
+        "suggest": {collection: get_completion_suggester(collection, string, size, lang)
+                    for collection in SEARCHABLE_COLLECTIONS}
+    }
+    results = current_app.es.search(index=current_app.es_data_db_index_name, body=q, size=0)
+    text_completion_result = {}
+    phonetic_result = {}
+    for collection in SEARCHABLE_COLLECTIONS:
+        text_completion_result[collection] = get_suggest_options(results, collection, lang)
+        # TODO: fix phonetics search, see get_completion
+        phonetic_result[collection] = []
+    return text_completion_result, phonetic_result, results['took']
+
+
+def get_completion_suggester(collection, string, size, lang):
+    return {
+        "prefix": string,
+        "completion": {
+            "field": "Header.{}.suggest".format(lang),
+            "size": size,
+            "contexts": {
+                "collection": collection,
+            }
+        }
+    }
+
+
+def get_suggest_options(results, suggester, lang):
+    try:
+        options = results['suggest'][suggester][0]['options']
+    except KeyError:
+        options = []
+    return [i['_source']['Header'][lang] for i in options]
+
+
+def get_completion(collection, string, size=SIZE):
+    '''Search in the elastic search index for completion options.
+    Returns tuple of (text_completion_results, phonetic_results, took)
+    Where each array contains up to `size` results.
+    '''
+    # currently we only do a simple starts with search, without contains or phonetics
+    # TODO: fix phonetics search, some work was done for that
+    # see https://github.com/Beit-Hatfutsot/dbs-back/blob/2e79c363e40472f28fd07f8a344fe55ab77198ee/bhs_api/v1_endpoints.py#L189
+    lang = get_lang(string)
+    q = {
+        "_source": ["Slug", "Header"],
+        "suggest": {
+            "header": get_completion_suggester(collection, string, size, lang),
+        }
+    }
+    results = current_app.es.search(index=current_app.es_data_db_index_name, body=q, size=0)
+    return (get_suggest_options(results, 'header', lang),
+            get_suggest_options(results, 'phonetic', lang),
+            results['took'])
+
+
+def normalize_prefix(string):
+    ''' the completion suggester's analyzer ignores case and repeated spaces '''
+    return re.sub(r'\s+', ' ', string.lower(), flags=re.U).lstrip()
+
+
+def get_key(collection, lang, prefix, size):
+    return u'{}{}:{}:{}:{}'.format(KEY_PREFIX, collection, lang, size,
+                                   prefix).encode('utf8')
+
+
+def get_cached_completion(collection, string, size=SIZE):
+    '''Same as `get_completion` and `get_completion_all_collections` for a
+    `*` collection, serving cached suggestions with a `took` of 0.
+    '''
+    lang = get_lang(string)
+    prefix = normalize_prefix(string)
+    if current_app.redis is None:
+        return _get_completion(collection, prefix, size)
+    key = get_key(collection, lang, prefix, size)
+    try:
+        cached = current_app.redis.get(key)
+    except redis.RedisError as e:
+        current_app.logger.warn('failed to get cached suggestions: {}'.format(e))
+        cached = None
+    if cached:
+        text_completion_result, phonetic_result = cPickle.loads(cached)
+        return text_completion_result, phonetic_result, 0
+
+    text_completion_result, phonetic_result, took = \
+        _get_completion(collection, prefix, size)
+    _set_cached(key, (text_completion_result, phonetic_result),
+                current_app.config['CACHING_TTL'])
+    return text_completion_result, phonetic_result, took
+
+
+def _get_completion(collection, string, size):
+    if collection == "*":
+        return get_completion_all_collections(string, size)
+    else:
+        return get_completion(collection, string, size)
+
+
+def _set_cached(key, value, ttl):
+    try:
+        current_app.redis.set(key, cPickle.dumps(value), ex=ttl)
+    except redis.RedisError as e:
+        current_app.logger.warn('failed to cache suggestions: {}'.format(e))
+
+
+def get_hot_prefixes(collection, lang, db=None,
+                     max_length=HOT_PREFIX_LENGTH, top=HOT_PREFIXES):
+    ''' returns the `top` most frequent prefixes of every length up to
+        `max_length` of the visible headers in `lang`
+    '''
+    db = db or current_app.data_db
+    header_field = 'Header.{}'.format(lang)
+    counts = [Counter() for i in range(max_length)]
+    for doc in db[collection].find(VISIBLE_FILTER, {header_field: True}):
+        header = (doc.get('Header') or {}).get(lang)
+        if not header:
+            continue
+        header = normalize_prefix(header)
+        for i in range(min(max_length, len(header))):
+            counts[i][header[:i+1]] += 1
+    return [prefix for count in counts
+                   for prefix, n in count.most_common(top)]
+
+
+def warm_suggestions(size=SIZE):
+    '''Cache the suggestions of the hot prefixes of every collection and of
+    all the collections. Persons are left out as the mongo docs have no
+    Header.
+    '''
+    if current_app.redis is None:
+        current_app.logger.warn('no redis to warm the suggestions in')
+        return 0
+    all_prefixes = set()
+    warmed = 0
+    for collection in SEARCHABLE_COLLECTIONS:
+        if collection == 'persons':
+            continue
+        for lang in ('En', 'He'):
+            prefixes = get_hot_prefixes(collection, lang)
+            all_prefixes.update(prefixes)
+            for prefix in prefixes:
+                _warm(collection, prefix, size)
+                warmed += 1
+    for prefix in all_prefixes:
+        _warm("*", prefix, size)
+        warmed += 1
+    return warmed
+
+
+def _warm(collection, prefix, size):
+    text_completion_result, phonetic_result, took = \
+        _get_completion(collection, prefix, size)
+    _set_cached(get_key(collection, get_lang(prefix), prefix, size),
+                (text_completion_result, phonetic_result),
+                current_app.config['CACHING_TTL'])
+
+
+def clear_suggestions(redis_client, collections=None):
+    ''' drop the cached suggestions of `collections` and of all the
+        collections, or all of them when `collections` is None.
+        returns how many were dropped
+    '''
+    if collections is None:
+        patterns = [KEY_PREFIX + '*']
+    else:
+        # `*` is the key of all the collections, [*] matches it literally
+        patterns = ['{}{}:*'.format(KEY_PREFIX, collection)
+                    for collection in list(collections) + ['[*]']]
+    keys = set()
+    for pattern in patterns:
+        keys.update(redis_client.scan_iter(match=pattern))
+    if keys:
+        redis_client.delete(*keys)
+    return len(keys)
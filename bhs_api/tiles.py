@@ -0,0 +1,205 @@
+"""
+Clusters of the places for the map tiles, in the usual `z/x/y` web mercator
+scheme.
+
+Every tile is split into a grid of `2**CELL_ZOOM` by `2**CELL_ZOOM` cells and
+the places of a cell make one cluster with its count, centroid and the slug
+of the place nearest to the centroid.
+The tiles are stored in `TILES_COLLECTION`. `build_pyramid` computes the
+tiles up to `PYRAMID_ZOOM` in a single pass over the places, the deeper tiles
+are built on request and stored only if they have places and are no deeper
+than `STORED_ZOOM`, so the requests can't grow the collection without limit.
+The other tiles are cached only by the LRU of the API workers. When a place
+changes in a way the clusters show - its geometry, visibility or slug - or is
+deleted, `invalidate_tiles` removes the tiles of its old and new points and
+these are built again when next requested.
+"""
+import math
+
+from bhs_api.geo import Box, get_box_filter
+from bhs_api.item import VISIBLE_FILTER
+
+TILES_COLLECTION = 'geo_tiles'
+PYRAMID_ZOOM = 10
+MAX_ZOOM = 18
+# the deepest zoom of the tiles stored when built on request
+STORED_ZOOM = 14
+CELL_ZOOM = 3
+# the latitude limits of the web mercator projection
+MAX_MERCATOR_LAT = 85.0511287798
+PLACE_FIELDS = {'Slug': True, 'geometry': True}
+INSERT_BATCH_SIZE = 1000
+# the fields of a place the stored clusters depend on
+TILE_FIELDS = ('geometry', 'visible', 'Slug')
+
+
+def get_tile_id(z, x, y):
+    return '{}/{}/{}'.format(z, x, y)
+
+
+def get_cell(lng, lat, zoom):
+    ''' returns the x, y of the tile at `zoom` that contains the point '''
+    n = 2 ** zoom
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    lat_rad = math.radians(lat)
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad))
+             / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def get_tile_box(z, x, y):
+    n = 2 ** z
+    # the points beyond the projection are clamped into the edge tiles
+    ne_lat = 90.0 if y == 0 else _get_tile_lat(y, n)
+    sw_lat = -90.0 if y == n - 1 else _get_tile_lat(y + 1, n)
+    return Box(sw_lat, x * 360.0 / n - 180, ne_lat, (x + 1) * 360.0 / n - 180)
+
+
+def _get_tile_lat(y, n):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2.0 * y / n))))
+
+
+def validate_tile(z, x, y):
+    if not 0 <= z <= MAX_ZOOM:
+        raise ValueError('zoom must be between 0 and {}'.format(MAX_ZOOM))
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError('tile {} does not exist'.format(get_tile_id(z, x, y)))
+
+
+def _get_point(place):
+    geometry = place.get('geometry')
+    if not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+        return None
+    return geometry['coordinates'][:2]
+
+
+def _get_places_filter():
+    filters = VISIBLE_FILTER.copy()
+    filters['geometry'] = {'$exists': True}
+    filters['Header.En'] = {'$nin': [None, '']}
+    return filters
+
+
+def _make_clusters(cells):
+    ''' gets a dict of cell to a list of (lng, lat, slug) and returns the
+        clusters, sorted by their cell
+    '''
+    clusters = []
+    for cell in sorted(cells):
+        places = cells[cell]
+        lng = sum(p[0] for p in places) / float(len(places))
+        lat = sum(p[1] for p in places) / float(len(places))
+        nearest = min(places,
+                      key=lambda p: (p[0] - lng) ** 2 + (p[1] - lat) ** 2)
+        clusters.append({'count': len(places),
+                         'centroid': [lng, lat],
+                         'slug': nearest[2]})
+    return clusters
+
+
+def build_pyramid(db):
+    ''' builds all the tiles up to `PYRAMID_ZOOM` and replaces the stored
+        tiles with them. returns the number of tiles.
+    '''
+    # zoom -> tile -> cell -> places
+    tiles = [{} for z in range(PYRAMID_ZOOM + 1)]
+    for place in db['places'].find(_get_places_filter(), PLACE_FIELDS):
+        point = _get_point(place)
+        if not point:
+            continue
+        lng, lat = point
+        entry = (lng, lat, place.get('Slug'))
+        for z in range(PYRAMID_ZOOM + 1):
+            cell = get_cell(lng, lat, z + CELL_ZOOM)
+            tile = (cell[0] >> CELL_ZOOM, cell[1] >> CELL_ZOOM)
+            tiles[z].setdefault(tile, {}).setdefault(cell, []).append(entry)
+
+    # build in a side collection so readers never see a partial pyramid
+    new_collection = db[TILES_COLLECTION + '_new']
+    new_collection.drop()
+    count = 0
+    batch = []
+    for z, zoom_tiles in enumerate(tiles):
+        for (x, y), cells in zoom_tiles.iteritems():
+            batch.append(_make_tile(z, x, y, cells))
+            if len(batch) == INSERT_BATCH_SIZE:
+                new_collection.insert_many(batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        new_collection.insert_many(batch)
+        count += len(batch)
+    if count:
+        new_collection.rename(TILES_COLLECTION, dropTarget=True)
+    else:
+        db[TILES_COLLECTION].drop()
+    return count
+
+
+def _make_tile(z, x, y, cells):
+    return {'_id': get_tile_id(z, x, y),
+            'clusters': _make_clusters(cells)}
+
+
+def build_tile(db, z, x, y):
+    ''' builds a single tile from the places in it, stores it if it has
+        places and is no deeper than `STORED_ZOOM`
+    '''
+    filters = get_box_filter(get_tile_box(z, x, y))
+    filters.update(_get_places_filter())
+    cells = {}
+    for place in db['places'].find(filters, PLACE_FIELDS):
+        point = _get_point(place)
+        if not point:
+            continue
+        lng, lat = point
+        cell = get_cell(lng, lat, z + CELL_ZOOM)
+        # the box query is padded, skip the places of the neighbour tiles
+        if (cell[0] >> CELL_ZOOM, cell[1] >> CELL_ZOOM) != (x, y):
+            continue
+        cells.setdefault(cell, []).append((lng, lat, place.get('Slug')))
+    tile = _make_tile(z, x, y, cells)
+    if cells and z <= STORED_ZOOM:
+        db[TILES_COLLECTION].replace_one({'_id': tile['_id']}, tile, upsert=True)
+    return tile
+
+
+def get_tile(db, z, x, y):
+    ''' returns the clusters of a tile, raises ValueError for a bad tile '''
+    validate_tile(z, x, y)
+    tile = db[TILES_COLLECTION].find_one({'_id': get_tile_id(z, x, y)})
+    if not tile:
+        tile = build_tile(db, z, x, y)
+    return tile['clusters']
+
+
+def get_changed_geometries(old, new):
+    ''' returns the geometries whose tiles must be rebuilt when a place
+        changes from `old` to `new`, either is None for a created or a
+        deleted place
+    '''
+    old = old or {}
+    new = new or {}
+    if all(old.get(field) == new.get(field) for field in TILE_FIELDS):
+        return []
+    return [geometry for geometry in (old.get('geometry'), new.get('geometry'))
+            if geometry]
+
+
+def invalidate_tiles(db, geometries):
+    ''' removes the stored tiles that contain any of the `geometries`.
+        this runs in the migration, not in the API workers, so the tiles
+        they have in their `tile_cache` LRU are rebuilt only when it expires,
+        up to `CACHING_TTL` later.
+    '''
+    tile_ids = set()
+    for geometry in geometries:
+        point = _get_point({'geometry': geometry})
+        if not point:
+            continue
+        for z in range(MAX_ZOOM + 1):
+            x, y = get_cell(point[0], point[1], z)
+            tile_ids.add(get_tile_id(z, x, y))
+    if tile_ids:
+        db[TILES_COLLECTION].delete_many({'_id': {'$in': list(tile_ids)}})
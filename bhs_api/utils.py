@@ -20,6 +20,12 @@ from bson.json_util import dumps
 from bson.binary import Binary, BINARY_SUBTYPE
 from werkzeug import Response
 
+THUMBNAIL_SIZE = (260, 260)
+# the modes a jpeg can be saved in
+JPEG_MODES = ('RGB', 'L', 'CMYK')
+# what PIL raises for a file it can't read
+THUMBNAIL_ERRORS = (IOError, ValueError, SyntaxError)
+
 DEFAULT_CONF_FILE = '/etc/bhs/app_server.yaml'
 DEFAULT_ENV_CONF_FILE = "/etc/bhs/app_server.yaml.{BH_ENV}"  # BH_ENV will be repalaced with the environment (dev|prd)
 
@@ -315,8 +321,8 @@ def collection_to_csv(coll, f):
         the file includes the URL of the hebrew page, its title,
         the url of the english page and its title.
     '''
-    from bhs_api.item import SHOW_FILTER
-    for i in coll.find(SHOW_FILTER):
+    from bhs_api.item import VISIBLE_FILTER
+    for i in coll.find(VISIBLE_FILTER):
         url = slugs_to_urls(i['Slug'])
         try:
             line = ','.join([url['He'], i['Header']['He'].replace(',','|')])
@@ -329,19 +335,24 @@ def collection_to_csv(coll, f):
         line += '\n'
         f.write(line.encode('utf8'))
 
-def binarize_image(image):
+def make_thumbnail(image):
+    ''' returns a jpeg thumbnail of an image file or path '''
     from PIL import Image
 
-    binary = None
+    im = Image.open(image)
+    # a jpeg is decoded at the smallest scale that's larger than the thumbnail
+    im.draft('RGB', THUMBNAIL_SIZE)
+    im.thumbnail(THUMBNAIL_SIZE)
+    if im.mode not in JPEG_MODES:
+        im = im.convert('RGB')
+    thumbnail = StringIO()
+    im.save(thumbnail, 'JPEG')
+    return thumbnail.getvalue()
 
+def binarize_image(image):
     try:
-        im = Image.open(image)
-        thumb = im.copy()
-        thumb.thumbnail((260, 260))
-        image_buffer = StringIO()
-        thumb.save(image_buffer, "JPEG")
-        binary = Binary(image_buffer.getvalue(), BINARY_SUBTYPE)
-    except IOError as e:
+        return Binary(make_thumbnail(image), BINARY_SUBTYPE)
+    except THUMBNAIL_ERRORS as e:
         logging.error("failed to binarize image: "+str(e))
         return None
 
@@ -352,22 +363,6 @@ def binarize_image(image):
         except AttributeError:
             pass
 
-    return binary
-
-
-def create_thumb(image_doc, photo_mount_path):
-    filename = image_doc['PicturePath']
-    if filename:
-        # try:
-        filename = filename.replace(u'\\', '/')
-        image_path = photo_mount_path + '/' + filename 
-        binary = binarize_image(image_path)
-    else:
-        binary = None
-        print '%s: has no file name' % image_doc['PictureId']
-
-    return binary
-
 
 def get_unit_type(collection_identifier):
     """
@@ -27,8 +27,12 @@ from bhs_api.utils import (get_conf, gen_missing_keys_error, binarize_image,
                            upload_file, send_gmail, humanify, SEARCHABLE_COLLECTIONS)
 from bhs_api.user import collect_editors_items
 from bhs_api.item import (fetch_items, search_by_header, get_image_url,
-                          enrich_item, SHOW_FILTER)
+                          enrich_items)
 from bhs_api.fsearch import fsearch
+from bhs_api.cache import LRU
+from bhs_api.suggest import get_cached_completion
+from bhs_api.geo import Box, find_places_in_box, PLACES_LIMIT
+from bhs_api.tiles import get_tile
 from bhs_api.user import get_user
 
 from bhs_api import phonetic
@@ -36,6 +40,9 @@ from bhs_api.persons import (PERSONS_SEARCH_DEFAULT_PARAMETERS, PERSONS_SEARCH_R
                              PERSONS_SEARCH_YEAR_PARAMS, PERSONS_SEARCH_TEXT_PARAMS, PERSONS_SEARCH_EXACT_PARAMS)
 
 v1_endpoints = Blueprint('v1', __name__)
+# similar strings by (collection, string)
+phonetic_cache = LRU(1000)
+tile_cache = LRU(5000)
 
 def get_activation_link(user_id):
     s = URLSafeSerializer(current_app.secret_key)
@@ -243,53 +250,13 @@ def _validate_filetype(file_info_str):
 
     return False
 
-def get_completion_all_collections(string, size=7):
-    text_completion_result = {}
-    phonetic_result = {}
-    for collection in SEARCHABLE_COLLECTIONS:
-        text_completion_result[collection], phonetic_result[collection] = get_completion(collection, string, size)
-    return text_completion_result, phonetic_result
-
-def get_completion(collection, string, size=7):
-    '''Search in the elastic search index for completion options.
-    Returns tuple of (text_completion_results, phonetic_results)
-    Where each array contains up to `size` results.
-    '''
-    # currently we only do a simple starts with search, without contains or phonetics
-    # TODO: fix phonetics search, some work was done for that
-    # see https://github.com/Beit-Hatfutsot/dbs-back/blob/2e79c363e40472f28fd07f8a344fe55ab77198ee/bhs_api/v1_endpoints.py#L189
-    lang = "He" if phonetic.is_hebrew(string) else "En"
-    q = {
-        "_source": ["Slug", "Header"],
-        "suggest": {
-            "header" : {
-                "prefix": string,
-                "completion": {
-                    "field": "Header.{}.suggest".format(lang),
-                    "size": size,
-                    "contexts": {
-                        "collection": collection,
-                    }
-                }
-            },
-        }
-    }
-    q["suggest"]["header"]["completion"]["contexts"] = {"collection": collection}
-    results = current_app.es.search(index=current_app.es_data_db_index_name, body=q, size=0)
-    try:
-        header_options = results['suggest']['header'][0]['options']
-    except KeyError:
-        header_options = []
-    try:
-        phonetic_options = results['suggest']['phonetic'][0]['options']
-    except KeyError:
-        phonetic_options = []
-    return  [i['_source']['Header'][lang] for i in header_options], [i['_source']['Header'][lang] for i in phonetic_options]
-
-
 def get_phonetic(collection, string, limit=5):
-    collection = current_app.data_db[collection]
-    retval = phonetic.get_similar_strings(string, collection)
+    key = (collection, string)
+    retval = phonetic_cache.get(key)
+    if retval is None:
+        retval = phonetic.get_similar_strings(string,
+                                              current_app.data_db[collection])
+        phonetic_cache.set(key, retval, current_app.config['CACHING_TTL'])
     return retval[:limit]
 
 
@@ -449,8 +416,11 @@ def general_search():
             rv = es_search(**parameters)
         except Exception as e:
             return humanify({"error": e.message}, 500)
-        for item in rv['hits']['hits']:
-            enrich_item(item['_source'], collection_name=item['_type'])
+        started = datetime.now()
+        hits = rv['hits']['hits']
+        enrich_items([(hit['_source'], hit['_type']) for hit in hits])
+        current_app.logger.info('enriching {} search results took {}'
+                                .format(len(hits), datetime.now() - started))
         return humanify(rv)
     else:
         return humanify({"error": "You must specify a search query"}, 400)
@@ -511,22 +481,25 @@ def get_suggestions(collection,string):
     This view returns a json with 3 fields:
     "complete", "starts_with", "phonetic".
     Each field holds a list of up to 5 strings.
+    The "took" field holds elasticsearch's query time in ms, 0 when the
+    suggestions were cached.
     '''
     rv = {}
     try:
         unlistify_item = lambda i: " ".join(i) if isinstance(i, (tuple, list)) else i
         if collection == "*":
-            rv['starts_with'], rv['phonetic'] = get_completion_all_collections(string)
+            rv['starts_with'], rv['phonetic'], took = get_cached_completion(collection, string)
             rv['contains'] = {}
             # make all the words in the suggestion start with a capital letter
             rv = {k: {kk: [unlistify_item(i).title() for i in vv] for kk, vv in v.items()} for k, v in rv.items()}
-            return humanify(rv)
         else:
-            rv['starts_with'], rv['phonetic'] = get_completion(collection, string)
+            rv['starts_with'], rv['phonetic'], took = get_cached_completion(collection, string)
             rv['contains'] = []
             # make all the words in the suggestion start with a capital letter
             rv = {k: [unlistify_item(i).title() for i in v] for k, v in rv.items()}
-            return humanify(rv)
+        # elasticsearch's time in ms, to track the keystrokes latency
+        rv['took'] = took
+        return humanify(rv)
     except Exception, e:
         return humanify({"error": "unexpected exception getting completion data: {}".format(e), "traceback": traceback.format_exc()}, 500)
 
@@ -664,19 +637,50 @@ def get_story(hash):
 
 @v1_endpoints.route('/geo/places')
 def get_geocoded_places():
+    '''
+    Returns the places in a box, up to `limit` places sorted by id. When
+    there are more places the response has a `Link` header with the url of
+    the next page, which uses the `after` continuation token.
+    '''
     args = request.args
-    filters = SHOW_FILTER.copy()
-    filters['geometry'] = {'$exists': True}
-    filters['Header.En'] = {'$nin' : [None, '']}
     try:
-        filters['geometry.coordinates.1'] = {'$gte': float(args['sw_lat']), '$lte': float(args['ne_lat'])}
-        filters['geometry.coordinates.0'] = {'$gte': float(args['sw_lng']), '$lte': float(args['ne_lng'])}
+        box = Box(float(args['sw_lat']), float(args['sw_lng']),
+                  float(args['ne_lat']), float(args['ne_lng']))
     except KeyError:
         abort(400, 'Please specify a box using sw_lat, sw_lng, ne_lat, ne_lng')
     except ValueError:
         abort(400, 'Please specify a box using floats in sw_lat, sw_lng, ne_lat, ne_lng')
-    points = current_app.data_db['places'].find(filters, {'Header': True,
-        'Slug': True, 'geometry': True, 'PlaceTypeDesc': True})
-    ret = humanify(list(points))
+    try:
+        limit = max(min(int(args.get('limit', PLACES_LIMIT)), PLACES_LIMIT), 1)
+    except ValueError:
+        abort(400, 'limit must be an integer')
+    try:
+        points, next_token = find_places_in_box(current_app.data_db, box,
+                                                args.get('after'), limit)
+    except ValueError as e:
+        abort(400, str(e))
+    ret = humanify(points)
+    if next_token:
+        next_args = args.to_dict()
+        next_args['after'] = next_token
+        ret.headers['Link'] = '<{}>; rel="next"'.format(
+            url_for('.get_geocoded_places', _external=True, **next_args))
     return ret
 
+
+@v1_endpoints.route('/geo/tiles/<int:z>/<int:x>/<int:y>')
+def get_geo_tile(z, x, y):
+    '''
+    Returns the clusters of places in a map tile, each with its `count`,
+    `centroid` as [lng, lat] and the `slug` of a representative place.
+    '''
+    key = (z, x, y)
+    clusters = tile_cache.get(key)
+    if clusters is None:
+        try:
+            clusters = get_tile(current_app.data_db, z, x, y)
+        except ValueError as e:
+            abort(400, str(e))
+        tile_cache.set(key, clusters, current_app.config['CACHING_TTL'])
+    return humanify(clusters)
+
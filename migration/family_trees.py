@@ -1,6 +1,7 @@
 import os
 import logging
 import collections
+from copy import deepcopy
 from datetime import datetime
 import StringIO
 from gedcom import Gedcom, GedcomParseError
@@ -28,12 +29,17 @@ def add_children(elem, prefix, props):
 
 class Gedcom2Persons:
 
-    def __init__(self, gedcom, tree_num, file_id, onsave, dryrun=False):
-        ''' main import function, receieve a parsed gedcom '''
+    def __init__(self, gedcom, tree_num, file_id, onsave, dryrun=False,
+                 tree_version=None):
+        ''' main import function, receieve a parsed gedcom.
+            `tree_version` is the version the persons are saved with, when
+            it's None the workers look it up for every person.
+        '''
 
         self.gedcom = gedcom
         self.tree_num = tree_num
         self.file_id = file_id
+        self.tree_version = tree_version
         self.onsave = onsave
         self.dryrun=dryrun
 
@@ -77,7 +83,8 @@ class Gedcom2Persons:
                     persons = count,
                     file_id = file_id,
                     )
-        update_tree.delay(self.meta)
+        if not dryrun:
+            update_tree.delay(self.meta)
         self.add_nodes()
 
     def save(self, data, name):
@@ -89,6 +96,8 @@ class Gedcom2Persons:
         data['tree_num'] = self.meta['num']
         data['tree_size'] = self.meta['persons']
         data['tree_file_id'] = self.meta['file_id']
+        if self.tree_version is not None:
+            data['tree_version'] = self.tree_version
         self.onsave(data)
 
     def flatten(self, node_or_nodes, full=False):
@@ -113,43 +122,92 @@ class Gedcom2Persons:
             ret.append(node)
         return ret if isinstance(node_or_nodes, collections.Iterable) else ret[0]
 
+    def build_maps(self):
+        ''' a single pass over the gedcom that builds the relatives of every
+            individual, keyed by pointer. the families are walked once, no
+            matter how many persons refer to them.
+        '''
+        self.nodes = {}
+        self.parents = {}
+        self.siblings = {}
+        self.spouse_families = {}
+        family_spouses = {}
+        family_children = {}
+        for ptr, e in self.gedcom.as_dict.items():
+            if not e.is_individual:
+                continue
+            self.parents[ptr] = self.gedcom.get_parents(e)
+            siblings = []
+            for family in self.gedcom.families(e, "FAMC"):
+                if family.pointer not in family_children:
+                    family_children[family.pointer] = \
+                        self.gedcom.get_family_members(family, "CHIL")
+                siblings.extend(family_children[family.pointer])
+            self.siblings[ptr] = siblings
+            spouse_families = []
+            for family in self.gedcom.families(e, "FAMS"):
+                if family.pointer not in family_spouses:
+                    family_spouses[family.pointer] = \
+                        self.get_family_relatives(family)
+                spouse_families.append(family_spouses[family.pointer])
+            self.spouse_families[ptr] = spouse_families
+
+    def get_family_relatives(self, family):
+        ''' returns the spouses and the kids of a family '''
+        spouses = []
+        kids = []
+        for i in family.children:
+            if i.tag in ("HUSB", "WIFE"):
+                relatives, kind = spouses, "partner"
+            elif i.tag == "CHIL":
+                relatives, kind = kids, "kid"
+            else:
+                continue
+            try:
+                relatives.append(self.gedcom.as_dict[i.value])
+            except KeyError:
+                logging.error("missing {} {} in tree {}".
+                              format(kind, i.value, self.tree_num))
+        return spouses, kids
+
+    def flatten_relative(self, e):
+        ''' returns a deep copy of the memoized flat node of a relative, the
+            docs share no lists with each other
+        '''
+        try:
+            node = self.nodes[e.pointer]
+        except KeyError:
+            node = self.nodes[e.pointer] = self.flatten(e)
+        return deepcopy(node)
+
     def find_partners(self, node, depth=0, exclude_ids=None):
         ret = []
         if not node.is_individual:
             return ret
 
         if exclude_ids:
-            eids = exclude_ids + [node.pointer]
+            eids = exclude_ids | set([node.pointer])
         else:
-            eids = [node.pointer]
+            eids = set([node.pointer])
 
-        for f in self.gedcom.families(node, "FAMS"):
+        for spouses, kids in self.spouse_families[node.pointer]:
             partner = None
-            kids = []
-            for i in f.children:
-                if i.value in eids:
-                    continue
-                if i.tag in ("HUSB", "WIFE"):
-                    try:
-                        partner = self.flatten(self.gedcom.as_dict[i.value])
-                    except KeyError:
-                        logging.error("missing partner {} in tree {}".
-                                      format(i.value, self.tree_num))
-                elif i.tag == "CHIL":
-                    try:
-                        kids.append(self.gedcom.as_dict[i.value])
-                    except KeyError:
-                        logging.error("missing kid {} in tree {}".
-                                      format(i.value, self.tree_num))
-            if not partner:
+            for e in spouses:
+                if e.pointer not in eids:
+                    partner = e
+            if partner:
+                partner = self.flatten_relative(partner)
+            else:
                 partner = {'name': [u"\u263A"]}
             partner["children"] = []
             if depth > 0:
                 for e in kids:
-                    kid = self.flatten(e)
+                    if e.pointer in eids:
+                        continue
+                    kid = self.flatten_relative(e)
                     if depth > 1:
                         kid["partners"] = self.find_partners(e, depth - 1,
-                                                            eids)
+                                                             eids)
                     partner["children"].append(kid)
             ret.append(partner)
         return ret
@@ -157,25 +215,22 @@ class Gedcom2Persons:
 
     def find_siblings(self, ptr, e):
         found = []
-        siblings_ids = []
-        for family in self.gedcom.families(e, "FAMC"):
-            for sibling in \
-                    self.gedcom.get_family_members(family, "CHIL"):
-                siblings_ids.append(sibling.pointer)
-                if sibling.pointer != ptr:
-                    found.append(self.flatten(sibling))
+        siblings_ids = set()
+        for sibling in self.siblings[ptr]:
+            siblings_ids.add(sibling.pointer)
+            if sibling.pointer != ptr:
+                found.append(self.flatten_relative(sibling))
         return found, siblings_ids
 
     def find_parents(self, e, siblings_ids):
         ''' gather the parents and their parents '''
         found = []
-        parents = self.gedcom.get_parents(e)
-        for i in parents:
+        for i in self.parents[e.pointer]:
             if not i.is_individual:
                 continue
-            parent = self.flatten(i)
-            grandparents = self.gedcom.get_parents(i)
-            parent["parents"] = self.flatten(grandparents)
+            parent = self.flatten_relative(i)
+            parent["parents"] = [self.flatten_relative(j)
+                                 for j in self.parents[i.pointer]]
             parent["partners"] = self.find_partners(i, depth=1,
                                             exclude_ids=siblings_ids)
             found.append(parent)
@@ -183,9 +238,10 @@ class Gedcom2Persons:
 
     def add_nodes(self):
         '''Add the self.gedcom nodes to the graph, extracting children data'''
+        self.build_maps()
         for ptr, e in self.gedcom.as_dict.items():
-            node = self.flatten(e, full=True)
             if e.is_individual:
+                node = self.flatten(e, full=True)
                 node["partners"] = self.find_partners(e, depth=2)
                 node["siblings"], siblings_ids = self.find_siblings(ptr, e)
                 node["parents"] = self.find_parents(e, siblings_ids)
@@ -1,95 +1,99 @@
 import os
 import logging
-import StringIO
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 
-import boto
-import gcs_oauth2_boto_plugin
-from PIL import Image
+from bhs_api.utils import make_thumbnail, THUMBNAIL_ERRORS
+from .storage import StorageError
+from .upload_manifest import get_content_hash
+
+# the number of photos uploaded at once
+UPLOAD_WORKERS = 8
 
 def get_basename(full_path):
     return full_path.split('/')[-1]
 
-def upload_file(file_path, bucket, new_filename=None, thumb_bucket=None, dryrun=False):
+def get_photo_path(doc, mount_point):
+    ''' returns the path of the file of a photo doc, or None '''
+    path = doc['PicturePath']
+    if path:
+        return os.path.join(mount_point, path.replace('\\', '/'))
+
+
+def get_photo_name(doc, path):
+    ''' returns the name of the object of a photo doc '''
+    name = doc['PictureId']
+    if name and doc['PictureFileName']:
+        name = name + '.' + path.split('.')[-1].lower()
+    return name or get_basename(path)
+
+
+class PhotoUploader(object):
     '''
-    Upload the file object to a bucket.
-    Add the original file path to its object metadata.
+    Uploads the photos and their thumbnails in a pool of threads.
+    The objects the manifest has with the same content are skipped.
     '''
-    if not new_filename:
-        fn = get_basename(file_path)
-    else:
-        fn = new_filename
 
-    dest_uri = boto.storage_uri(bucket + '/' + fn, 'gs')
+    def __init__(self, photos, thumbs, mount_point, thumbnails=None,
+                 manifest=None, workers=UPLOAD_WORKERS, dryrun=False):
+        self.photos = photos
+        self.thumbs = thumbs
+        self.mount_point = mount_point
+        self.thumbnails = thumbnails
+        self.manifest = manifest
+        self.workers = workers
+        self.dryrun = dryrun
 
-    if dryrun:
-        logging.info("create new key for dest_url={}".format(dest_uri))
-    else:
+    def upload(self, docs):
+        ''' uploads the photos of `docs`, returns the counts of the results '''
+        counts = Counter()
+        pool = ThreadPool(self.workers)
         try:
-            new_key = dest_uri.new_key()
-        except boto.exception.NoAuthHandlerFound as e:
-            logging.error(e)
-            return None
-
-    try:
-        file_obj = open(file_path)
-    except IOError as e:
-        logging.error(e)
-        return None
+            for result in pool.imap_unordered(self.upload_photo, docs):
+                counts[result] += 1
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        logging.info('uploaded {} photos, {} unchanged, {} failed'.format(
+            counts['uploaded'], counts['unchanged'], counts['failed']))
+        return counts
 
-    if dryrun:
-        logging.info("update_metadata file_path=".format(file_path))
-    else:
-        new_key.update_metadata({'path': file_path})
+    def upload_photo(self, doc):
+        ''' returns "uploaded", "unchanged" or "failed" '''
+        path = get_photo_path(doc, self.mount_point)
+        if not path:
+            logging.error('{}: has no file name'.format(doc['PictureId']))
+            return 'failed'
+        name = get_photo_name(doc, path)
         try:
-            new_key.set_contents_from_file(file_obj)
-            new_key.make_public()
-        except boto.exception.GSResponseError as e:
+            with open(path, 'rb') as f:
+                uploaded = self._upload(self.photos, name, f, {'path': path})
+                if self.thumbnails:
+                    thumbnail = self.thumbnails.get(path)
+                else:
+                    f.seek(0)
+                    thumbnail = make_thumbnail(f)
+            if thumbnail:
+                uploaded |= self._upload(self.thumbs, name, StringIO(thumbnail))
+        except THUMBNAIL_ERRORS + (StorageError,) as e:
             logging.error(e)
-            # Do we have the credentials file set up?
-            boto_cred_file = os.path.expanduser('~') + '/.boto'
-            if not os.path.exists(boto_cred_file):
-                logging.error('Credentials file {} was not found.'.format(boto_cred_file))
-
-            return None
-
-    if thumb_bucket:
-        file_obj.seek(0)
-        im = Image.open(file_obj)
-        im.thumbnail((260, 260))
-        thumbnail = StringIO.StringIO()
-        im.save(thumbnail, 'JPEG')
-        thumb_uri = boto.storage_uri('{}/{}'.format(thumb_bucket, fn),
-                                     'gs')
-        if dryrun:
-            logging.info("create new thumb_uri and make it public {}".format(thumb_uri))
-        else:
-            new_key = thumb_uri.new_key()
-            # save the thumbnail
-            thumbnail.seek(0)
-            new_key.set_contents_from_file(thumbnail)
-            new_key.make_public()
-
-    file_obj.close()
-    return str(dest_uri)
-
-
-def upload_photo(doc, conf, dryrun=False):
-    ''' upload a photo to google storage bucket '''
-    bucket_name = getattr(conf, 'photos_bucket_name')
-    mount_point = getattr(conf, 'photos_mount_point')
-    uuid = doc['PictureId']
-    filename = doc['PictureFileName']
-    path = doc['PicturePath']
-    if path and uuid and filename:
-        path = path.replace('\\', '/')
-        extension = path.split('.')[-1].lower()
-        uuid = uuid + '.' + extension
-    result = upload_file(os.path.join(mount_point, path),
-                         bucket_name,
-                         uuid,
-                         conf.thumbnails_bucket_name,
-                         dryrun=dryrun)
-    if result:
-        logging.info('Uploaded file result - ' + result)
-
+            return 'failed'
+        return 'uploaded' if uploaded else 'unchanged'
 
+    def _upload(self, storage, name, fd, metadata=None):
+        ''' returns False if the object has the same content '''
+        content_hash, size = get_content_hash(fd)
+        if self.manifest and self.manifest.is_uploaded(storage.name, name,
+                                                       content_hash, size):
+            return False
+        if self.dryrun:
+            logging.info('upload {}'.format(storage.uri(name)))
+            return True
+        storage.upload(name, fd, metadata)
+        if self.manifest:
+            self.manifest.add(storage.name, name, content_hash, size)
+        return True
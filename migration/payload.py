@@ -0,0 +1,44 @@
+"""
+Compact payloads for the migration tasks.
+
+The chunks of docs are sent to the workers in one of the `PAYLOAD_FORMATS`:
+
+- `pickle` - the celery default, the pickled docs in the message.
+- `zlib` - the same, compressed by kombu. the workers decompress it
+  transparently.
+- `staged` - the docs are written compressed to a file in a staging
+  directory shared with the workers and the message carries only its path.
+"""
+import os
+import uuid
+import zlib
+import cPickle
+
+PAYLOAD_FORMATS = ('pickle', 'zlib', 'staged')
+DEFAULT_FORMAT = 'zlib'
+COMPRESSION_LEVEL = 6
+
+
+def encode_docs(docs):
+    return zlib.compress(cPickle.dumps(docs, cPickle.HIGHEST_PROTOCOL),
+                         COMPRESSION_LEVEL)
+
+
+def decode_docs(data):
+    return cPickle.loads(zlib.decompress(data))
+
+
+def stage_docs(docs, staging_dir):
+    ''' writes the docs to a new file in `staging_dir`, returns its path '''
+    path = os.path.join(staging_dir, '{}.chunk'.format(uuid.uuid4().hex))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encode_docs(docs))
+    # the workers never see a partial file
+    os.rename(tmp_path, path)
+    return path
+
+
+def load_staged_docs(path):
+    with open(path, 'rb') as f:
+        return decode_docs(f.read())
@@ -0,0 +1,125 @@
+"""
+The buckets the media files are kept in.
+
+`GSStorage` is a bucket of google storage and `LocalStorage` a directory
+that stands for one in tests and local runs. `get_storage` picks one by
+its name - a `file://` url is a local directory, anything else a bucket
+name. Both have a `name`, `upload(name, fd, metadata=None)`,
+`download(name, fd)`, `uri(name)` and `list()`, which yields the names of
+their objects in sorted order, one page at a time.
+"""
+import os
+import uuid
+import shutil
+import logging
+
+import boto
+import gcs_oauth2_boto_plugin
+
+LOCAL_PREFIX = 'file://'
+
+logger = logging.getLogger('migration.storage')
+
+
+class StorageError(Exception):
+    pass
+
+
+class GSStorage(object):
+
+    def __init__(self, bucket_name):
+        self.name = bucket_name
+
+    def _get_uri(self, name):
+        return boto.storage_uri('{}/{}'.format(self.name, name), 'gs')
+
+    def upload(self, name, fd, metadata=None):
+        try:
+            key = self._get_uri(name).new_key()
+            if metadata:
+                key.update_metadata(metadata)
+            # the canned acl saves a make_public request for every object
+            key.set_contents_from_file(fd, policy='public-read')
+        except (boto.exception.GSResponseError,
+                boto.exception.NoAuthHandlerFound) as e:
+            # Do we have the credentials file set up?
+            boto_cred_file = os.path.expanduser('~') + '/.boto'
+            if not os.path.exists(boto_cred_file):
+                logger.error('Credentials file {} was not found.'.format(boto_cred_file))
+            raise StorageError('failed to upload {}: {}'.format(self.uri(name), e))
+
+    def download(self, name, fd):
+        try:
+            self._get_uri(name).get_key().get_file(fd)
+        except (boto.exception.GSResponseError,
+                boto.exception.NoAuthHandlerFound) as e:
+            raise StorageError('failed to download {}: {}'.format(self.uri(name), e))
+
+    def list(self):
+        # the bucket is listed lazily, in pages
+        for key in boto.storage_uri(self.name, 'gs').get_bucket():
+            yield key.name
+
+    def uri(self, name):
+        return 'gs://{}/{}'.format(self.name, name)
+
+
+class LocalStorage(object):
+    ''' a directory of objects, their metadata isn't kept '''
+
+    def __init__(self, directory):
+        self.name = LOCAL_PREFIX + directory
+        self.directory = directory
+
+    def _get_path(self, name):
+        return os.path.join(self.directory, *name.split('/'))
+
+    def upload(self, name, fd, metadata=None):
+        path = self._get_path(name)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(fd, f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            raise StorageError('failed to upload {}: {}'.format(self.uri(name), e))
+
+    def download(self, name, fd):
+        try:
+            with open(self._get_path(name), 'rb') as f:
+                shutil.copyfileobj(f, fd)
+        except IOError as e:
+            raise StorageError('failed to download {}: {}'.format(self.uri(name), e))
+
+    def list(self):
+        return self._list('')
+
+    def _list(self, prefix):
+        directory = os.path.join(self.directory, prefix)
+        if not os.path.isdir(directory):
+            return
+        # a directory sorts by its name and a slash, like the names in it
+        entries = []
+        for entry in os.listdir(directory):
+            if entry.endswith('.tmp'):
+                continue
+            if os.path.isdir(os.path.join(directory, entry)):
+                entry += '/'
+            entries.append(entry)
+        for entry in sorted(entries):
+            if entry.endswith('/'):
+                for name in self._list(prefix + entry):
+                    yield name
+            else:
+                yield prefix + entry
+
+    def uri(self, name):
+        return self._get_path(name)
+
+
+def get_storage(name):
+    if name.startswith(LOCAL_PREFIX):
+        return LocalStorage(name[len(LOCAL_PREFIX):])
+    return GSStorage(name)
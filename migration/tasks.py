@@ -2,27 +2,46 @@ import os
 import json
 import elasticsearch
 import pymongo
+import redis
 from celery import Celery
 from flask import current_app
 from bhs_api import create_app
 from bhs_api.utils import uuids_to_str
+from bhs_api.cache import publish_invalidation, LRU
+from bhs_api.phonetic import get_header_dms_codes
 from bhs_api.item import get_collection_id_field, create_slug, doc_show_filter, get_doc_id, update_es
-from scripts.get_places_geo import get_place_geo
+from bhs_api.tiles import invalidate_tiles, get_changed_geometries, TILE_FIELDS
+from bhs_api.geocode import geocode_place
+from bhs_api.indexer import get_indexer
+from bhs_api.suggest import clear_suggestions
+from migration.payload import load_staged_docs
 from scripts.batch_related import get_bhp_related
 
 
 MIGRATE_MODE = os.environ.get('MIGRATE_MODE')
 MIGRATE_ES = os.environ.get('MIGRATE_ES', '1')
 MIGRATE_RELATED = os.environ.get('MIGRATE_RELATED', True)
+VISIBLE_INDICES = [[('visible', pymongo.ASCENDING), ('Header.En', pymongo.ASCENDING)],
+                   [('visible', pymongo.ASCENDING), ('Header.He', pymongo.ASCENDING)]]
+DMS_INDICES = ['dms_codes.En', 'dms_codes.He']
+DUPLICATE_KEY_ERROR = 11000
+TREE_VERSIONS_TTL = 300
+# a staged chunk that failed is retried every few minutes before giving up
+STAGED_RETRIES = 5
+STAGED_RETRY_DELAY = 180
+# the tree versions a worker used lately, saves a redis request per person
+tree_versions_cache = LRU(1000)
 INDICES = {
-    'places' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He'],
-    'familyNames' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He'],
-    'lexicon' : ['UnitId'],
-    'photoUnits' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He'],
+    'places' : ['UnitId', 'Header.En', 'Header.He', [('geometry', pymongo.GEOSPHERE)]] + VISIBLE_INDICES + DMS_INDICES,
+    'familyNames' : ['UnitId', 'Header.En', 'Header.He'] + VISIBLE_INDICES + DMS_INDICES,
+    'lexicon' : ['UnitId', 'visible'],
+    'photoUnits' : ['UnitId', 'Header.En', 'Header.He'] + VISIBLE_INDICES,
     'photos' : ['PictureId', 'PictureFileName', 'PicturePath'],
-    'persons' : ['name_lc.0', 'name_lc.1', 'sex', 'BIRT_PLAC_lc', 'MARR_PLAC_lc', 'tree_num', 'DEAT_PLAC_lc'],
+    'persons' : ['name_lc.0', 'name_lc.1', 'sex', 'BIRT_PLAC_lc', 'MARR_PLAC_lc', 'tree_num', 'DEAT_PLAC_lc',
+                 [('visible', pymongo.ASCENDING), ('tree_num', pymongo.ASCENDING)], 'birth_year'],
     'synonyms': ['s_group', 'str_lc'],
-    'personalities' : ['UnitId', 'DisplayStatusDesc', 'RightsDesc', 'StatusDesc', 'Header.En', 'Header.He']
+    'personalities' : ['UnitId', 'Header.En', 'Header.He'] + VISIBLE_INDICES + DMS_INDICES,
+    'movies' : ['UnitId', 'visible', 'MovieFileId'],
 }
 
 def make_celery():
@@ -49,12 +68,32 @@ def make_celery():
         abstract = True
         def __call__(self, *args, **kwargs):
             with app.app_context():
-                return TaskBase.__call__(self, *args, **kwargs)
+                try:
+                    return TaskBase.__call__(self, *args, **kwargs)
+                finally:
+                    indexer = get_indexer(app.es)
+                    indexer.flush()
+                    invalidate_suggestions(app, indexer.pop_indexed_types())
     celery.Task = ContextTask
     return celery
 celery = make_celery()
 
 
+def invalidate_suggestions(app, collections):
+    ''' drop the cached suggestions of the collections that had docs indexed,
+        once the docs are searchable
+    '''
+    if not collections or app.redis is None:
+        return
+    try:
+        app.es.indices.refresh(index=app.es_data_db_index_name)
+        dropped = clear_suggestions(app.redis, collections)
+    except (elasticsearch.ElasticsearchException, redis.RedisError) as e:
+        app.logger.error('failed to drop the cached suggestions: {}'.format(e))
+    else:
+        app.logger.debug('dropped {} cached suggestions'.format(dropped))
+
+
 def ensure_indices(collection):
     indices = INDICES.get(collection.name, set())
     for index in indices:
@@ -122,7 +161,37 @@ def update_tree(data, db=None):
         trees.insert_one(doc)
     current_app.redis.set('tree_vers_'+str(num),
                           json.dumps(doc['versions']),
-                          300)
+                          TREE_VERSIONS_TTL)
+
+
+def get_tree_versions(tree_num):
+    ''' returns the versions of a tree, cached in the worker and in redis.
+        returns None if the tree doesn't exist.
+    '''
+    tree_vers = tree_versions_cache.get(tree_num)
+    if tree_vers is None:
+        tree_key = 'tree_vers_'+str(tree_num)
+        tree_vers = current_app.redis.get(tree_key)
+        if tree_vers:
+            tree_vers = json.loads(tree_vers)
+        else:
+            tree = current_app.data_db['trees'].find_one({'num':tree_num})
+            if not tree:
+                return None
+            tree_vers = tree['versions']
+            current_app.redis.set(tree_key, json.dumps(tree_vers), TREE_VERSIONS_TTL)
+        tree_versions_cache.set(tree_num, tree_vers, TREE_VERSIONS_TTL)
+    return tree_vers
+
+
+def get_tree_version(trees, tree_num, file_id):
+    ''' returns the version a tree file will be saved with '''
+    tree = trees.find_one({'num': tree_num}, {'versions': True})
+    tree_vers = tree['versions'] if tree else []
+    for i, ver in enumerate(tree_vers):
+        if ver['file_id'] == file_id:
+            return i
+    return len(tree_vers)
 
 
 def find_version(tree_vers, file_id):
@@ -137,75 +206,204 @@ def find_version(tree_vers, file_id):
 @celery.task
 def update_row(doc, collection_name):
     collection = celery.data_db[collection_name]
-    # from celery.contrib import rdb; rdb.set_trace()
     update_doc(collection, doc)
-    ensure_indices(collection)
+
+
+@celery.task
+def update_rows(docs, collection_name):
+    ''' a celery task to update a chunk of docs of a single collection '''
+    collection = celery.data_db[collection_name]
+    update_docs(collection, docs)
+
+
+@celery.task(bind=True, max_retries=STAGED_RETRIES,
+             default_retry_delay=STAGED_RETRY_DELAY)
+def update_staged_rows(self, path, collection_name):
+    ''' a celery task to update a chunk of docs staged by `stage_docs`.
+        a failed update is retried, the file is removed once it succeeds
+    '''
+    collection = celery.data_db[collection_name]
+    try:
+        update_docs(collection, load_staged_docs(path))
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            current_app.logger.error('failed to update the staged chunk {}, '
+                                     'the file is kept: {}'.format(path, e))
+        raise self.retry(exc=e)
+    os.remove(path)
+
+
+@celery.task
+def carry_forward_persons(tree_num, from_version, to_version, ids, fields):
+    ''' a celery task to copy the unchanged persons of a tree from a version
+        to a new one. `fields` are the version fields to set on the copies.
+    '''
+    carry_forward(celery.data_db['persons'], tree_num, from_version,
+                  to_version, ids, fields)
+
+
+def carry_forward(persons, tree_num, from_version, to_version, ids, fields):
+    docs = list(persons.find({'tree_num': tree_num,
+                              'tree_version': from_version,
+                              'id': {'$in': ids}}))
+    if not docs:
+        return
+    bulk = persons.initialize_unordered_bulk_op()
+    for doc in docs:
+        del doc['_id']
+        # the old version might be archived already
+        doc.pop('archived', None)
+        doc.update(fields)
+        doc['tree_version'] = to_version
+        doc['Slug'] = {'En': get_person_slug(tree_num, to_version, doc['id'])}
+        bulk.find({'tree_num': tree_num, 'tree_version': to_version,
+                   'id': doc['id']}).upsert().replace_one(doc)
+    try:
+        bulk.execute()
+    except pymongo.errors.BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            current_app.logger.error('failed to carry person {}.{} forward: {}'
+                                     .format(tree_num, docs[error['index']]['id'],
+                                             error['errmsg']))
+    if MIGRATE_ES == '1':
+        for doc in docs:
+            is_ok, msg = update_es(persons.name, doc, True)
+            if not is_ok:
+                current_app.logger.error(msg)
+    publish_invalidation(current_app.redis,
+                         [doc['Slug']['En'] for doc in docs])
+    current_app.logger.info('carried {} persons of tree {} forward to version {}'
+                            .format(len(docs), tree_num, to_version))
+
+
+def _prepare_doc(collection, doc):
+    # precompute the show filter so readers can query on an indexed field
+    doc['visible'] = doc_show_filter(collection.name, doc)
+    if 'UnitHeaderDMSoundex' in doc:
+        doc['dms_codes'] = get_header_dms_codes(doc['UnitHeaderDMSoundex'])
+
+    if MIGRATE_RELATED != '0':
+        doc['related'] = get_bhp_related(doc, collection.name,
+                                                max_items=6,
+                                                bhp_only=True)
+
+
+def _find_existing(collection, queries):
+    ''' returns a dict of the docs matching the queries, keyed by their
+        query values. all the queries must have the same fields.
+    '''
+    fields = sorted(queries[0])
+    projection = dict.fromkeys(fields + list(TILE_FIELDS), True)
+    existing = {}
+    for doc in collection.find({'$or': queries}, projection):
+        existing[tuple(doc.get(field) for field in fields)] = doc
+    return existing
+
 
 def update_collection(collection, query, doc):
     """ update the mongo collection.
         returns True is a new doc was created and False is an existing item
         has been updated
     """
+    return bulk_update_collection(collection, [(query, doc)])[0]
 
-    if MIGRATE_RELATED != '0':
-        doc['related'] = get_bhp_related(doc, collection.name,
-                                                max_items=6,
-                                                bhp_only=True)
 
-    if MIGRATE_MODE  == 'i':
-        doc['Slug'] = create_slug(doc, collection.name)
-        try:
-            doc['_id'] = query['_id']
-        except KeyError:
-            pass
+def bulk_update_collection(collection, items):
+    """ update the mongo collection with a list of (query, doc) tuples in a
+        single bulk operation.
+        returns a list with True for every doc that was created and False for
+        every existing item that has been updated
+    """
+    if not items:
+        return []
+    for query, doc in items:
+        _prepare_doc(collection, doc)
 
-        collection.insert(doc)
-        created = True
+    if MIGRATE_MODE == 'i':
+        existing = {}
     else:
-        r = collection.update_one(query,
-                                  {'$set': doc},
-                                  upsert=False)
-        # check if update failed and if it did, create a slug
-        if r.matched_count == 0:
-            doc['Slug'] = create_slug(doc, collection.name)
-            try:
-                doc['_id'] = query['_id']
-            except KeyError:
-                pass
-
-            created = True
-            try:
-                collection.insert(doc)
-            except pymongo.errors.DuplicateKeyError:
-                # oops - seems like we need to add the id to the slug
-                reslugify(collection, doc)
-                collection.insert(doc)
+        existing = _find_existing(collection, [query for query, doc in items])
+    fields = sorted(items[0][0])
+    keys = [tuple(query.get(field) for field in fields)
+            for query, doc in items]
+    # a doc repeated in the chunk is written once, with its latest values
+    latest = dict((key, i) for i, key in enumerate(keys))
+    bulk = collection.initialize_unordered_bulk_op()
+    created = []
+    written = []
+    slugs = []
+    geometries = []
+    for i, (query, doc) in enumerate(items):
+        old = existing.get(keys[i])
+        created.append(not old)
+        if latest[keys[i]] != i:
+            continue
+        if old:
+            # the update doesn't include the slug, it's only in the db
+            slug = old.get('Slug') if doc.get('Slug') is None else doc['Slug']
         else:
-            created = False
+            doc['Slug'] = slug = create_slug(doc, collection.name)
+            if '_id' in query:
+                doc['_id'] = query['_id']
+        slugs += (slug or {}).values()
+        if collection.name == 'places':
+            # the update $sets only some fields, the rest are kept
+            new = dict(old or {})
+            new.update(doc)
+            geometries += get_changed_geometries(old, new)
+        bulk.find(query).upsert().update_one({'$set': doc})
+        written.append((query, doc))
 
+    try:
+        bulk.execute()
+    except pymongo.errors.BulkWriteError as e:
+        _retry_write_errors(collection, written, e.details['writeErrors'])
+
+    # make sure the item pages will show the updated docs
+    publish_invalidation(current_app.redis, slugs)
+    if geometries:
+        invalidate_tiles(collection.database, geometries)
     return created
 
 
-def update_doc(collection, document):
+def _retry_write_errors(collection, written, write_errors):
+    for error in write_errors:
+        query, doc = written[error['index']]
+        if error['code'] != DUPLICATE_KEY_ERROR or not doc.get('Slug'):
+            current_app.logger.error('failed to update {} {}: {}'.format(
+                                     collection.name, query, error['errmsg']))
+            continue
+        # oops - seems like we need to add the id to the slug
+        reslugify(collection, doc)
+        try:
+            collection.update_one(query, {'$set': doc}, upsert=True)
+        except pymongo.errors.DuplicateKeyError as e:
+            current_app.logger.error('failed to update {} {}: {}'.format(
+                                     collection.name, query, e))
+
+
+def get_person_slug(tree_num, tree_version, id):
+    return 'person_{};{}.{}'.format(tree_num, tree_version, id)
+
+
+def get_doc_query(collection, document):
+    ''' prepares a document for migration and returns the query of its
+        mongo doc, or None if it has no id
+    '''
     # update place items with geojson
     if collection.name == 'places':
-        document['geometry'] = get_place_geo(document)
+        document['geometry'] = geocode_place(document)
 
     # family trees get special treatment
     if collection.name == 'persons':
         tree_num = document['tree_num']
         id = document['id']
-        tree_key = 'tree_vers_'+str(tree_num)
         query = {'tree_num': tree_num, 'id': id}
-        tree_vers = current_app.redis.get(tree_key)
-        if tree_vers:
-            tree_vers = json.loads(tree_vers)
-            i = find_version(tree_vers, document['tree_file_id'])
-        else:
-            tree = current_app.data_db['trees'].find_one({'num':tree_num})
-            if tree:
-                tree_vers = tree['versions']
-                current_app.redis.set(tree_key, json.dumps(tree_vers), 300)
+        # the version is usually resolved once per tree by the producer
+        i = document.get('tree_version')
+        if i is None:
+            tree_vers = get_tree_versions(tree_num)
+            if tree_vers:
                 i = find_version(tree_vers, document['tree_file_id'])
             else:
                 current_app.logger.info("didn't find tree number {} using version 0 for {}"
@@ -217,27 +415,36 @@ def update_doc(collection, document):
 
         # we have to create it here as at the moment create_slug function requires Header to create slug
         # TODO: move this logic to create_slug function
-        document['Slug'] = {'En': 'person_{};{}.{}'.format(
-                              tree_num,
-                              i,
-                              id)}
-        created = update_collection(collection, query, document)
-        if MIGRATE_ES == '1':
-            is_ok, msg = update_es(collection.name, document, created)
-            if not is_ok:
-                current_app.logger.error(msg)
-        current_app.logger.info('Updated person: {}.{}'
-                                .format(tree_num, id))
+        document['Slug'] = {'En': get_person_slug(tree_num, i, id)}
+        return query
     else:
         doc_id = get_doc_id(collection.name, document)
         if doc_id:
-            query = {get_collection_id_field(collection): doc_id}
-            created = update_collection(collection, query, document)
-            if MIGRATE_ES == '1':
-                is_ok, msg = update_es(collection.name, document, created)
-                if not is_ok:
-                    current_app.logger.error(msg)
-            slug = document.get("Slug", {}).get("En")
-            current_app.logger.info('Updated {} {}, Slug: {}'.format(collection.name, doc_id, slug))
+            return {get_collection_id_field(collection): doc_id}
         else:
             current_app.logger.error('update failed because of id {}'.format(collection.name))
+
+
+def update_doc(collection, document):
+    update_docs(collection, [document])
+
+
+def update_docs(collection, documents):
+    items = []
+    for document in documents:
+        query = get_doc_query(collection, document)
+        if query:
+            items.append((query, document))
+    created = bulk_update_collection(collection, items)
+    for (query, document), is_new in zip(items, created):
+        if MIGRATE_ES == '1':
+            is_ok, msg = update_es(collection.name, document, is_new)
+            if not is_ok:
+                current_app.logger.error(msg)
+        if collection.name == 'persons':
+            current_app.logger.info('Updated person: {}.{}'
+                                    .format(query['tree_num'], query['id']))
+        else:
+            slug = document.get("Slug", {}).get("En")
+            current_app.logger.info('Updated {} {}, Slug: {}'.format(
+                collection.name, query.values()[0], slug))
@@ -0,0 +1,77 @@
+"""
+Backpressure between the migration producer and the celery workers.
+
+The producer calls `QueueThrottle.sent` after every task it sends. While the
+broker queue holds `max_in_flight` tasks or more the call sleeps, so the
+broker never holds more than about `max_in_flight` tasks worth of docs.
+The queue depth and the producer and consumer rates are logged every
+`report_interval` seconds.
+"""
+import time
+import logging
+
+import redis
+
+MAX_IN_FLIGHT = 200
+POLL_INTERVAL = 1
+REPORT_INTERVAL = 30
+
+logger = logging.getLogger('migration.throttle')
+
+
+class QueueThrottle(object):
+
+    def __init__(self, redis_client, queue='celery',
+                 max_in_flight=MAX_IN_FLIGHT, poll_interval=POLL_INTERVAL,
+                 report_interval=REPORT_INTERVAL):
+        self.redis = redis_client
+        self.queue = queue
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+        self.produced = 0
+        self.waited = 0
+        self._last_report = time.time()
+        self._last_produced = 0
+        self._last_depth = 0
+
+    def get_depth(self):
+        ''' returns the number of tasks waiting in the broker, or None if
+            the broker can't be reached
+        '''
+        try:
+            return self.redis.llen(self.queue)
+        except redis.RedisError as e:
+            logger.warn('failed to get the depth of queue {}: {}'
+                        .format(self.queue, e))
+            return None
+
+    def sent(self, count=1):
+        ''' records sent tasks and waits while the queue is full '''
+        self.produced += count
+        depth = self.get_depth()
+        while depth is not None and depth >= self.max_in_flight:
+            self.report(depth)
+            time.sleep(self.poll_interval)
+            self.waited += self.poll_interval
+            depth = self.get_depth()
+        self.report(depth)
+
+    def report(self, depth=None, force=False):
+        now = time.time()
+        elapsed = now - self._last_report
+        if not force and elapsed < self.report_interval:
+            return
+        if depth is None:
+            depth = self.get_depth() or 0
+        elapsed = max(elapsed, 0.001)
+        produced = self.produced - self._last_produced
+        # whatever was produced and isn't in the queue was consumed
+        consumed = produced - (depth - self._last_depth)
+        logger.info('queue {}: {} tasks waiting, produced {:.1f} tasks/sec, '
+                    'consumed {:.1f} tasks/sec, paused for {}s so far'
+                    .format(self.queue, depth, produced / elapsed,
+                            consumed / elapsed, self.waited))
+        self._last_report = now
+        self._last_produced = self.produced
+        self._last_depth = depth
@@ -0,0 +1,146 @@
+"""
+Reconciliation of the thumbnails bucket with the photos bucket.
+
+`diff_listings` merges the sorted listings of the two buckets as they are
+streamed, without keeping either of them, and yields the photos with no
+thumbnail and the thumbnails with no photo. `ThumbnailSync` adds the missing
+thumbnails in a pool of processes, a batch at a time, and saves the last
+name it reached to a state file so an interrupted run can be resumed. The
+state file is removed when a run completes, so the next run starts over.
+"""
+import os
+import json
+import logging
+import tempfile
+from itertools import islice
+from collections import Counter
+from multiprocessing import Pool
+from StringIO import StringIO
+
+from bhs_api.utils import make_thumbnail, THUMBNAIL_ERRORS
+from .storage import StorageError
+
+MISSING = 'missing'
+ORPHAN = 'orphan'
+WORKERS = 4
+BATCH_SIZE = 100
+# larger photos are downloaded to a temporary file, not to memory
+SPOOL_SIZE = 16 << 20
+
+logger = logging.getLogger('migration.thumbnail_sync')
+
+
+def check_sorted(names):
+    previous = None
+    for name in names:
+        if previous is not None and name <= previous:
+            raise ValueError('the listing is not sorted: {!r} after {!r}'
+                             .format(name, previous))
+        previous = name
+        yield name
+
+
+def diff_listings(sources, targets):
+    ''' merges two sorted listings, yields (name, MISSING) for the names of
+        `sources` that aren't in `targets` and (name, ORPHAN) for the names
+        of `targets` that aren't in `sources`
+    '''
+    targets = check_sorted(targets)
+    target = next(targets, None)
+    for source in check_sorted(sources):
+        while target is not None and target < source:
+            yield target, ORPHAN
+            target = next(targets, None)
+        if target == source:
+            target = next(targets, None)
+        else:
+            yield source, MISSING
+    while target is not None:
+        yield target, ORPHAN
+        target = next(targets, None)
+
+
+def add_thumbnail(args):
+    ''' makes the thumbnail of a photo, returns an error or None.
+        this is the entry point of the pool workers.
+    '''
+    photos, thumbs, name = args
+    with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as photo:
+        try:
+            photos.download(name, photo)
+            photo.seek(0)
+            thumbnail = make_thumbnail(photo)
+            thumbs.upload(name, StringIO(thumbnail))
+        except THUMBNAIL_ERRORS + (StorageError,) as e:
+            return 'failed to add the thumbnail of {}: {}'.format(name, e)
+
+
+class ThumbnailSync(object):
+
+    def __init__(self, photos, thumbs, workers=WORKERS, state_path=None,
+                 batch_size=BATCH_SIZE):
+        self.photos = photos
+        self.thumbs = thumbs
+        self.workers = workers
+        self.batch_size = batch_size
+        self.state_path = state_path
+        self.last_name = self._load_state()
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            return json.load(f)['last_name']
+
+    def _save_state(self, last_name):
+        self.last_name = last_name
+        if not self.state_path:
+            return
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_name': last_name}, f)
+        os.rename(tmp_path, self.state_path)
+
+    def _clear_state(self):
+        self.last_name = None
+        if self.state_path and os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def diff(self):
+        ''' yields the differences of the buckets after the last name the
+            previous runs reached
+        '''
+        for name, kind in diff_listings(self.photos.list(), self.thumbs.list()):
+            if self.last_name is None or name > self.last_name:
+                yield name, kind
+
+    def run(self):
+        ''' adds the missing thumbnails, returns the counts of the results '''
+        counts = Counter()
+        missing = (name for name, kind in self.diff() if kind == MISSING)
+        pool = Pool(self.workers)
+        try:
+            while True:
+                batch = list(islice(missing, self.batch_size))
+                if not batch:
+                    break
+                errors = pool.map(add_thumbnail, [(self.photos, self.thumbs, name)
+                                                  for name in batch])
+                for error in errors:
+                    if error:
+                        logger.error(error)
+                        counts['failed'] += 1
+                    else:
+                        counts['added'] += 1
+                self._save_state(batch[-1])
+                logger.info('added {} thumbnails, {} failed, up to {}'.format(
+                    counts['added'], counts['failed'], batch[-1]))
+            # the buckets were reconciled to the end, nothing to resume
+            self._clear_state()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return counts
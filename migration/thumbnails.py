@@ -0,0 +1,120 @@
+"""
+The thumbnails of the photos, made once for all their consumers.
+
+The docs of the photos collection carry a thumbnail and `PhotoUploader`
+uploads one to the thumbnails bucket. Both get it from a `ThumbnailStore`,
+a directory of thumbnails keyed by the path, size and modification time of
+their photos, so a photo that didn't change since its thumbnail was made
+isn't opened again. `ThumbnailStore.prepare` makes the missing thumbnails
+of a batch of photos in a pool of processes.
+"""
+import os
+import uuid
+import hashlib
+import logging
+from multiprocessing import Pool
+
+from bhs_api.utils import make_thumbnail, THUMBNAIL_ERRORS
+
+THUMBNAILS_DIR = '/var/cache/bhs/thumbnails'
+WORKERS = 4
+
+logger = logging.getLogger('migration.thumbnails')
+
+
+def write_thumbnail(args):
+    ''' makes the thumbnail of `source` in `path`, returns an error or None.
+        this is the entry point of the pool workers.
+    '''
+    source, path = args
+    try:
+        data = make_thumbnail(source)
+    except THUMBNAIL_ERRORS as e:
+        return 'failed to make a thumbnail of {}: {}'.format(source, e)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by another worker
+            pass
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class ThumbnailStore(object):
+
+    def __init__(self, directory=THUMBNAILS_DIR, workers=WORKERS):
+        self.directory = directory
+        self.workers = workers
+        # the sources that failed in this run aren't tried again
+        self.failed = set()
+
+    def get_path(self, source):
+        ''' returns the path of the thumbnail of the current version of
+            `source`, or None if it doesn't exist
+        '''
+        source = os.path.abspath(source)
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        key = hashlib.sha1('{}\0{}\0{!r}'.format(source, stat.st_size,
+                                                 stat.st_mtime)).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.jpg')
+
+    def prepare(self, sources):
+        ''' makes the missing thumbnails of `sources` '''
+        missing = []
+        unchanged = 0
+        for source in set(sources):
+            path = self.get_path(source)
+            if not path or source in self.failed:
+                continue
+            if os.path.exists(path):
+                unchanged += 1
+            else:
+                missing.append((source, path))
+        if self.workers > 1 and len(missing) > 1:
+            pool = Pool(min(self.workers, len(missing)))
+            try:
+                errors = list(pool.imap(write_thumbnail, missing, chunksize=8))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            errors = map(write_thumbnail, missing)
+        failed = 0
+        for (source, path), error in zip(missing, errors):
+            if error:
+                logger.error(error)
+                self.failed.add(source)
+                failed += 1
+        logger.info('made {} thumbnails, {} failed, {} photos unchanged'
+                    .format(len(missing) - failed, failed, unchanged))
+
+    def get(self, source):
+        ''' returns the jpeg thumbnail of `source`, or None if it can't be
+            made
+        '''
+        path = self.get_path(source)
+        if not path:
+            logger.error('missing photo {}'.format(source))
+            return None
+        if source in self.failed:
+            return None
+        if not os.path.exists(path):
+            error = write_thumbnail((source, path))
+            if error:
+                logger.error(error)
+                self.failed.add(source)
+                return None
+        with open(path, 'rb') as f:
+            return f.read()
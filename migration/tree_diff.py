@@ -0,0 +1,70 @@
+"""
+Incremental migration of the new versions of a tree.
+
+Every person doc is saved with a `content_hash` of its gedcom data. When a
+new version of a tree is migrated, `TreeDiff` compares its persons with the
+hashes of the last migrated version. Only the added and the changed
+persons are sent to the workers, the unchanged ones are copied to the new
+version in bulk by the `carry_forward_persons` task.
+"""
+import json
+import hashlib
+import collections
+
+# fields that change with every version of the tree, not with the person
+VERSION_FIELDS = ('tree_version', 'tree_file_id', 'tree_size',
+                  'content_hash', 'Slug')
+CHANGE_KINDS = ('added', 'changed', 'unchanged', 'removed')
+
+
+def get_content_hash(data):
+    content = dict((k, v) for k, v in data.items() if k not in VERSION_FIELDS)
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=repr)) \
+                  .hexdigest()
+
+
+def get_previous_hashes(persons, tree_num, version):
+    ''' returns the last migrated version of a tree, up to `version`, and a
+        dict of the content hashes of its persons by their ids
+    '''
+    for base_version in (version, version - 1):
+        if base_version < 0:
+            break
+        docs = persons.find({'tree_num': tree_num,
+                             'tree_version': base_version},
+                            {'id': True, 'content_hash': True})
+        # the persons migrated before the hashes get None and count as changed
+        hashes = dict((doc['id'], doc.get('content_hash')) for doc in docs)
+        if hashes:
+            return base_version, hashes
+    return None, {}
+
+
+class TreeDiff(object):
+
+    def __init__(self, previous_hashes):
+        self.previous = previous_hashes
+        self.seen = set()
+        self.unchanged = []
+        self.counts = collections.Counter()
+
+    def add(self, data):
+        ''' sets the content hash of a person, returns False if the person
+            didn't change
+        '''
+        content_hash = data['content_hash'] = get_content_hash(data)
+        self.seen.add(data['id'])
+        if data['id'] not in self.previous:
+            self.counts['added'] += 1
+        elif self.previous[data['id']] != content_hash:
+            self.counts['changed'] += 1
+        else:
+            self.counts['unchanged'] += 1
+            self.unchanged.append(data['id'])
+            return False
+        return True
+
+    def get_report(self):
+        report = dict((kind, self.counts[kind]) for kind in CHANGE_KINDS)
+        report['removed'] = len(set(self.previous) - self.seen)
+        return report
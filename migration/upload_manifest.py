@@ -0,0 +1,64 @@
+"""
+A local record of the uploaded media files.
+
+`UploadManifest` keeps the content hash and the size of every object the
+migration uploaded, in an sqlite file. A file whose object already has the
+same content isn't uploaded again, so migrating the same window twice
+uploads only the photos that changed in between.
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+
+MANIFEST_PATH = '/var/cache/bhs/uploads.sqlite'
+HASH_CHUNK_SIZE = 1 << 20
+# the records are committed in batches, a crash uploads them again
+COMMIT_INTERVAL = 100
+
+
+def get_content_hash(fd):
+    ''' returns the sha1 and the size of the content of `fd` and rewinds it '''
+    digest = hashlib.sha1()
+    size = 0
+    for chunk in iter(lambda: fd.read(HASH_CHUNK_SIZE), ''):
+        digest.update(chunk)
+        size += len(chunk)
+    fd.seek(0)
+    return digest.hexdigest(), size
+
+
+class UploadManifest(object):
+    ''' the uploaded objects by their storage and name, shared by threads '''
+
+    def __init__(self, path=MANIFEST_PATH):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                        'storage TEXT, name TEXT, hash TEXT, size INTEGER, '
+                        'PRIMARY KEY (storage, name))')
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def is_uploaded(self, storage, name, content_hash, size):
+        with self.lock:
+            row = self.db.execute('SELECT hash, size FROM uploads '
+                                  'WHERE storage = ? AND name = ?',
+                                  (storage, name)).fetchone()
+        return row is not None and tuple(row) == (content_hash, size)
+
+    def add(self, storage, name, content_hash, size):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)',
+                            (storage, name, content_hash, size))
+            self.pending += 1
+            if self.pending >= COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -9,7 +9,7 @@ import elasticsearch
 from werkzeug.exceptions import NotFound, Forbidden
 
 from bhs_api import create_app
-from bhs_api.item import (SHOW_FILTER, Slug, get_item_slug,
+from bhs_api.item import (get_visible_filter, Slug, get_item_slug,
                           get_item_by_id, get_item, get_collection_name,
                           get_item_query)
 from bhs_api.utils import uuids_to_str, SEARCHABLE_COLLECTIONS
@@ -234,18 +234,23 @@ if __name__ == '__main__':
     else:
         data_db = app.data_db
 
-    query = SHOW_FILTER.copy()
+    slug_query = {}
     if args.slug:
         if args.slug[0] >= 'a' and args.slug[0] <= 'z':
-            query.update({"Slug.En": args.slug})
+            slug_query["Slug.En"] = args.slug
         else:
-            query.update({"Slug.He": args.slug})
+            slug_query["Slug.He"] = args.slug
+
+    def get_query(collection):
+        query = get_visible_filter(collection).copy()
+        query.update(slug_query)
+        return query
 
     with app.app_context():
         logger.info('Pass 1 - Collecting bhp related')
         direct_related_list = []
         for collection in collections:
-            for doc in data_db[collection].find(query,
+            for doc in data_db[collection].find(get_query(collection),
                                                 modifiers={"$snapshot": "true"}):
                 related = get_bhp_related(doc, collection,
                                           max_items=6, bhp_only=True)
@@ -291,11 +296,11 @@ if __name__ == '__main__':
         logger.info('Pass 3 - Completing related and enriching documents')
         for collection in collections:
             started = datetime.datetime.now()
-            count = data_db[collection].count(SHOW_FILTER)
+            count = data_db[collection].count(get_visible_filter(collection))
             logger.info('Starting to work on {}'.format(collection))
             logger.info('Collection {} has {} valid documents.'
                         .format(collection, count))
-            for doc in data_db[collection].find(query,
+            for doc in data_db[collection].find(get_query(collection),
                                                 modifiers={"$snapshot": "true"}):
                 slug = get_item_slug(doc)
                 if not doc.has_key('bhp_related') or not doc['bhp_related']:
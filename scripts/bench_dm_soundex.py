@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    Usage: `python scripts/bench_dm_soundex.py [--rounds N]`
+
+    Reports the words/sec of `phonetic.dm_soundex` over the words of the
+    regression corpus, with a cold and a warm cache.
+'''
+import io
+import os
+import time
+from argparse import ArgumentParser
+
+from bhs_api import phonetic
+
+CORPUS = os.path.join(os.path.dirname(__file__), os.pardir,
+                      'tests', 'dm_soundex_corpus.txt')
+
+
+def load_words():
+    with io.open(CORPUS, encoding='utf8') as f:
+        return [line.split(u'\t')[0] for line in f
+                if not line.startswith(u'#')]
+
+
+def bench(name, func, words, rounds, clear_cache):
+    elapsed = 0
+    for i in range(rounds):
+        if clear_cache:
+            phonetic._dms_cache.clear()
+        started = time.time()
+        func(words)
+        elapsed += time.time() - started
+    print("{}: {:.0f} words/sec".format(name, len(words) * rounds / elapsed))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+    words = load_words()
+    one_by_one = lambda words: [phonetic.dm_soundex(w) for w in words]
+    bench('cold dm_soundex', one_by_one, words, args.rounds, True)
+    bench('warm dm_soundex', one_by_one, words, args.rounds, False)
+    bench('warm dm_soundex_many', phonetic.dm_soundex_many, words,
+          args.rounds, False)
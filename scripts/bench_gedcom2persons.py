@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''
+    Usage: `python scripts/bench_gedcom2persons.py [--sizes N,N,..] [--gedcom PATH]`
+
+    Times the conversion of gedcom trees to person docs - the T666 test tree
+    and synthetic trees of a few sizes - and counts the relatives lookups
+    made on the parsed gedcom. The peak memory of the process is printed at
+    the end.
+'''
+import os
+import random
+import resource
+import tempfile
+import time
+import collections
+from argparse import ArgumentParser
+
+from gedcom import Gedcom
+
+from migration.family_trees import Gedcom2Persons, THIS_YEAR
+
+T666 = os.path.join(os.path.dirname(__file__), os.pardir,
+                    'tests', 'gentrees', 'T666.ged')
+LOOKUPS = ('families', 'get_parents', 'get_family_members')
+
+
+def make_tree(size, max_kids=4, seed=0):
+    ''' returns the text of a synthetic gedcom with about `size` persons,
+        the descendants of a single couple and their spouses
+    '''
+    rand = random.Random(seed)
+    persons = []
+    families = []
+
+    def add_person(sex, birth_year, famc=None):
+        person = dict(pointer='@I{}@'.format(len(persons) + 1), sex=sex,
+                      birth_year=birth_year, famc=famc, fams=[])
+        persons.append(person)
+        return person
+
+    queue = collections.deque([add_person('M', 1700)])
+    while queue and len(persons) < size:
+        person = queue.popleft()
+        # some persons married twice
+        for i in range(2 if rand.random() < 0.1 else 1):
+            spouse = add_person('F' if person['sex'] == 'M' else 'M',
+                                person['birth_year'] + rand.randint(-5, 5))
+            family = dict(pointer='@F{}@'.format(len(families) + 1),
+                          year=person['birth_year'] + 25, kids=[])
+            families.append(family)
+            husband, wife = (person, spouse) if person['sex'] == 'M' \
+                            else (spouse, person)
+            family['husband'], family['wife'] = husband, wife
+            for member in (husband, wife):
+                member['fams'].append(family['pointer'])
+            for j in range(rand.randint(0, max_kids)):
+                kid = add_person(rand.choice('MF'),
+                                 family['year'] + rand.randint(1, 15),
+                                 family['pointer'])
+                family['kids'].append(kid)
+                queue.append(kid)
+
+    lines = ['0 HEAD', '1 SOUR BENCH', '1 GEDC', '2 VERS 5.5',
+             '2 FORM LINEAGE-LINKED', '1 CHAR UTF-8']
+    for person in persons:
+        lines += ['0 {} INDI'.format(person['pointer']),
+                  '1 NAME Person{} /Bench/'.format(person['pointer'][2:-1]),
+                  '1 SEX {}'.format(person['sex']),
+                  '1 BIRT', '2 DATE {}'.format(person['birth_year'])]
+        if person['birth_year'] + 70 < THIS_YEAR:
+            lines += ['1 DEAT', '2 DATE {}'.format(person['birth_year'] + 70)]
+        lines += ['1 FAMS {}'.format(f) for f in person['fams']]
+        if person['famc']:
+            lines.append('1 FAMC {}'.format(person['famc']))
+    for family in families:
+        lines += ['0 {} FAM'.format(family['pointer']),
+                  '1 HUSB {}'.format(family['husband']['pointer']),
+                  '1 WIFE {}'.format(family['wife']['pointer']),
+                  '1 MARR', '2 DATE {}'.format(family['year'])]
+        lines += ['1 CHIL {}'.format(kid['pointer']) for kid in family['kids']]
+    lines.append('0 TRLR')
+    return '\n'.join(lines) + '\n'
+
+
+def count_lookups(gedcom):
+    ''' wraps the relatives lookups of a parsed gedcom with counters '''
+    counts = collections.Counter()
+
+    def counted(name, func):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    for name in LOOKUPS:
+        setattr(gedcom, name, counted(name, getattr(gedcom, name)))
+    return counts
+
+
+def bench(name, fd):
+    started = time.time()
+    gedcom = Gedcom(fd=fd)
+    parsed = time.time()
+    counts = count_lookups(gedcom)
+    persons = []
+    Gedcom2Persons(gedcom, 0, name, persons.append, dryrun=True)
+    elapsed = max(time.time() - parsed, 0.001)
+    print("{:>12}: {:7} persons, parsed in {:6.2f} sec, converted in "
+          "{:6.2f} sec ({:8.0f} persons/sec), {}".format(
+              name, len(persons), parsed - started, elapsed,
+              len(persons) / elapsed,
+              ', '.join('{} {}'.format(counts[i], i) for i in LOOKUPS)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--gedcom', default=T666)
+    parser.add_argument('--sizes', default='1000,10000,50000',
+                        help='a comma separated list of synthetic tree sizes')
+    args = parser.parse_args()
+    with open(args.gedcom) as fd:
+        bench(os.path.basename(args.gedcom), fd)
+    for size in map(int, args.sizes.split(',')):
+        # the trees are read from files, like the migration does
+        with tempfile.TemporaryFile() as fd:
+            fd.write(make_tree(size))
+            fd.seek(0)
+            bench('synthetic', fd)
+    print("peak memory: {:.0f} MB".format(
+          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+    Usage: `python scripts/bench_geocode.py [--places N] [--delay SECONDS]`
+
+    Runs the places backfill against the local stub geocoder on a scratch
+    db, with a cold cache and different numbers of workers, and again with
+    a warm cache.
+'''
+import time
+from argparse import ArgumentParser
+
+from bhs_api import create_app
+from bhs_api.geocode import StubGeocoder, GEOCODE_COLLECTION
+from scripts.get_places_geo import geocode_places
+
+BENCH_DB = 'geocode_bench'
+
+
+def reset_places(db, count):
+    db['places'].drop()
+    db['places'].insert_many([{'Header': {'En': u'place {}'.format(i)},
+                               'visible': True} for i in range(count)])
+
+
+def bench(name, db, geocoder, workers, rate):
+    calls = geocoder.calls
+    started = time.time()
+    geocode_places(db, geocoder, workers, rate)
+    print("{}: {:.2f} sec, {} geocoder calls".format(
+          name, time.time() - started, geocoder.calls - calls))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--places', type=int, default=200)
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='the latency of the stub geocoder')
+    parser.add_argument('--rate', type=float, default=1000)
+    args = parser.parse_args()
+    app, conf = create_app()
+    db = app.client_data_db[BENCH_DB]
+    geocoder = StubGeocoder(delay=args.delay)
+    try:
+        for workers in (1, 4, 16):
+            db[GEOCODE_COLLECTION].drop()
+            reset_places(db, args.places)
+            bench('cold, {} workers'.format(workers), db, geocoder,
+                  workers, args.rate)
+        reset_places(db, args.places)
+        bench('warm, 16 workers', db, geocoder, 16, args.rate)
+    finally:
+        app.client_data_db.drop_database(BENCH_DB)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+    Usage: `python scripts/bench_task_payloads.py [--sample N] [--chunk-size N]`
+
+    Compares the migration task payload formats on docs sampled from the
+    data db: the broker bytes per doc and the cost to encode a doc.
+    The redis transport stores the message bodies base64 encoded, so the
+    broker bytes are counted after base64.
+'''
+import base64
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from kombu.compression import compress
+from kombu.exceptions import EncodeError
+from kombu.serialization import dumps
+
+from bhs_api import create_app
+from migration.payload import stage_docs
+
+COLLECTIONS = ('persons', 'photoUnits', 'places', 'personalities')
+
+
+def get_sample(db, collection_name, size):
+    docs = list(db[collection_name].aggregate([{'$sample': {'size': size}}]))
+    for doc in docs:
+        # the migrated docs don't have a mongo id yet
+        doc.pop('_id', None)
+    return docs
+
+
+def encode_message(chunk, collection_name, payload, staging_dir):
+    ''' returns the bytes of the message in the broker and of a staged file '''
+    staged_bytes = 0
+    if payload == 'staged':
+        path = stage_docs(chunk, staging_dir)
+        staged_bytes = os.path.getsize(path)
+        args = (path, collection_name)
+    else:
+        args = (chunk, collection_name)
+    serializer = 'json' if payload == 'json' else 'pickle'
+    content_type, encoding, body = dumps({'args': args, 'kwargs': {}},
+                                         serializer=serializer)
+    if payload == 'zlib':
+        body, content_type = compress(body, 'zlib')
+    return len(base64.b64encode(body)), staged_bytes
+
+
+def bench(docs, collection_name, payload, chunk_size, staging_dir):
+    chunks = [docs[i:i+chunk_size] for i in range(0, len(docs), chunk_size)]
+    broker_bytes = staged_bytes = 0
+    started = time.time()
+    try:
+        for chunk in chunks:
+            message, staged = encode_message(chunk, collection_name, payload,
+                                             staging_dir)
+            broker_bytes += message
+            staged_bytes += staged
+    except EncodeError as e:
+        return "{:8}: can't encode - {}".format(payload, e)
+    elapsed = time.time() - started
+    return "{:8}: {:8.0f} broker bytes/doc {:8.0f} staged bytes/doc " \
+           "{:6.0f} usec/doc".format(payload,
+                                     broker_bytes / float(len(docs)),
+                                     staged_bytes / float(len(docs)),
+                                     elapsed * 1e6 / len(docs))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--sample', type=int, default=1000)
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--collection', help="only run for a single collection")
+    args = parser.parse_args()
+    app, conf = create_app()
+    staging_dir = tempfile.mkdtemp()
+    try:
+        for name in [args.collection] if args.collection else COLLECTIONS:
+            docs = get_sample(app.data_db, name, args.sample)
+            if not docs:
+                continue
+            print("{}, {} docs".format(name, len(docs)))
+            for payload in ('json', 'pickle', 'zlib', 'staged'):
+                print(bench(docs, name, payload, args.chunk_size, staging_dir))
+    finally:
+        shutil.rmtree(staging_dir)
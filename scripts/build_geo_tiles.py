@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+'''
+    Usage: `python scripts/build_geo_tiles.py [--db DB]`
+
+    Builds the clusters of the places map tiles from the places' geometry.
+    `get_places_geo.py` runs it after geocoding, this is for building the
+    tiles by hand, e.g. after restoring a db.
+'''
+import argparse
+
+from bhs_api import create_app
+from bhs_api.tiles import build_pyramid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db',
+                        help='the db to run on defaults to the value in the config file.')
+    args = parser.parse_args()
+    app, conf = create_app()
+    db = app.client_data_db[args.db] if args.db else app.data_db
+    print("built {} map tiles".format(build_pyramid(db)))
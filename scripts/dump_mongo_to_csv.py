@@ -10,7 +10,7 @@ import unicodecsv
 
 
 from bhs_api import create_app
-from bhs_api.item import SHOW_FILTER
+from bhs_api.item import VISIBLE_FILTER
 
 
 def parse_args():
@@ -69,11 +69,11 @@ if __name__ == '__main__':
             writer.writerow(header)
 
         started = datetime.now()
-        cursor = db[collection].find(SHOW_FILTER)
+        cursor = db[collection].find(VISIBLE_FILTER)
         if args.debug:
             import pdb; pdb.set_trace()
             cursor = cursor.limit(100)
-        for doc in db[collection].find(SHOW_FILTER):
+        for doc in db[collection].find(VISIBLE_FILTER):
             if "En" not in doc["Slug"]:
                 continue
 
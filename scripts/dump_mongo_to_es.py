@@ -4,12 +4,12 @@ import datetime
 from uuid import UUID
 import argparse
 
-import elasticsearch
-
 from bhs_api import create_app
 from bhs_api import phonetic
 from bhs_api.utils import uuids_to_str, SEARCHABLE_COLLECTIONS
-from bhs_api.item import SHOW_FILTER
+from bhs_api.item import get_visible_filter, strip_mongo_fields
+from bhs_api.suggest import warm_suggestions
+from bhs_api.indexer import get_indexer, bulk_load
 from scripts.elasticsearch_create_index import ElasticsearchCreateIndexCommand
 
 
@@ -31,10 +31,11 @@ class MongoToEsDumper(object):
         self.es = es
         self.es_index_name = es_index_name
         self.mongo_db = mongo_db
+        self.indexer = get_indexer(es)
 
     def _process_collection(self, collection):
         started = datetime.datetime.now()
-        for doc in self.mongo_db[collection].find(SHOW_FILTER):
+        for doc in self.mongo_db[collection].find(get_visible_filter(collection)):
             self._process_doc(collection, doc)
         finished = datetime.datetime.now()
         print 'Collection {} took {}'.format(collection, finished - started)
@@ -53,6 +54,7 @@ class MongoToEsDumper(object):
         _id = doc['_id']
         del doc['_id']
         del doc['UnitHeaderDMSoundex']
+        strip_mongo_fields(doc)
         # un null the fields that are used for completion
         if collection in ('places', 'familyNames'):
             self._add_phonetics(doc)
@@ -62,26 +64,16 @@ class MongoToEsDumper(object):
             if not header[lang]:
                 header[lang] = '1234567890'
             header["{}_lc".format(lang)] = header[lang].lower()
-        res = None
-        try:
-            res = app.es.index(index=self.es_index_name, doc_type=collection, id=_id, body=doc)
-        except elasticsearch.exceptions.SerializationError:
-            # UUID fields are causing es to crash, turn them to strings
-            uuids_to_str(doc)
-            try:
-                res = app.es.index(index=self.es_index_name, doc_type=collection, id=_id, body=doc)
-            except elasticsearch.exceptions.SerializationError as e:
-                import pdb
-                pdb.set_trace()
-        except elasticsearch.exceptions.RequestError as e:
-            import pdb
-            pdb.set_trace()
-        return res
+        # UUID fields are causing es to crash, turn them to strings
+        uuids_to_str(doc)
+        self.indexer.index(self.es_index_name, collection, str(_id), doc)
 
     def main(self, collections, delete_existing=False):
         ElasticsearchCreateIndexCommand().create_es_index(self.es, self.es_index_name, delete_existing=delete_existing)
-        for collection in collections:
-            self._process_collection(collection)
+        with bulk_load(self.indexer, self.es_index_name):
+            for collection in collections:
+                self._process_collection(collection)
+        print 'Indexed {} docs, {} failed'.format(self.indexer.indexed, self.indexer.failed)
 
 
 if __name__ == '__main__':
@@ -91,3 +83,6 @@ if __name__ == '__main__':
     db = app.data_db if not args.db else app.client_data_db[args.db]
     collections = SEARCHABLE_COLLECTIONS if not args.collection else [args.collection]
     MongoToEsDumper(es=app.es, es_index_name=db.name, mongo_db=db).main(delete_existing=args.remove, collections=collections)
+    if not args.db:
+        with app.app_context():
+            warm_suggestions()
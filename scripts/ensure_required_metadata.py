@@ -5,6 +5,8 @@ from bhs_api import create_app
 from bhs_api.utils import SEARCHABLE_COLLECTIONS
 from bhs_api.item import get_collection_id_field
 from bhs_api.item import doc_show_filter, update_es, get_show_metadata
+from bhs_api.suggest import warm_suggestions
+from bhs_api.indexer import get_indexer, bulk_load
 import sys
 from datetime import datetime
 from traceback import print_exc
@@ -23,6 +25,8 @@ class EnsureRequiredMetadataCommand(object):
     def __init__(self, app=None):
         self.args = self._parse_args()
         self.app, self.conf = create_app() if not app else (app, app.conf)
+        # the collections that had items added, updated or deleted
+        self.changed_collections = set()
 
     def _parse_args(self):
         parser = ArgumentParser()
@@ -287,6 +291,9 @@ class EnsureRequiredMetadataCommand(object):
         self._info("processing collection {}{}".format(collection_name, " key {}".format(key) if key else ""))
         errors, processed_mongo_keys, processed_elasticsearch_keys, num_actions = [], [], [], {}
         self._process_mongo_items(collection_name, errors, key, num_actions, processed_mongo_keys)
+        # the added items are indexed in bulk, collect their errors
+        for action, error in get_indexer(self.app.es).flush():
+            errors.append("error adding item {}: {}".format(action.values()[0]['_id'], error))
         self._process_elasticsearch_items(collection_name, errors, key, num_actions, processed_mongo_keys, processed_elasticsearch_keys)
         self._info("total {} items were processed:".format(len(processed_mongo_keys) + len(processed_elasticsearch_keys) + len(errors)))
         if len(errors) > 0:
@@ -297,6 +304,8 @@ class EnsureRequiredMetadataCommand(object):
                 for err in errors:
                     f.write("{}\n".format(err))
                     self._debug(err)
+        if any(code in num_actions for code in [self.UPDATED_METADATA, self.ADDED_ITEM, self.DELETED_ITEM]):
+            self.changed_collections.add(collection_name)
         for code in [self.UPDATED_METADATA, self.ADDED_ITEM, self.DELETED_ITEM, self.NO_UPDATE_NEEDED]:
             if code in num_actions:
                 self._info({self.UPDATED_METADATA: "updated {} items",
@@ -310,10 +319,21 @@ class EnsureRequiredMetadataCommand(object):
         collection_names = SEARCHABLE_COLLECTIONS if not self.args.collection else [self.args.collection]
         if key and len(collection_names) != 1:
             raise Exception("cannot use key param without specifying a specific collection this key relates to")
+        elif self.args.add and not key:
+            # adding can be a large load, don't refresh the index until done
+            with bulk_load(get_indexer(self.app.es), self._get_elasticsearch_index_name()):
+                for collection_name in collection_names:
+                    self._process_collection(collection_name, key)
         else:
             for collection_name in collection_names:
                 self._process_collection(collection_name, key)
 
 
 if __name__ == '__main__':
-    EnsureRequiredMetadataCommand().main()
+    command = EnsureRequiredMetadataCommand()
+    command.main()
+    if command.changed_collections:
+        # the changed items change the suggestions, warm them once searchable
+        command.app.es.indices.refresh(index=command._get_elasticsearch_index_name())
+        with command.app.app_context():
+            warm_suggestions()
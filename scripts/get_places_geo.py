@@ -1,11 +1,18 @@
+'''
+    Usage: `python scripts/get_places_geo.py [--db DB] [--workers N] [--rate R]`
+
+    Geocodes every place that doesn't have a geometry, using up to `workers`
+    concurrent requests and at most `rate` requests per second. The results
+    are cached, so only new headers reach the geocoder.
+'''
 import argparse
-from flask import current_app
+from multiprocessing.dummy import Pool
 
 from bhs_api import create_app
-from bhs_api.item import SHOW_FILTER
-
-import requests
-import urllib
+from bhs_api.item import VISIBLE_FILTER
+from bhs_api.geocode import (geocode, create_geocoder, RateLimitedGeocoder,
+                             GeocodeError)
+from bhs_api.tiles import build_pyramid
 
 
 def parse_args():
@@ -14,29 +21,45 @@ def parse_args():
                                      )
     parser.add_argument('--db',
                         help='the db to run on defaults to the value in the config file.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='the number of concurrent geocoder requests')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='the max geocoder requests per second')
     return parser.parse_args()
 
 
-#TODO: move this to bhs_api.utils
-def get_place_geo(doc):
-    ''' tries to get the geo of a place, return None if fails '''
-    url = 'https://api.opencagedata.com/geocode/v1/geojson'
-    query = doc['Header']['En']
-    parameters = {}
-    parameters['q'] = query
-    parameters['key'] = current_app.conf.opencage_key
-
-    str_parameters = {}
-    for k, v in parameters.iteritems():
-        str_parameters[k] = unicode(v).encode('utf-8')
-    params = urllib.urlencode(str_parameters)
-    full_url = url + '?' + params
-    response = requests.get(full_url)
-    if response.status_code == 200:
-        result = response.json()
-        if len(result['features']):
-            return result['features'][0]['geometry']
-    return None
+def geocode_places(db, geocoder, workers=4, rate=10):
+    ''' geocodes the places with no geometry, returns the number of places
+        geocoded and the number of failures
+    '''
+    filters = VISIBLE_FILTER.copy()
+    filters['geometry'] = None
+    filters['Header.En'] = {'$nin' : [None, '']}
+    # only the cache misses reach the geocoder and count against the rate
+    geocoder = RateLimitedGeocoder(geocoder, rate)
+
+    def geocode_doc(doc):
+        try:
+            return doc['_id'], geocode(db, geocoder, doc['Header']['En'])
+        except GeocodeError as e:
+            print(u"failed to geocode {}: {}".format(doc['Header']['En'], e))
+            return doc['_id'], False
+
+    docs = list(db['places'].find(filters, {'Header': True}))
+    pool = Pool(workers)
+    done = failed = 0
+    try:
+        for _id, geometry in pool.imap_unordered(geocode_doc, docs):
+            if geometry:
+                db['places'].update_one({"_id": _id},
+                                        {"$set": {"geometry": geometry}})
+                done += 1
+            elif geometry is False:
+                failed += 1
+    finally:
+        pool.close()
+        pool.join()
+    return done, failed
 
 
 if __name__ == '__main__':
@@ -47,15 +70,8 @@ if __name__ == '__main__':
     else:
         db = app.data_db
 
-    index_name = db.name
-    filters = SHOW_FILTER.copy()
-    filters['geometry'] = {'$exists': False}
-    filters['Header.En'] = {'$nin' : [None, '']}
-
-    with app.app_context():
-        for doc in db['places'].find(filters):
-            geometry = get_place_geo(doc)
-            if geometry:
-                db['places'].update({"_id": doc["_id"]},
-                                    {"$set": {"geometry": geometry}},
-                                    multi=True)
+    done, failed = geocode_places(db, create_geocoder(conf),
+                                  args.workers, args.rate)
+    print("geocoded {} places, {} failed".format(done, failed))
+    # the map tiles are clustered from the new geometries
+    print("built {} map tiles".format(build_pyramid(db)))
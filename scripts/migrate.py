@@ -9,17 +9,29 @@ import datetime
 import calendar
 import time
 from functools import partial
+from collections import namedtuple, Counter
+from multiprocessing import Pool
 
 from pymongo import MongoClient
 from pymongo.errors import BulkWriteError
 from bson.code import Code
+from bson.binary import Binary, BINARY_SUBTYPE
+import redis
 
 from gedcom import Gedcom, GedcomParseError
 from migration.migration_sqlclient import MigrationSQLClient
-from migration.tasks import update_row
-from migration.files import upload_photo
+from migration.tasks import (update_rows, update_staged_rows, ensure_indices,
+                             get_tree_version, carry_forward_persons, celery)
+from migration.payload import stage_docs, PAYLOAD_FORMATS, DEFAULT_FORMAT
+from migration.throttle import QueueThrottle, MAX_IN_FLIGHT
+from migration.files import PhotoUploader, get_photo_path, UPLOAD_WORKERS
+from migration.storage import get_storage
+from migration.upload_manifest import UploadManifest, MANIFEST_PATH
+from migration.thumbnails import (ThumbnailStore, THUMBNAILS_DIR,
+                                  WORKERS as THUMBNAIL_WORKERS)
 from migration.family_trees import Gedcom2Persons
-from bhs_api.utils import get_migrate_conf, create_thumb, get_unit_type
+from migration.tree_diff import TreeDiff, get_previous_hashes, CHANGE_KINDS
+from bhs_api.utils import get_migrate_conf, get_unit_type
 from bhs_api import phonetic
 from bhs_api.item import get_collection_id_field
 
@@ -37,6 +49,13 @@ logger = logging.getLogger('scripts.migrate')
 logger.setLevel(logging.getLevelName('INFO'))
 
 repeated_slugs = {'He': {}, 'En': {}}
+# the number of docs in every update_rows task
+CHUNK_SIZE = 100
+# the number of unchanged persons in every carry_forward_persons task
+CARRY_FORWARD_CHUNK_SIZE = 1000
+
+TreeResult = namedtuple('TreeResult', ('tree_num', 'file_name', 'persons',
+                                       'elapsed', 'error', 'changes'))
 
 split = lambda x: re.split(',|\||;| ', x)
 
@@ -53,6 +72,32 @@ def parse_args():
     parser.add_argument('--lasthours',
                         help="migrate all content changed in the last LASTHOURS")
     parser.add_argument('--dryrun', help="don't update data, just print what will be done")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="the number of docs to update in every task")
+    parser.add_argument('--payload', choices=PAYLOAD_FORMATS, default=DEFAULT_FORMAT,
+                        help="how to send the docs to the workers")
+    parser.add_argument('--staging-dir',
+                        help="a directory shared with the workers, for the staged payload")
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help="pause while the broker holds this many tasks, 0 for no limit")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="the number of processes migrating the trees")
+    parser.add_argument('--full-trees', action='store_true',
+                        help="migrate all the persons of the trees, not only the changed ones")
+    parser.add_argument('--thumbnails-dir', default=THUMBNAILS_DIR,
+                        help="a directory to keep the thumbnails of the photos in")
+    parser.add_argument('--thumbnail-workers', type=int, default=THUMBNAIL_WORKERS,
+                        help="the number of processes making the thumbnails")
+    parser.add_argument('--photos-bucket',
+                        help="the photos bucket, or a file:// directory. "
+                             "defaults to photos_bucket_name")
+    parser.add_argument('--thumbnails-bucket',
+                        help="the thumbnails bucket, or a file:// directory. "
+                             "defaults to thumbnails_bucket_name")
+    parser.add_argument('--upload-manifest', default=MANIFEST_PATH,
+                        help="a file to keep the hashes of the uploaded photos in")
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS,
+                        help="the number of photos uploaded at once")
 
     return parser.parse_args()
 
@@ -230,10 +275,14 @@ def parse_image_unit(doc):
 def parse_image(doc):
     image_doc = doc.copy()
 
-    # create thumbnail and attach to document
-    thumb_binary = create_thumb(image_doc, conf.photos_mount_point)
-    if thumb_binary:
-        image_doc['bin'] = thumb_binary
+    # attach the thumbnail to the document
+    path = get_photo_path(image_doc, conf.photos_mount_point)
+    if path:
+        thumbnail = thumbnails.get(path)
+        if thumbnail:
+            image_doc['bin'] = Binary(thumbnail, BINARY_SUBTYPE)
+    else:
+        logger.warn('{}: has no file name'.format(image_doc['PictureId']))
 
     return image_doc
 
@@ -291,6 +340,47 @@ def parse_doc(doc, collection_name):
     return collection_procedure_map[collection_name](doc)
 
 
+class RowsBatcher(object):
+    ''' groups the docs of every collection into update_rows tasks of up to
+        `chunk_size` docs
+    '''
+
+    def __init__(self, chunk_size=CHUNK_SIZE, throttle=None,
+                 payload=DEFAULT_FORMAT, staging_dir=None):
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.payload = payload
+        self.staging_dir = staging_dir
+        self.chunks = {}
+
+    def add(self, doc, collection_name):
+        chunk = self.chunks.setdefault(collection_name, [])
+        chunk.append(doc)
+        if len(chunk) >= self.chunk_size:
+            self.flush(collection_name)
+
+    def flush(self, collection_name=None):
+        names = [collection_name] if collection_name else self.chunks.keys()
+        for name in names:
+            chunk = self.chunks.pop(name, None)
+            if chunk:
+                self.send(chunk, name)
+                if self.throttle:
+                    self.throttle.sent()
+
+    def send(self, chunk, collection_name):
+        if self.payload == 'staged':
+            path = stage_docs(chunk, self.staging_dir)
+            update_staged_rows.delay(path, collection_name)
+        else:
+            compression = 'zlib' if self.payload == 'zlib' else None
+            update_rows.apply_async((chunk, collection_name),
+                                    compression=compression)
+
+batcher = RowsBatcher()
+thumbnails = ThumbnailStore()
+
+
 def parse_n_update(row, collection_name, dryrun=False):
     doc = parse_doc(row, collection_name)
     id_field = get_collection_id_field(collection_name)
@@ -298,7 +388,7 @@ def parse_n_update(row, collection_name, dryrun=False):
         collection_name, id_field, doc[id_field],
         doc.get('UpdateDate', '?')))
     if not dryrun:
-        update_row.delay(doc, collection_name)
+        batcher.add(doc, collection_name)
     return doc
 
 
@@ -312,34 +402,153 @@ def get_file_descriptors(tree, gedcom_path):
     return file_id, file_name
 
 
-def migrate_trees(cursor, only_process_treenum=None, gedcom_path=None, on_save=None, dryrun=False):
-    ''' get command line arguments and sql query and initiated update_tree
-        and update_row celery tasks.
-        returns how many people migrated
+def migrate_tree(row, gedcom_path=None, on_save=None, dryrun=False, incremental=True):
+    ''' migrate the persons of a single tree, returns a TreeResult.
+        the errors are logged and returned, they don't stop the migration
+        of the other trees.
+        when `incremental`, only the persons that changed since the last
+        migrated version are saved, the others are copied to the new version.
     '''
     collection_name = "persons"
-    row_number = 0
-    filtered_rows = filter(lambda row: not only_process_treenum or row['GenTreeNumber'] == only_process_treenum, cursor)
-    for row_number, row in enumerate(filtered_rows, start=1):
+    started = time.time()
+    tree_num = row['GenTreeNumber']
+    file_id, file_name = get_file_descriptors(row, gedcom_path)
+    result = partial(TreeResult, tree_num, file_name)
+    try:
+        gedcom_fd = open(file_name)
+    except IOError, e:
+        logger.error('failed to open gedocm file tree number {}, path {}: {}'.format(tree_num, file_name, str(e)))
+        return result(0, time.time() - started, str(e), None)
+    try:
+        g = Gedcom(fd=gedcom_fd)
+    except (SyntaxError, GedcomParseError) as e:
+        logger.error('failed to parse tree number {}, path {}: {}'.format(tree_num, file_name, str(e)))
+        return result(0, time.time() - started, str(e), None)
+    except Exception as e:
+        logger.exception('failed to parse tree number {}, path {}'.format(tree_num, file_name))
+        return result(0, time.time() - started, str(e), None)
+    logger.info('>>> migrating tree {}, path {}'.format(tree_num, file_name))
+    on_save = partial(parse_n_update, collection_name=collection_name, dryrun=dryrun) if not on_save else on_save
+    changes = None
+    try:
+        # resolve the version once for all the persons of the tree
+        tree_version = get_tree_version(celery.data_db['trees'],
+                                        tree_num, file_id)
+        if incremental:
+            base_version, hashes = get_previous_hashes(celery.data_db[collection_name],
+                                                       tree_num, tree_version)
+            diff = TreeDiff(hashes)
+            def save(data):
+                if diff.add(data):
+                    on_save(data)
+        else:
+            save = on_save
+        persons = Gedcom2Persons(g, tree_num, file_id, save,
+                                 tree_version=tree_version)
+        if incremental:
+            if diff.unchanged and base_version != tree_version and not dryrun:
+                carry_forward(tree_num, base_version, tree_version, diff.unchanged,
+                              {'tree_file_id': file_id,
+                               'tree_size': persons.meta['persons']})
+            changes = diff.get_report()
+            logger.info('tree {}: {}'.format(tree_num, format_changes(changes)))
+    except Exception as e:
+        logger.exception('failed to migrate tree number {}, path {}'.format(tree_num, file_name))
+        return result(0, time.time() - started, str(e), changes)
+    logger.info('<<< migrated tree {}, path {}'.format(tree_num, file_name))
+    return result(persons.meta['persons'], time.time() - started, None, changes)
+
+
+def carry_forward(tree_num, from_version, to_version, ids, fields):
+    for i in range(0, len(ids), CARRY_FORWARD_CHUNK_SIZE):
+        carry_forward_persons.delay(tree_num, from_version, to_version,
+                                    ids[i:i+CARRY_FORWARD_CHUNK_SIZE], fields)
+        if batcher.throttle:
+            batcher.throttle.sent()
+
+
+def format_changes(changes):
+    return ', '.join('{} {}'.format(changes[kind], kind) for kind in CHANGE_KINDS)
+
+
+def init_tree_worker():
+    # drop the docs the parent process batched before the fork
+    batcher.chunks = {}
+
+
+def migrate_tree_in_worker(args):
+    ''' the pool workers migrate a tree and send all its docs '''
+    row, gedcom_path, dryrun, incremental = args
+    started = time.time()
+    try:
+        result = migrate_tree(row, gedcom_path, dryrun=dryrun, incremental=incremental)
+    except Exception as e:
+        # an error raised here would stop the pool, losing the other results
+        logger.exception('failed to migrate tree number {}'.format(row['GenTreeNumber']))
         file_id, file_name = get_file_descriptors(row, gedcom_path)
-        try:
-            gedcom_fd = open(file_name)
-        except IOError, e:
-            logger.error('failed to open gedocm file tree number {}, path {}: {}'.format(row['GenTreeNumber'], file_name, str(e)))
+        return TreeResult(row['GenTreeNumber'], file_name, 0,
+                          time.time() - started, str(e), None)
+    try:
+        batcher.flush("persons")
+    except Exception as e:
+        logger.exception('failed to send the persons of tree number {}'.format(result.tree_num))
+        result = result._replace(error=str(e))
+    return result
+
+
+def log_trees_summary(results, elapsed):
+    failed = [result for result in results if result.error]
+    logger.info('migrated {} trees, {} persons in {:.1f} sec, {} trees failed'.format(
+        len(results) - len(failed), sum(result.persons for result in results),
+        elapsed, len(failed)))
+    changes = Counter()
+    for result in results:
+        changes.update(result.changes or {})
+    if changes:
+        logger.info('persons: {}'.format(format_changes(changes)))
+    for result in sorted(results, key=lambda result: result.elapsed, reverse=True):
+        if result.error:
+            logger.error('tree {} failed after {:.1f} sec: {}'.format(
+                result.tree_num, result.elapsed, result.error))
+        elif result.changes:
+            logger.info('tree {}: {} persons in {:.1f} sec, {}'.format(
+                result.tree_num, result.persons, result.elapsed,
+                format_changes(result.changes)))
         else:
-            try:
-                g = Gedcom(fd=gedcom_fd)
-            except (SyntaxError, GedcomParseError) as e:
-                logger.error('failed to parse tree number {}, path {}: {}'.format(row['GenTreeNumber'], file_name, str(e)))
-            else:
-                logger.info('>>> migrating tree {}, path {}'.format(row['GenTreeNumber'], file_name))
-                if on_save and dryrun:
-                    raise Exception("dryrun is not supported with on_save")
-                else:
-                    on_save = partial(parse_n_update, collection_name=collection_name, dryrun=dryrun) if not on_save else on_save
-                    Gedcom2Persons(g, row['GenTreeNumber'], file_id, on_save)
-                    logger.info('<<< migrated tree {}, path {}'.format(row['GenTreeNumber'], file_name))
-    return row_number
+            logger.info('tree {}: {} persons in {:.1f} sec'.format(
+                result.tree_num, result.persons, result.elapsed))
+
+
+def migrate_trees(cursor, only_process_treenum=None, gedcom_path=None, on_save=None, dryrun=False, workers=1,
+                  incremental=True):
+    ''' get command line arguments and sql query and initiated update_tree
+        and update_row celery tasks. with more than one worker the trees are
+        migrated in a pool of processes.
+        returns how many trees were processed
+    '''
+    if on_save and dryrun:
+        raise Exception("dryrun is not supported with on_save")
+    if on_save and workers > 1:
+        raise Exception("workers are not supported with on_save")
+    rows = filter(lambda row: not only_process_treenum or row['GenTreeNumber'] == only_process_treenum, cursor)
+    started = time.time()
+    if workers > 1 and len(rows) > 1:
+        pool = Pool(workers, initializer=init_tree_worker)
+        try:
+            results = list(pool.imap_unordered(migrate_tree_in_worker,
+                                               [(row, gedcom_path, dryrun, incremental) for row in rows]))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = [migrate_tree(row, gedcom_path, on_save, dryrun, incremental) for row in rows]
+    batcher.flush("persons")
+    if results:
+        log_trees_summary(results, time.time() - started)
+    return len(rows)
 
 
 if __name__ == '__main__':
@@ -364,8 +573,30 @@ if __name__ == '__main__':
     else:
         since = int(args.since)
 
+    thumbnails.directory = args.thumbnails_dir
+    thumbnails.workers = args.thumbnail_workers
+    batcher.chunk_size = args.chunk_size
+    batcher.payload = args.payload
+    batcher.staging_dir = args.staging_dir
+    if args.payload == 'staged' and not args.staging_dir:
+        logger.error('the staged payload requires --staging-dir')
+        sys.exit(1)
+    if args.max_in_flight:
+        broker = redis.StrictRedis(host=celery.conf['REDIS_HOST'],
+                                   port=celery.conf['REDIS_PORT'],
+                                   password=celery.conf['REDIS_PASSWORD'],
+                                   db=0)
+        batcher.throttle = QueueThrottle(broker, celery.conf.CELERY_DEFAULT_QUEUE,
+                                         args.max_in_flight)
+
     collection = args.collection
     queries = get_queries(collection)
+    if not args.dryrun:
+        # create the indices once per run, not in every task
+        for collection_name in queries:
+            if collection_name == 'genTrees':
+                collection_name = 'persons'
+            ensure_indices(celery.data_db[collection_name])
     logger.info('looking for changed items in {}-{}'.format(since, until))
     photos_to_update = []
     for collection_name, query in queries.items():
@@ -376,7 +607,9 @@ if __name__ == '__main__':
             # TODO: have all places refer to it as "persons" instead of variations on genTrees / ftrees etc..
             tree_nums = [args.unitid] if args.unitid else None
             sql_cursor = sqlClient.execute(query, since=since, until=until)
-            count = migrate_trees(sql_cursor, args.unitid, args.gedcom_path, dryrun=args.dryrun)
+            count = migrate_trees(sql_cursor, args.unitid, args.gedcom_path,
+                                  dryrun=args.dryrun, workers=args.workers,
+                                  incremental=not args.full_trees)
             if not count:
                 logger.info('{}:Skipping'.format(collection_name))
         else:
@@ -386,6 +619,11 @@ if __name__ == '__main__':
                 sql_cursor = sqlClient.execute(query, since=since, until=until)
 
             if sql_cursor:
+                if collection_name == 'photos':
+                    # the thumbnails are made in parallel, before the docs
+                    sql_cursor = list(sql_cursor)
+                    thumbnails.prepare(get_photo_path(row, conf.photos_mount_point)
+                                       for row in sql_cursor if row['PicturePath'])
                 for row in sql_cursor:
                     doc = parse_n_update(row, collection_name, dryrun=args.dryrun)
                     # collect all the photos
@@ -401,14 +639,29 @@ if __name__ == '__main__':
             # TODO:
             # rsync_media(collection_name)
 
+    batcher.flush()
+    if batcher.throttle:
+        batcher.throttle.report(force=True)
+
     # update photos
     if len(photos_to_update) > 0:
         photos_query = get_queries('photos')['photos']
         photos_cursor = sqlClient.execute(photos_query,
                                           unit_ids=photos_to_update,
                                           )
-        for row in photos_cursor:
-            upload_photo(row, conf, dryrun=args.dryrun)
+        photo_rows = list(photos_cursor)
+        thumbnails.prepare(get_photo_path(row, conf.photos_mount_point)
+                           for row in photo_rows if row['PicturePath'])
+        manifest = UploadManifest(args.upload_manifest)
+        uploader = PhotoUploader(
+            get_storage(args.photos_bucket or conf.photos_bucket_name),
+            get_storage(args.thumbnails_bucket or conf.thumbnails_bucket_name),
+            conf.photos_mount_point, thumbnails, manifest,
+            workers=args.upload_workers, dryrun=args.dryrun)
+        try:
+            uploader.upload(photo_rows)
+        finally:
+            manifest.close()
 
     if since_file and not args.dryrun:
         since_file.seek(0)
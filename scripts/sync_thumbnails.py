@@ -1,81 +1,63 @@
 #!/usr/bin/env python
 '''
-    Usage: `python scripts/sync_thumbails.py`
+    Usage: `python scripts/sync_thumbnails.py [--dry-run] [--workers N]
+                                              [--state PATH]`
 
     This scripts looks for images that have no thumbnails, generates them
-    and push it to the thumbnails bucket in `thumbnail_bucket_name`
+    and push it to the thumbnails bucket in `thumbnail_bucket_name`.
+    The buckets can be replaced by local directories with `--photos-bucket`
+    and `--thumbnails-bucket file://PATH`. `--dry-run` prints the photos
+    with no thumbnail, prefixed by `+`, and the thumbnails with no photo,
+    prefixed by `-`. `--state` resumes an interrupted run.
 
 '''
-
-
-import os
-import json
-from subprocess import check_output
 import logging
-import StringIO
-
-import pymongo
-import boto
-import gcs_oauth2_boto_plugin
-from PIL import Image
+from collections import Counter
+from argparse import ArgumentParser
 
 from bhs_api.utils import get_migrate_conf
+from migration.storage import get_storage
+from migration.thumbnail_sync import ThumbnailSync, MISSING, ORPHAN, WORKERS
 
 conf = get_migrate_conf(('photos_bucket_name', 'thumbnails_bucket_name'))
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)-15s %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
-logger = logging.getLogger('scripts.migrate')
+logger = logging.getLogger('scripts.sync_thumbnails')
 logger.setLevel(logging.getLevelName('INFO'))
 
-def get_bucket_list(bucket_name):
-    uri = boto.storage_uri(bucket_name, 'gs')
-    for obj in uri.get_bucket():
-        yield obj.name
-
 
-def add_thumbnail(file_name):
-    ''' add a thumbnail for the specific file'''
-    src_uri = boto.storage_uri('{}/{}'.format(conf.photos_bucket_name,
-                                              file_name),
-                               'gs')
-    dest_uri = boto.storage_uri('{}/{}'.format(conf.thumbnails_bucket_name,
-                                              file_name),
-                               'gs')
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--photos-bucket', default=conf.photos_bucket_name,
+                        help="the photos bucket, or a file:// directory")
+    parser.add_argument('--thumbnails-bucket', default=conf.thumbnails_bucket_name,
+                        help="the thumbnails bucket, or a file:// directory")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="the number of processes making the thumbnails")
+    parser.add_argument('--state',
+                        help="a file to save the progress in, to resume from")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the differences of the buckets, don't sync them")
+    return parser.parse_args()
 
-    try:
-        new_key = dest_uri.new_key()
-    except boto.exception.NoAuthHandlerFound as e:
-        logging.error(e)
-        return None
-
-    # Create a file-like object for holding the photo contents.
-    photo = StringIO.StringIO()
-    src_uri.get_key().get_file(photo)
-
-    thumbnail = StringIO.StringIO()
-    im = Image.open(photo)
-    im.thumbnail((260, 260))
-    im.save(thumbnail, 'JPEG')
-    thumbnail.seek(0)
-    # save the thumbnail
-    try:
-        new_key.set_contents_from_file(thumbnail)
-        new_key.make_public()
-    except boto.exception.GSResponseError as e:
-        logging.error(e)
-        # Do we have the credentials file set up?
-        boto_cred_file = os.path.expanduser('~') + '/.boto'
-        if not os.path.exists(boto_cred_file):
-            logging.error('Credentials file {} was not found.'.format(boto_cred_file))
 
 if __name__ == '__main__':
-    photo_files = set(get_bucket_list(conf.photos_bucket_name))
-    thumbnail_files = set(get_bucket_list(conf.thumbnails_bucket_name))
-    missing_thumbnails = photo_files.difference(thumbnail_files)
-    print len(missing_thumbnails)
-    for photo in missing_thumbnails:
-        add_thumbnail(photo)
-        exit(-1)
-
+    args = parse_args()
+    sync = ThumbnailSync(get_storage(args.photos_bucket),
+                         get_storage(args.thumbnails_bucket),
+                         workers=args.workers, state_path=args.state)
+    if sync.last_name:
+        logger.info('resuming after {}'.format(sync.last_name))
+    if args.dry_run:
+        counts = Counter()
+        for name, kind in sync.diff():
+            counts[kind] += 1
+            print '{} {}'.format('+' if kind == MISSING else '-', name)
+        logger.info('{} photos with no thumbnail, {} thumbnails with no photo'
+                    .format(counts[MISSING], counts[ORPHAN]))
+    else:
+        counts = sync.run()
+        logger.info('added {} thumbnails, {} failed'.format(counts['added'],
+                                                           counts['failed']))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    Usage: `python scripts/update_dms_codes.py [--collection COLLECTION]`
+
+    Backfills the `dms_codes` field that migration extracts from
+    `UnitHeaderDMSoundex`, used by `phonetic.get_similar_strings`.
+'''
+from argparse import ArgumentParser
+
+import pymongo
+
+from bhs_api import create_app
+from bhs_api.phonetic import get_header_dms_codes
+from migration.tasks import DMS_INDICES
+
+COLLECTIONS = ('places', 'familyNames', 'personalities')
+BATCH_SIZE = 1000
+
+
+def update_dms_codes(collection):
+    updated = 0
+    requests = []
+    cursor = collection.find({'UnitHeaderDMSoundex': {'$exists': True}},
+                             {'UnitHeaderDMSoundex': True})
+    for doc in cursor:
+        codes = get_header_dms_codes(doc['UnitHeaderDMSoundex'])
+        requests.append(pymongo.UpdateOne({'_id': doc['_id']},
+                                          {'$set': {'dms_codes': codes}}))
+        if len(requests) == BATCH_SIZE:
+            updated += collection.bulk_write(requests).modified_count
+            requests = []
+    if requests:
+        updated += collection.bulk_write(requests).modified_count
+    for index in DMS_INDICES:
+        collection.create_index(index)
+    return updated
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--collection', help="only run for a single collection")
+    args = parser.parse_args()
+    app, conf = create_app()
+    collections = [args.collection] if args.collection else COLLECTIONS
+    for name in collections:
+        print("{}: {} updated".format(name, update_dms_codes(app.data_db[name])))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    Usage: `python scripts/update_visible.py [--collection COLLECTION]`
+
+    Backfills the `visible` field that migration precomputes from the show
+    filter and creates the indexes the readers use.
+    The persons readers match persons that got old enough since their
+    migration by birth year (see `bhs_api.item.get_visible_filter`), running
+    this periodically for the persons collection only refreshes their flag.
+'''
+from argparse import ArgumentParser
+
+from bhs_api import create_app
+from bhs_api.item import get_show_filter
+from bhs_api.tiles import build_pyramid
+from migration.tasks import INDICES
+
+COLLECTIONS = ('places', 'familyNames', 'lexicon', 'photoUnits',
+               'personalities', 'movies', 'persons')
+
+
+def update_visible(collection):
+    show_filter = get_show_filter(collection.name)
+    shown = collection.update_many(show_filter, {'$set': {'visible': True}})
+    hidden = collection.update_many({'$nor': [show_filter]},
+                                    {'$set': {'visible': False}})
+    for index in INDICES.get(collection.name, []):
+        collection.create_index(index)
+    return shown.modified_count, hidden.modified_count
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--collection', help="only run for a single collection")
+    args = parser.parse_args()
+    app, conf = create_app()
+    collections = [args.collection] if args.collection else COLLECTIONS
+    for name in collections:
+        shown, hidden = update_visible(app.data_db[name])
+        print("{}: {} shown, {} hidden".format(name, shown, hidden))
+        if name == 'places' and (shown or hidden):
+            # the map tiles count only the visible places
+            print("built {} map tiles".format(build_pyramid(app.data_db)))
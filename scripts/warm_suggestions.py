@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    Usage: `python scripts/warm_suggestions.py`
+
+    Caches the suggestions of the most frequent header prefixes, should run
+    after the elasticsearch index is updated.
+'''
+from bhs_api import create_app
+from bhs_api.suggest import warm_suggestions
+
+
+if __name__ == '__main__':
+    app, conf = create_app()
+    with app.app_context():
+        print("warmed {} prefixes".format(warm_suggestions()))
@@ -14,6 +14,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
                                              os.pardir)))
 
 from bhs_api import create_app
+from bhs_api.cache import ItemCache
 
 
 @pytest.fixture
@@ -29,6 +30,8 @@ def app(mock_db):
     app, conf = create_app(testing=True)
     # there should one and only one data db
     app.data_db = mock_db
+    # keep the item cache local to the test, away from any redis
+    app.item_cache = ItemCache(None, app.config['CACHING_TTL'])
     return app
 
 
@@ -63,6 +66,7 @@ def mock_db():
             'StatusDesc': 'Completed',
             'RightsDesc': 'Full',
             'DisplayStatusDesc':  'free',
+            'visible': True,
             'UnitText1': {'En': 'tester',
                         'He': 'בודק',
                         }
@@ -74,6 +78,7 @@ def mock_db():
             'StatusDesc': 'Edit',
             'RightsDesc': 'Full',
             'DisplayStatusDesc':  'free',
+            'visible': False,
             'UnitText1': {'En': 'another tester',
                         'He': 'עוד בודק',
                         },
@@ -119,6 +124,7 @@ def mock_db():
             'StatusDesc': 'Completed',
             'RightsDesc': 'Full',
             'DisplayStatusDesc':  'free',
+            'visible': True,
             'UnitText1': {'En': 'just a place' }})
     places.insert(PLACE_BIELSK_NOT_FOR_VIEWING)
     return db
@@ -0,0 +1,42 @@
+from bhs_api.cache import LRU, ItemCache
+from bhs_api.item import fetch_items
+
+
+def test_lru():
+    lru = LRU(size=2)
+    lru.set('a', 1, 60)
+    lru.set('b', 2, 60)
+    # touching `a` makes `b` the least recently used
+    assert lru.get('a') == 1
+    lru.set('c', 3, 60)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    # expired keys are gone
+    lru.set('d', 4, -1)
+    assert lru.get('d') is None
+
+
+def test_item_cache(app, mock_db):
+    app.item_cache = ItemCache(None, 3600)
+    with app.app_context():
+        res = fetch_items(['personality_tester', 'personality_no-one'])
+        assert res[0]['UnitId'] == 1
+        assert res[1]['error_code'] == 404
+        assert app.item_cache.stats['misses'] == 2
+        # changing the db doesn't change the cached items
+        mock_db['personalities'].update_one({'UnitId': 1},
+                                            {'$set': {'UnitText1.En': 'changed'}})
+        mock_db['personalities'].insert_one({'UnitId': 4,
+                                             'Slug': {'En': 'personality_no-one'}})
+        res = fetch_items(['personality_tester', 'personality_no-one'])
+        assert res[0]['UnitText1']['En'] == 'tester'
+        assert res[1] == {'slug': 'personality_no-one', 'error_code': 404,
+                          'msg': res[1]['msg']}
+        assert app.item_cache.stats['lru_hits'] == 2
+        # until they are invalidated
+        app.item_cache.invalidate(['personality_tester', 'personality_no-one'])
+        res = fetch_items(['personality_tester', 'personality_no-one'])
+        assert res[0]['UnitText1']['En'] == 'changed'
+        assert res[1]['error_code'] == 403
+        assert app.item_cache.stats['misses'] == 4
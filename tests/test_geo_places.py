@@ -3,6 +3,11 @@ import pytest
 from pytest_flask.plugin import client
 import urllib
 
+from bhs_api.geo import Box, find_places_in_box, MAX_POLYGON_SPAN
+from bhs_api.tiles import (build_pyramid, get_tile, get_cell, invalidate_tiles,
+                           get_changed_geometries,
+                           PYRAMID_ZOOM, STORED_ZOOM, TILES_COLLECTION)
+
 places_tester = [{
         'UnitId': 1000,
         'UnitText1': {'En': 'The Geo Place'},
@@ -11,6 +16,7 @@ places_tester = [{
         'StatusDesc': 'Completed',
         'RightsDesc': 'Full',
         'DisplayStatusDesc':  'free',
+        'visible': True,
         'PlaceTypeDesc': {'En': "Country"},
         'geometry': {'type': 'Point',
                      'coordinates': [10.01, 49.5]}
@@ -22,10 +28,71 @@ places_tester = [{
             'PlaceTypeDesc': {'En': "Country"},
             'StatusDesc': 'Completed',
             'RightsDesc': 'Full',
-            'DisplayStatusDesc':  'free'
+            'DisplayStatusDesc':  'free',
+            'visible': True,
+        },{
+            'UnitId': 3000,
+            'Header': {'En': 'test_far_place'},
+            'PlaceTypeDesc': {'En': "Country"},
+            'visible': True,
+            'geometry': {'type': 'Point',
+                         'coordinates': [34.78, 32.08]}
         }]
 
-def test_get_geo_places(client, app):
+@pytest.fixture
+def geo_filter(mocker):
+    # mongomock doesn't support geo queries, the exact filter is done in python
+    box_filter = lambda box: {'geometry': {'$exists': True}}
+    mocker.patch('bhs_api.tiles.get_box_filter', box_filter)
+    return mocker.patch('bhs_api.geo.get_box_filter', box_filter)
+
+def test_box_contains():
+    box = Box(48.3, 9.2, 51.4, 12.6)
+    assert box.contains(10.01, 49.5)
+    assert not box.contains(34.78, 32.08)
+    assert not box.contains(10.01, 52)
+    # crossing the antimeridian
+    box = Box(-20, 170, 20, -170)
+    assert box.contains(175, 0)
+    assert box.contains(-175, 0)
+    assert not box.contains(0, 0)
+    with pytest.raises(ValueError):
+        Box(10, 0, 0, 10)
+
+def test_box_geometries():
+    geometries = Box(-80, -180, 80, 180).get_geometries()
+    assert len(geometries) > 1
+    for geometry in geometries:
+        ring = geometry['coordinates'][0]
+        assert ring[0] == ring[-1]
+        lngs = [lng for lng, lat in ring]
+        assert all(-180 <= lng < 180 for lng in lngs)
+    geometries = Box(48.3, 9.2, 51.4, 12.6).get_geometries()
+    assert len(geometries) == 1
+    lngs = [lng for lng, lat in geometries[0]['coordinates'][0]]
+    assert max(lngs) - min(lngs) < MAX_POLYGON_SPAN
+
+def test_find_places_pages(app, geo_filter):
+    app.data_db['places'].insert(places_tester)
+    box = Box(-90, -180, 90, 180)
+    points, token = find_places_in_box(app.data_db, box, limit=1)
+    assert [p['Header']['En'] for p in points] == ['test_place']
+    assert token
+    points, token = find_places_in_box(app.data_db, box, token, limit=1)
+    assert [p['Header']['En'] for p in points] == ['test_far_place']
+    assert not token
+    with pytest.raises(ValueError):
+        find_places_in_box(app.data_db, box, 'badtoken')
+
+def test_find_places_exact_pages(app, geo_filter):
+    # the far place is first by id and out of the box
+    app.data_db['places'].insert([places_tester[2], places_tester[0]])
+    box = Box(48.3, 9.2, 51.4, 12.6)
+    points, token = find_places_in_box(app.data_db, box, limit=1)
+    assert [p['Header']['En'] for p in points] == ['test_place']
+    assert not token
+
+def test_get_geo_places(client, app, geo_filter):
     app.data_db['places'].insert(places_tester)
 
     url = '/v1/geo/places'
@@ -42,6 +109,21 @@ def test_get_geo_places(client, app):
     assert res.status_code == 200
     assert len(res.json) == 1
     assert res.json[0]['Header']['En'] == 'test_place'
+    assert 'Link' not in res.headers
+
+def test_get_geo_places_next_link(client, app, geo_filter):
+    app.data_db['places'].insert(places_tester)
+    with app.app_context():
+        res = client.get('/v1/geo/places?sw_lat=-90&sw_lng=-180&ne_lat=90&ne_lng=180&limit=1')
+        assert res.status_code == 200
+        assert len(res.json) == 1
+        link = res.headers['Link']
+        assert link.endswith('>; rel="next"')
+        next_url = link[1:link.index('>')].split('localhost', 1)[1]
+        res = client.get(next_url)
+    assert res.status_code == 200
+    assert res.json[0]['Header']['En'] == 'test_far_place'
+    assert 'Link' not in res.headers
 
 def test_get_geo_places_bad_param_value(client, app):
     app.data_db['places'].insert(places_tester)
@@ -76,3 +158,64 @@ def test_get_geo_places_bad_param_key(client, app):
     assert res.status_code == 400
 
 
+
+def test_build_pyramid(app):
+    app.data_db['places'].insert(places_tester)
+    # the two places share the tiles of the lowest zooms
+    count = build_pyramid(app.data_db)
+    assert PYRAMID_ZOOM + 1 < count < 2 * (PYRAMID_ZOOM + 1)
+    assert app.data_db[TILES_COLLECTION].count() == count
+    clusters = get_tile(app.data_db, 0, 0, 0)
+    assert len(clusters) == 2
+    assert all(c['count'] == 1 for c in clusters)
+    x, y = get_cell(10.01, 49.5, 5)
+    clusters = get_tile(app.data_db, 5, x, y)
+    assert clusters == [{'count': 1, 'centroid': [10.01, 49.5], 'slug': None}]
+
+def test_tile_clusters(app, geo_filter):
+    app.data_db['places'].insert([{
+        'Header': {'En': 'place_{}'.format(i)},
+        'Slug': {'En': 'place_place_{}'.format(i)},
+        'visible': True,
+        'geometry': {'type': 'Point', 'coordinates': [10 + i * 0.01, 49.5]}
+    } for i in range(3)])
+    # built on demand
+    clusters = get_tile(app.data_db, 0, 0, 0)
+    assert len(clusters) == 1
+    assert clusters[0]['count'] == 3
+    assert clusters[0]['slug'] == {'En': 'place_place_1'}
+    assert clusters[0]['centroid'][0] == pytest.approx(10.01)
+    assert app.data_db[TILES_COLLECTION].find_one({'_id': '0/0/0'})
+    invalidate_tiles(app.data_db, [{'type': 'Point', 'coordinates': [10, 49.5]}])
+    assert not app.data_db[TILES_COLLECTION].find_one({'_id': '0/0/0'})
+    # the empty tiles and the deepest tiles aren't stored
+    assert get_tile(app.data_db, 1, 1, 1) == []
+    z = STORED_ZOOM + 1
+    x, y = get_cell(10, 49.5, z)
+    assert get_tile(app.data_db, z, x, y)[0]['count'] == 1
+    assert app.data_db[TILES_COLLECTION].count() == 0
+    with pytest.raises(ValueError):
+        get_tile(app.data_db, 1, 2, 0)
+
+def test_changed_geometries():
+    point = {'type': 'Point', 'coordinates': [10, 49.5]}
+    moved = {'type': 'Point', 'coordinates': [11, 49.5]}
+    place = {'geometry': point, 'visible': True, 'Slug': {'En': 'place_a'},
+             'UnitText1': {'En': 'a'}}
+    assert get_changed_geometries(place, dict(place, UnitText1={'En': 'b'})) == []
+    assert get_changed_geometries(place, dict(place, geometry=moved)) == [point, moved]
+    assert get_changed_geometries(place, dict(place, visible=False)) == [point, point]
+    assert get_changed_geometries(place, dict(place, Slug={'En': 'place_b'})) == [point, point]
+    # created and deleted
+    assert get_changed_geometries(None, place) == [point]
+    assert get_changed_geometries(place, None) == [point]
+
+def test_get_geo_tile(client, app):
+    app.data_db['places'].insert(places_tester)
+    build_pyramid(app.data_db)
+    with app.app_context():
+        res = client.get('/v1/geo/tiles/0/0/0')
+        assert res.status_code == 200
+        assert sorted(c['count'] for c in res.json) == [1, 1]
+        res = client.get('/v1/geo/tiles/3/8/0')
+        assert res.status_code == 400
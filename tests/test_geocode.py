@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pytest
+
+from bhs_api.geocode import (geocode, geocode_place, normalize_query,
+                             StubGeocoder, RateLimitedGeocoder, GeocodeError,
+                             GEOCODE_COLLECTION, NEGATIVE_TTL)
+from scripts.get_places_geo import geocode_places
+
+
+class NoResultGeocoder(StubGeocoder):
+    def geocode(self, query):
+        self.calls += 1
+        return None
+
+
+class FailingGeocoder(StubGeocoder):
+    def geocode(self, query):
+        self.calls += 1
+        raise GeocodeError('down')
+
+
+def test_normalize_query():
+    assert normalize_query(u'  Tel   Aviv ') == u'tel aviv'
+    assert normalize_query(u'ＢＥＲＬＩＮ') == u'berlin'
+
+
+def test_geocode_cache(app):
+    geocoder = StubGeocoder()
+    geometry = geocode(app.data_db, geocoder, u'Berlin')
+    assert geometry['type'] == 'Point'
+    assert geocode(app.data_db, geocoder, 'berlin ') == geometry
+    assert geocoder.calls == 1
+
+
+def test_negative_cache(app):
+    geocoder = NoResultGeocoder()
+    assert geocode(app.data_db, geocoder, u'Atlantis') is None
+    assert geocode(app.data_db, geocoder, u'Atlantis') is None
+    assert geocoder.calls == 1
+    # the negative results expire
+    app.data_db[GEOCODE_COLLECTION].update_one(
+        {'_id': u'atlantis'},
+        {'$set': {'updated_at': datetime.utcnow() - NEGATIVE_TTL}})
+    geocode(app.data_db, geocoder, u'Atlantis')
+    assert geocoder.calls == 2
+
+
+def test_failures_are_not_cached(app):
+    geocoder = FailingGeocoder()
+    with pytest.raises(GeocodeError):
+        geocode(app.data_db, geocoder, u'Berlin')
+    assert app.data_db[GEOCODE_COLLECTION].count() == 0
+    with app.app_context():
+        assert geocode_place({'Header': {'En': 'Berlin'}}, geocoder=geocoder) is None
+
+
+def test_geocode_places(app):
+    # mongomock matches a missing header with $nin: [None]
+    app.data_db['places'].delete_many({})
+    app.data_db['places'].insert_many([
+        {'Header': {'En': 'place {}'.format(i)}, 'visible': True}
+        for i in range(10)])
+    app.data_db['places'].insert_one({'Header': {'En': 'hidden'},
+                                      'visible': False})
+    geocoder = StubGeocoder()
+    assert geocode_places(app.data_db, geocoder, workers=3, rate=1000) == (10, 0)
+    assert geocoder.calls == 10
+    assert app.data_db['places'].find({'geometry': None}).count() == 1
+    # all the places have a geometry now
+    assert geocode_places(app.data_db, geocoder, workers=3, rate=1000) == (0, 0)
+    assert geocoder.calls == 10
+
+
+def test_rate_limit():
+    geocoder = RateLimitedGeocoder(StubGeocoder(), 100)
+    started = datetime.utcnow()
+    for i in range(6):
+        geocoder.geocode(u'Berlin')
+    assert (datetime.utcnow() - started).total_seconds() >= 0.05
@@ -0,0 +1,67 @@
+import elasticsearch
+import mock
+
+from bhs_api.indexer import BulkIndexer, bulk_load
+
+
+def given_es(res=None):
+    es = mock.MagicMock()
+    es.bulk.return_value = res or {'errors': False}
+    return es
+
+
+def test_flush_by_size():
+    es = given_es()
+    indexer = BulkIndexer(es, max_actions=3)
+    for i in range(7):
+        indexer.index('bhdata', 'places', i, {'UnitId': i})
+    assert es.bulk.call_count == 2
+    assert len(es.bulk.call_args[1]['body']) == 6
+    indexer.flush()
+    assert es.bulk.call_count == 3
+    assert indexer.indexed == 7
+
+
+def test_flush_by_time():
+    es = given_es()
+    indexer = BulkIndexer(es, max_interval=0)
+    indexer.update('bhdata', 'places', 1, {'UnitId': 1})
+    es.bulk.assert_called_once_with(body=[
+        {'update': {'_index': 'bhdata', '_type': 'places', '_id': 1}},
+        {'doc': {'UnitId': 1}}])
+
+
+def test_item_errors():
+    es = given_es({'errors': True, 'items': [
+        {'index': {'_id': 1, 'status': 201}},
+        {'index': {'_id': 2, 'status': 400, 'error': 'mapper_parsing_exception'}}]})
+    indexer = BulkIndexer(es)
+    indexer.index('bhdata', 'places', 1, {'UnitId': 1})
+    indexer.index('bhdata', 'places', 2, {'UnitId': 2})
+    errors = indexer.flush()
+    assert [(action['index']['_id'], error) for action, error in errors] == \
+        [(2, 'mapper_parsing_exception')]
+    assert (indexer.indexed, indexer.failed) == (1, 1)
+    assert indexer.pop_indexed_types() == {'places'}
+    assert indexer.pop_indexed_types() == set()
+    # a failed request fails all the actions
+    es.bulk.side_effect = elasticsearch.ConnectionError('N/A', 'down', None)
+    indexer.index('bhdata', 'places', 3, {'UnitId': 3})
+    assert len(indexer.flush()) == 1
+    assert indexer.failed == 2
+    assert indexer.pop_indexed_types() == set()
+
+
+def test_bulk_load():
+    es = given_es()
+    es.indices.get_settings.return_value = {
+        'bhdata_v2': {'settings': {'index': {'refresh_interval': '30s'}}}}
+    indexer = BulkIndexer(es)
+    with bulk_load(indexer, 'bhdata'):
+        es.indices.put_settings.assert_called_once_with(
+            index='bhdata', body={'index': {'refresh_interval': '-1'}})
+        indexer.index('bhdata', 'places', 1, {'UnitId': 1})
+    assert es.bulk.called
+    es.indices.put_settings.assert_called_with(
+        index='bhdata', body={'index': {'refresh_interval': '30s'}})
+    es.indices.refresh.assert_called_once_with(index='bhdata')
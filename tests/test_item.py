@@ -1,7 +1,8 @@
 import pytest
-from bhs_api.item import enrich_item
+from bhs_api.item import enrich_item, enrich_items, _filter_doc
 
 from pytest_flask.plugin import client
+from werkzeug.exceptions import Forbidden
 
 # The documentation for client is at http://werkzeug.pocoo.org/docs/0.9/test/
 
@@ -33,3 +34,49 @@ def test_enrich_item_no_pictures(app, mock_db):
     with app.app_context():
         item = enrich_item({}, mock_db)
     assert 'main_image_url' not in item
+
+def test_enrich_items(app, mock_db):
+    mock_db['movies'].insert({'MovieFileId': 'V1',
+                              'MoviePath': 'movies/v1.mp4',
+                              'RightsDesc': 'Full',
+                              'StatusDesc': 'Completed',
+                              'DisplayStatusDesc': 'free'})
+    items = [{'MovieFileId': 'V1'},
+             {'MovieFileId': 'V2'},
+             {'Pictures': [{'PictureId': 'ID'}]}]
+    with app.app_context():
+        enrich_items([(item, 'movies') for item in items], mock_db)
+    assert items[0]['video_url'] == \
+               'https://storage.googleapis.com/bhs-movies/V1.mp4'
+    assert 'video_url' not in items[1]
+    assert items[2]['thumbnail_url'] == \
+               'https://storage.googleapis.com/bhs-thumbnails/ID.jpg'
+
+def test_filter_doc_without_visible(app, mock_db):
+    # docs migrated before `visible` was stored fall back to the show filter
+    mock_db['places'].insert({'UnitId': 1,
+                              'RightsDesc': 'Full',
+                              'StatusDesc': 'Completed',
+                              'DisplayStatusDesc': 'free',
+                              'UnitText1': {'En': 'text'}})
+    mock_db['places'].insert({'UnitId': 2,
+                              'RightsDesc': 'Full',
+                              'StatusDesc': 'Edit',
+                              'DisplayStatusDesc': 'free',
+                              'UnitText1': {'En': 'text'}})
+    mock_db['places'].insert({'UnitId': 3,
+                              'StatusDesc': 'Edit',
+                              'visible': True})
+    mock_db['places'].insert({'UnitId': 4,
+                              'RightsDesc': 'Full',
+                              'StatusDesc': 'Completed',
+                              'DisplayStatusDesc': 'free',
+                              'UnitText1': {'En': 'text'},
+                              'visible': False})
+    with app.app_context():
+        assert _filter_doc({'UnitId': 1}, 'places', mock_db)['UnitId'] == 1
+        with pytest.raises(Forbidden):
+            _filter_doc({'UnitId': 2}, 'places', mock_db)
+        assert _filter_doc({'UnitId': 3}, 'places', mock_db)['UnitId'] == 3
+        with pytest.raises(Forbidden):
+            _filter_doc({'UnitId': 4}, 'places', mock_db)
@@ -1,12 +1,31 @@
 # coding: utf-8
 import json
+import pytest
 import boto
 import elasticsearch
 import requests
-from migration.tasks import update_doc, update_tree
-from migration.files import upload_file
+import time
+import redis
+from pymongo.errors import BulkWriteError
+from migration.throttle import QueueThrottle
+from migration.tasks import (update_doc, update_docs, update_tree, update_staged_rows,
+                             get_tree_version, tree_versions_cache, carry_forward_persons,
+                             invalidate_suggestions)
+from migration.tree_diff import TreeDiff, get_content_hash, get_previous_hashes
+from migration.payload import stage_docs, load_staged_docs
+from bhs_api.indexer import get_indexer
+from migration.files import PhotoUploader
+from migration.thumbnails import ThumbnailStore
+from migration.storage import get_storage, LocalStorage, GSStorage
+from migration.upload_manifest import UploadManifest
+from bhs_api.utils import binarize_image
+from migration.thumbnail_sync import diff_listings, ThumbnailSync, MISSING, ORPHAN
+from StringIO import StringIO
+from PIL import Image
+import os
 from test_search import given_local_elasticsearch_client_with_test_data
 from scripts.ensure_required_metadata import EnsureRequiredMetadataCommand
+from scripts.dump_mongo_to_es import MongoToEsDumper
 from copy import deepcopy
 from mocks import PLACE_BIELSK_NOT_FOR_VIEWING
 
@@ -69,7 +88,7 @@ def test_update_doc(mocker, app):
     ''' This function tests the simplest case for
         migration.tasks.update_doc function
     '''
-    mocker.patch('elasticsearch.Elasticsearch.index')
+    mocker.patch('elasticsearch.Elasticsearch.bulk', return_value={'errors': False})
     collection = app.data_db['personalities']
     with app.app_context():
         # make sure the document does not exist in mongo
@@ -79,51 +98,102 @@ def test_update_doc(mocker, app):
         doc =  collection.find_one({'UnitId':1000})
         assert doc['UnitText1']['En'] == 'The Tester'
         assert doc["UnitId"] == 1000
+        assert doc['visible'] == True
         # check in elasticsearch
         expected_elasticsearch_body = dict(deepcopy(THE_TESTER),
                                            Header={"En": "Nik Nikos", "He": "_"},
                                            Slug={"En": "luminary_nik-nikos"},
                                            related=["place_some"])
-        elasticsearch.Elasticsearch.index.assert_called_once_with(body=expected_elasticsearch_body,
-                                                                  doc_type='personalities',
-                                                                  id=1000,
-                                                                  index='bhdata',)
+        # the doc is indexed in bulk
+        assert not elasticsearch.Elasticsearch.bulk.called
+        assert get_indexer(app.es).flush() == []
+        elasticsearch.Elasticsearch.bulk.assert_called_once_with(body=[
+            {'index': {'_index': 'bhdata', '_type': 'personalities', '_id': 1000}},
+            expected_elasticsearch_body])
 
 def test_updated_doc(mocker, app):
     ''' testing a creation and an update, ensuring uniquness '''
-    mocker.patch('elasticsearch.Elasticsearch.index')
-    mocker.patch('elasticsearch.Elasticsearch.update')
+    mocker.patch('elasticsearch.Elasticsearch.bulk', return_value={'errors': False})
     collection = app.data_db['personalities']
     with app.app_context():
         the_tester = deepcopy(THE_TESTER)
         update_doc(collection, the_tester)
         assert collection.find_one({'UnitId':1000})['Slug']['En'] == "luminary_nik-nikos"
-        elasticsearch.Elasticsearch.index.assert_called_once_with(
-            index="bhdata", doc_type="personalities", id=1000,
-            body = dict(deepcopy(THE_TESTER),
-                        Header={"En": "Nik Nikos", "He": "_"},
-                        Slug={"En": "luminary_nik-nikos"},
-                        related=["place_some"])
-        )
         updated_tester = deepcopy(the_tester)
         updated_tester['Header']['En'] = 'Nikos Nikolveich'
         updated_tester['UnitText1']['En'] = 'The Great Tester'
         update_doc(collection, updated_tester)
-        elasticsearch.Elasticsearch.update.assert_called_once_with(
-            index = 'bhdata', doc_type = 'personalities', id = 1000,
-            body = dict(deepcopy(THE_TESTER),
-                        Header={"En": "Nikos Nikolveich", "He": "_"},
-                        Slug={"En": "luminary_nik-nikos"},
-                        related=["place_some"],
-                        UnitText1={"En": "The Great Tester"})
-        )
+        get_indexer(app.es).flush()
+        action = {'_index': 'bhdata', '_type': 'personalities', '_id': 1000}
+        elasticsearch.Elasticsearch.bulk.assert_called_once_with(body=[
+            {'index': action},
+            dict(deepcopy(THE_TESTER),
+                 Header={"En": "Nik Nikos", "He": "_"},
+                 Slug={"En": "luminary_nik-nikos"},
+                 related=["place_some"]),
+            {'update': action},
+            {'doc': dict(deepcopy(THE_TESTER),
+                         Header={"En": "Nikos Nikolveich", "He": "_"},
+                         Slug={"En": "luminary_nik-nikos"},
+                         related=["place_some"],
+                         UnitText1={"En": "The Great Tester"})},
+        ])
+
+
+def test_update_hidden_doc(mocker, app):
+    mocker.patch('elasticsearch.Elasticsearch.bulk')
+    collection = app.data_db['personalities']
+    with app.app_context():
+        update_doc(collection, dict(deepcopy(THE_TESTER), StatusDesc='Edit'))
+        assert collection.find_one({'UnitId':1000})['visible'] == False
+        # hidden docs are not indexed
+        get_indexer(app.es).flush()
+        assert not elasticsearch.Elasticsearch.bulk.called
+
+
+def test_update_docs(mocker, app):
+    mocker.patch('elasticsearch.Elasticsearch.bulk', return_value={'errors': False})
+    collection = app.data_db['personalities']
+    with app.app_context():
+        update_doc(collection, deepcopy(THE_TESTER))
+        updated_tester = dict(deepcopy(THE_TESTER), UnitText1={'En': 'The Great Tester'})
+        new_tester = dict(deepcopy(THE_TESTER), UnitId=1001, Header={'En': 'Nik Nikos II'})
+        repeated_tester = dict(deepcopy(new_tester), UnitText1={'En': 'The Second'})
+        update_docs(collection, [updated_tester, new_tester, repeated_tester])
+        get_indexer(app.es).flush()
+    assert collection.find_one({'UnitId': 1000})['UnitText1']['En'] == 'The Great Tester'
+    assert collection.find_one({'UnitId': 1000})['Slug']['En'] == 'luminary_nik-nikos'
+    assert collection.count({'UnitId': 1001}) == 1
+    doc = collection.find_one({'UnitId': 1001})
+    assert doc['UnitText1']['En'] == 'The Second'
+    assert doc['Slug']['En'] == 'luminary_nik-nikos-ii'
+    body = elasticsearch.Elasticsearch.bulk.call_args[1]['body']
+    assert [action.keys()[0] for action in body[::2]] == ['index', 'update', 'index', 'index']
+
+
+def test_update_docs_duplicate_slug(mocker, app):
+    mocker.patch('elasticsearch.Elasticsearch.bulk', return_value={'errors': False})
+    collection = app.data_db['personalities']
+    bulk = mocker.MagicMock()
+    bulk.execute.side_effect = BulkWriteError({'writeErrors': [
+        {'index': 0, 'code': 11000, 'errmsg': 'duplicate key'}]})
+    mocker.patch.object(collection, 'initialize_unordered_bulk_op', return_value=bulk)
+    with app.app_context():
+        update_docs(collection, [deepcopy(THE_TESTER)])
+        get_indexer(app.es).flush()
+    assert collection.find_one({'UnitId': 1000})['Slug']['En'] == 'luminary_nik-nikos-1000'
 
 
 def test_update_photo(mocker):
     mocker.patch('boto.storage_uri')
-    mocker.patch('boto.storage_uri')
-    upload_file('from', 'to_bucket', 'to_key')
+    photo = StringIO('photo')
+    GSStorage('to_bucket').upload('to_key', photo, {'path': 'from'})
     boto.storage_uri.assert_called_once_with('to_bucket/to_key', 'gs')
+    key = boto.storage_uri.return_value.new_key.return_value
+    key.update_metadata.assert_called_once_with({'path': 'from'})
+    # made public by the upload itself
+    key.set_contents_from_file.assert_called_once_with(photo, policy='public-read')
+    assert key.make_public.call_count == 0
 
 def test_update_tree(app):
 
@@ -197,6 +267,15 @@ def test_update_place(mocker, app):
 
     doc =  collection.find_one({'UnitId':2000})
     assert doc['geometry'] == 'geo'
+    # re-migrating the place uses the geocode cache
+    with app.app_context():
+        update_doc(collection, {
+            'UnitId': 2000,
+            'UnitText1': {'En': "Oh la la!"},
+            'Header': {'En': ' paris'},
+        })
+    assert requests.get.call_count == 1
+    assert collection.find_one({'UnitId':2000})['geometry'] == 'geo'
 
 
 def test_ensure_metadata(app, mock_db):
@@ -270,3 +349,296 @@ def test_ensure_metadata(app, mock_db):
     # person has first_name / last_name fields (added during migration process for elasticsearch indexing)
     assert [h["first_name_lc"] for h in es_search(app, "persons", "person_id:I3")] == ["deady"]
     assert [h["last_name_lc"] for h in es_search(app, "persons", "person_id:I3")] == ["deadead"]
+
+
+def test_queue_throttle(mocker):
+    mocker.patch('time.sleep')
+    broker = mocker.MagicMock()
+    # the queue is full twice before the workers catch up
+    broker.llen.side_effect = [1, 3, 3, 2]
+    throttle = QueueThrottle(broker, max_in_flight=3)
+    throttle.sent()
+    assert not time.sleep.called
+    throttle.sent()
+    assert time.sleep.call_count == 2
+    assert throttle.produced == 2
+    # an unreachable broker doesn't stop the migration
+    broker.llen.side_effect = redis.ConnectionError()
+    throttle.sent()
+    assert throttle.produced == 3
+
+
+def test_invalidate_suggestions(mocker, app):
+    app.es = mocker.MagicMock()
+    app.redis = mocker.MagicMock()
+    clear = mocker.patch('migration.tasks.clear_suggestions', return_value=2)
+    invalidate_suggestions(app, set())
+    assert not clear.called
+    # the index is refreshed before the suggestions are dropped
+    invalidate_suggestions(app, {'places'})
+    app.es.indices.refresh.assert_called_once_with(index=app.es_data_db_index_name)
+    clear.assert_called_once_with(app.redis, {'places'})
+    # an unreachable redis doesn't fail the task
+    clear.side_effect = redis.ConnectionError()
+    invalidate_suggestions(app, {'places'})
+
+
+def test_dump_mongo_to_es(mocker, mock_db):
+    es = mocker.MagicMock()
+    es.bulk.return_value = {'errors': False}
+    doc = deepcopy(THE_TESTER)
+    doc.update({'_id': 'id1', 'Header': {'En': 'Nik Nikos', 'He': None},
+                'UnitHeaderDMSoundex': None, 'visible': True,
+                'dms_codes': {'En': ['463900']}, 'content_hash': 'abc'})
+    dumper = MongoToEsDumper(es, 'bhdata', mock_db)
+    dumper._process_doc('personalities', doc)
+    dumper.indexer.flush()
+    body = es.bulk.call_args[1]['body'][1]
+    assert not set(body) & {'_id', 'visible', 'dms_codes', 'content_hash'}
+
+
+def test_update_staged_rows(mocker, app, tmpdir):
+    mocker.patch('elasticsearch.Elasticsearch.bulk', return_value={'errors': False})
+    path = stage_docs([deepcopy(THE_TESTER)], str(tmpdir))
+    assert load_staged_docs(path) == [THE_TESTER]
+    mocker.patch('migration.tasks.celery.data_db', app.data_db)
+    with app.app_context():
+        update_staged_rows.run(path, 'personalities')
+        get_indexer(app.es).flush()
+    assert app.data_db['personalities'].find_one({'UnitId': 1000})
+    assert tmpdir.listdir() == []
+
+
+def test_update_staged_rows_failed(mocker, app, tmpdir):
+    path = stage_docs([deepcopy(THE_TESTER)], str(tmpdir))
+    mocker.patch('migration.tasks.celery.data_db', app.data_db)
+    mocker.patch('migration.tasks.update_docs', side_effect=ValueError('oops'))
+    with app.app_context():
+        # called directly, the retry raises the error
+        with pytest.raises(ValueError):
+            update_staged_rows.run(path, 'personalities')
+    # the chunk is kept for the retry
+    assert load_staged_docs(path) == [THE_TESTER]
+
+
+def test_person_tree_version(mocker, app):
+    mocker.patch('elasticsearch.Elasticsearch.bulk', return_value={'errors': False})
+    app.redis = mocker.MagicMock()
+    app.redis.get.return_value = None
+    app.data_db['trees'].insert({'num': 7, 'versions': [{'file_id': 'a'}, {'file_id': 'b'}]})
+    assert get_tree_version(app.data_db['trees'], 7, 'b') == 1
+    assert get_tree_version(app.data_db['trees'], 7, 'c') == 2
+    assert get_tree_version(app.data_db['trees'], 8, 'a') == 0
+    persons = app.data_db['persons']
+    with app.app_context():
+        # the version resolved by the producer
+        update_doc(persons, {'id': 'I1', 'tree_num': 7, 'tree_file_id': 'b',
+                             'tree_version': 1})
+        assert not app.redis.get.called
+        # looked up once per worker
+        tree_versions_cache.delete(7)
+        update_docs(persons, [{'id': 'I{}'.format(i), 'tree_num': 7,
+                               'tree_file_id': 'b'} for i in range(2, 5)])
+        get_indexer(app.es).flush()
+    assert app.redis.get.call_count == 1
+    assert persons.count({'tree_num': 7, 'tree_version': 1}) == 4
+
+
+def test_tree_diff(app):
+    person = {'id': 'I1', 'name': ['a', 'b'], 'tree_num': 7, 'tree_size': 3,
+              'tree_version': 0, 'parents': [{'id': 'I2'}]}
+    # the version fields don't change the hash
+    assert get_content_hash(person) == get_content_hash(
+        dict(person, tree_size=4, tree_version=1, tree_file_id='b'))
+    assert get_content_hash(person) != get_content_hash(
+        dict(person, parents=[{'id': 'I3'}]))
+    persons = app.data_db['persons']
+    persons.insert_many([
+        {'id': 'I1', 'tree_num': 7, 'tree_version': 0, 'content_hash': get_content_hash(person)},
+        {'id': 'I2', 'tree_num': 7, 'tree_version': 0, 'content_hash': 'old'},
+        # migrated before the hashes
+        {'id': 'I3', 'tree_num': 7, 'tree_version': 0},
+        {'id': 'I4', 'tree_num': 7, 'tree_version': 0, 'content_hash': 'removed'},
+    ])
+    assert get_previous_hashes(persons, 8, 0) == (None, {})
+    base_version, hashes = get_previous_hashes(persons, 7, 1)
+    assert base_version == 0
+    assert len(hashes) == 4
+    diff = TreeDiff(hashes)
+    assert diff.add(dict(person, tree_version=1, tree_size=4)) == False
+    assert diff.add({'id': 'I2', 'name': ['c']}) == True
+    assert diff.add({'id': 'I3', 'name': ['d']}) == True
+    new_person = {'id': 'I5', 'name': ['e']}
+    assert diff.add(new_person) == True
+    assert new_person['content_hash'] == get_content_hash(new_person)
+    assert diff.unchanged == ['I1']
+    assert diff.get_report() == {'added': 1, 'changed': 2, 'unchanged': 1,
+                                 'removed': 1}
+
+
+def test_carry_forward_persons(mocker, app):
+    bulk = mocker.patch('elasticsearch.Elasticsearch.bulk',
+                        return_value={'errors': False})
+    persons = app.data_db['persons']
+    persons.insert_many([{'id': 'I{}'.format(i), 'tree_num': 9,
+                          'tree_version': 0, 'tree_file_id': 'a',
+                          'tree_size': 3, 'archived': True,
+                          'name': ['deady', 'deadead'], 'name_lc': ['deady', 'deadead'],
+                          'deceased': True, 'content_hash': str(i),
+                          'Slug': {'En': 'person_9;0.I{}'.format(i)}}
+                         for i in range(3)])
+    mocker.patch('migration.tasks.celery.data_db', app.data_db)
+    with app.app_context():
+        carry_forward_persons.run(9, 0, 1, ['I0', 'I2'],
+                                  {'tree_file_id': 'b', 'tree_size': 5})
+        get_indexer(app.es).flush()
+    # the old version is kept
+    assert persons.count({'tree_num': 9, 'tree_version': 0}) == 3
+    copies = list(persons.find({'tree_num': 9, 'tree_version': 1}))
+    assert sorted(doc['id'] for doc in copies) == ['I0', 'I2']
+    doc = copies[0]
+    assert doc['Slug'] == {'En': 'person_9;1.{}'.format(doc['id'])}
+    assert doc['tree_file_id'] == 'b'
+    assert doc['tree_size'] == 5
+    assert doc['content_hash'] == doc['id'][1:]
+    assert 'archived' not in doc
+    body = bulk.call_args[1]['body']
+    assert sorted(action['index']['_id'] for action in body[::2]) == ['9_1_I0', '9_1_I2']
+    assert 'content_hash' not in body[1]
+
+
+def test_thumbnails(mocker, tmpdir):
+    photos = []
+    for i, (size, mode) in enumerate([((2000, 1500), 'RGB'), ((300, 600), 'P')]):
+        path = str(tmpdir.join('photo{}.{}'.format(i, 'jpg' if mode == 'RGB' else 'png')))
+        Image.new(mode, size).save(path)
+        photos.append(path)
+    broken = tmpdir.join('broken.jpg')
+    broken.write('not a photo')
+    thumbnails = ThumbnailStore(str(tmpdir.join('thumbnails')), workers=2)
+    thumbnails.prepare(photos + [str(broken)])
+    assert thumbnails.failed == set([str(broken)])
+    assert thumbnails.get(str(broken)) is None
+    sizes = []
+    for path in photos:
+        thumbnail = Image.open(thumbnails.get_path(path))
+        assert thumbnail.format == 'JPEG'
+        sizes.append(thumbnail.size)
+    assert sizes == [(260, 195), (130, 260)]
+    # the thumbnails of the unchanged photos aren't made again
+    make_thumbnail = mocker.patch('migration.thumbnails.make_thumbnail',
+                                  return_value='thumbnail')
+    thumbnails = ThumbnailStore(str(tmpdir.join('thumbnails')), workers=1)
+    thumbnails.prepare(photos)
+    assert thumbnails.get(photos[0]).startswith('\xff\xd8')
+    assert make_thumbnail.call_count == 0
+    os.utime(photos[0], (0, 0))
+    assert thumbnails.get(photos[0]) == 'thumbnail'
+    make_thumbnail.assert_called_once_with(photos[0])
+
+
+def test_binarize_image():
+    image = StringIO()
+    Image.new('RGBA', (520, 520)).save(image, 'PNG')
+    image.seek(0)
+    binary = binarize_image(image)
+    assert image.tell() == 0
+    assert Image.open(StringIO(binary)).size == (260, 260)
+    assert binarize_image(StringIO('not an image')) is None
+
+
+def test_local_storage(tmpdir):
+    storage = get_storage('file://' + str(tmpdir))
+    assert isinstance(storage, LocalStorage)
+    for name in ('b', 'a/c', 'a-b', 'a/b/d'):
+        storage.upload(name, StringIO(name))
+    # sorted like the names of a bucket
+    assert list(storage.list()) == ['a-b', 'a/b/d', 'a/c', 'b']
+    content = StringIO()
+    storage.download('a/b/d', content)
+    assert content.getvalue() == 'a/b/d'
+
+
+def test_photo_uploader(tmpdir):
+    mount = tmpdir.mkdir('mount')
+    photos_dir = mount.mkdir('Photos')
+    docs = []
+    for i in range(3):
+        Image.new('RGB', (400, 300)).save(str(photos_dir.join('p{}.JPG'.format(i))))
+        docs.append({'PictureId': 'id{}'.format(i), 'PictureFileName': 'p{}.JPG'.format(i),
+                     'PicturePath': 'Photos\\p{}.JPG'.format(i)})
+    # missing
+    docs.append({'PictureId': 'id3', 'PictureFileName': 'p3.JPG', 'PicturePath': 'Photos\\p3.JPG'})
+    photos = LocalStorage(str(tmpdir.join('bucket')))
+    thumbs = LocalStorage(str(tmpdir.join('thumbs')))
+
+    def upload():
+        manifest = UploadManifest(str(tmpdir.join('manifest', 'uploads.sqlite')))
+        uploader = PhotoUploader(photos, thumbs, str(mount),
+                                 ThumbnailStore(str(tmpdir.join('thumbnails'))),
+                                 manifest, workers=2)
+        counts = uploader.upload(docs)
+        manifest.close()
+        return counts
+
+    assert upload() == {'uploaded': 3, 'failed': 1}
+    assert list(photos.list()) == ['id0.jpg', 'id1.jpg', 'id2.jpg']
+    assert list(thumbs.list()) == ['id0.jpg', 'id1.jpg', 'id2.jpg']
+    assert Image.open(thumbs.uri('id0.jpg')).size == (260, 195)
+    # only the changed photos are uploaded again
+    assert upload() == {'unchanged': 3, 'failed': 1}
+    Image.new('RGB', (400, 400), 'red').save(str(photos_dir.join('p1.JPG')))
+    assert upload() == {'uploaded': 1, 'unchanged': 2, 'failed': 1}
+    assert Image.open(photos.uri('id1.jpg')).size == (400, 400)
+    assert Image.open(thumbs.uri('id1.jpg')).size == (260, 260)
+
+
+def test_diff_listings():
+    assert list(diff_listings(['a', 'b', 'd', 'e'], ['b', 'c', 'e', 'f'])) == \
+        [('a', MISSING), ('c', ORPHAN), ('d', MISSING), ('f', ORPHAN)]
+    assert list(diff_listings(iter(['a']), iter([]))) == [('a', MISSING)]
+    with pytest.raises(ValueError):
+        list(diff_listings(['b', 'a'], []))
+
+
+def test_thumbnail_sync(tmpdir):
+    photos = LocalStorage(str(tmpdir.join('photos')))
+    thumbs = LocalStorage(str(tmpdir.join('thumbs')))
+    for name in ('a.jpg', 'b.jpg', 'c.png', 'd.jpg'):
+        content = StringIO()
+        Image.new('RGB', (520, 260)).save(content, 'JPEG' if name.endswith('jpg') else 'PNG')
+        content.seek(0)
+        photos.upload(name, content)
+    photos.upload('broken.jpg', StringIO('not a photo'))
+    thumbs.upload('b.jpg', StringIO('thumbnail'))
+    thumbs.upload('orphan.jpg', StringIO('thumbnail'))
+    state = str(tmpdir.join('state.json'))
+    sync = ThumbnailSync(photos, thumbs, workers=2, state_path=state, batch_size=2)
+    assert list(sync.diff()) == [('a.jpg', MISSING), ('broken.jpg', MISSING),
+                                 ('c.png', MISSING), ('d.jpg', MISSING),
+                                 ('orphan.jpg', ORPHAN)]
+    # a dry run doesn't change the buckets
+    assert list(thumbs.list()) == ['b.jpg', 'orphan.jpg']
+    assert sync.run() == {'added': 3, 'failed': 1}
+    assert list(thumbs.list()) == ['a.jpg', 'b.jpg', 'c.png', 'd.jpg', 'orphan.jpg']
+    assert Image.open(thumbs.uri('c.png')).size == (260, 130)
+    assert Image.open(thumbs.uri('c.png')).format == 'JPEG'
+    # a complete run leaves nothing to resume
+    assert not os.path.exists(state)
+    os.remove(thumbs.uri('a.jpg'))
+    os.remove(thumbs.uri('c.png'))
+    # an interrupted run is resumed after the last name it reached
+    with open(state, 'w') as f:
+        json.dump({'last_name': 'b.jpg'}, f)
+    sync = ThumbnailSync(photos, thumbs, state_path=state)
+    assert sync.last_name == 'b.jpg'
+    assert list(sync.diff()) == [('broken.jpg', MISSING), ('c.png', MISSING),
+                                 ('orphan.jpg', ORPHAN)]
+    assert sync.run() == {'added': 1, 'failed': 1}
+    assert not os.path.exists(state)
+    # and the next run starts over
+    sync = ThumbnailSync(photos, thumbs, state_path=state)
+    assert sync.last_name is None
+    assert list(sync.diff())[:2] == [('a.jpg', MISSING), ('broken.jpg', MISSING)]
+    assert sync.run() == {'added': 1, 'failed': 1}
+    assert os.path.exists(thumbs.uri('a.jpg'))
@@ -4,6 +4,7 @@ import pytest
 from datetime import datetime
 
 from bhs_api.fsearch import fsearch, clean_person, build_query, build_search_dict
+from bhs_api.item import get_visible_filter
 
 # The documentation for client is at http://werkzeug.pocoo.org/docs/0.9/test/
 
@@ -197,6 +198,22 @@ def test_get_persons(client, mock_db):
             'Slug': {'En': 'person_1;0.I1'},
             'bio': 'yossi is a big boy'
             })
+    # the migration invalidates the cached items it updates
+    client.application.item_cache.invalidate(['person_1;0.I1'])
     res = client.get('/v1/item/person_1;0.I1')
     assert res.status_code == 200
     assert res.json[0]['bio'] == 'yossi is a big boy' # this will FAIL in the year 2100
+
+
+def test_persons_visible_filter(mock_db):
+    this_year = datetime.now().year
+    mock_db['persons'].drop()
+    for i, (visible, birth_year) in enumerate([(True, this_year - 20),
+                                                 (False, this_year - 20),
+                                                 # got old since migrated
+                                                 (False, this_year - 120)]):
+        mock_db['persons'].insert({'id': 'I{}'.format(i),
+                                   'visible': visible,
+                                   'birth_year': birth_year})
+    found = mock_db['persons'].find(get_visible_filter('persons'))
+    assert sorted(doc['id'] for doc in found) == ['I0', 'I2']
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+from bhs_api import hebrew_dm
+from bhs_api.phonetic import (get_bhp_soundex, dm_soundex, dm_soundex_many,
+                              get_header_dms_codes, get_similar_strings)
+
+# the codes returned by hebrew_dm_server.js
+NODE_CODES = [
+    (u'ירושלים', u'194860 197486'),
+    (u'כהן', u'556000 560000'),
+    (u'שטיינברג', u'267950 436795'),
+    (u'ווייס', u'740000'),
+    (u'תל אביב', u'380000 077000'),
+    (u'משה בן מימון', u'640000 760000 666000'),
+    (u' כהן ', u'556000 560000 '),
+    (u'יייה', u'000000'),
+]
+
+
+def test_hebrew_dm():
+    for name, code in NODE_CODES:
+        assert hebrew_dm.encode(name) == code
+    assert hebrew_dm.encode(u'כהן'.encode('utf8')) == u'556000 560000'
+    names = [name for name, code in NODE_CODES]
+    assert hebrew_dm.encode_many(names + names) == \
+        [code for name, code in NODE_CODES] * 2
+
+
+def test_bhp_soundex():
+    assert get_bhp_soundex(u'ירושלים') == u'ZZ H194860 H197486\n ZZ '
+
+
+def test_dm_soundex_corpus():
+    corpus = os.path.join(os.path.dirname(__file__), 'dm_soundex_corpus.txt')
+    with io.open(corpus, encoding='utf8') as f:
+        lines = [line.rstrip(u'\n').split(u'\t') for line in f
+                 if not line.startswith(u'#')]
+    words = [word for word, codes in lines]
+    for (word, codes), dms in zip(lines, dm_soundex_many(words)):
+        assert u' '.join(sorted(dms)) == codes
+    # and again from the cache
+    for word, codes in lines:
+        assert u' '.join(sorted(dm_soundex(word))) == codes
+
+
+def test_dm_soundex_options():
+    assert dm_soundex('Schwartz', 8) == set(['47940000'])
+    assert dm_soundex('Schwartz', reverse=True) == set(['439740'])
+    assert dm_soundex('Schwartz', zero_pad=False) == set(['4794'])
+    assert dm_soundex('', zero_pad=False) == set(['0'])
+    assert dm_soundex('Katz', 3) == set(['540000'])
+    # the returned sets are not the cached ones
+    dm_soundex('Katz').add('nope')
+    assert dm_soundex('Katz') == set(['540000'])
+
+
+def test_similar_strings(mock_db):
+    families = mock_db['familyNames']
+    for i, (header, visible) in enumerate([('Schwartz', True),
+                                           ('Schwarz', True),
+                                           ('Shvarts', False),
+                                           ('Cohen', True)]):
+        families.insert({'UnitId': i,
+                         'Header': {'En': header},
+                         'UnitText1': {'En': 'a family'},
+                         'visible': visible,
+                         'dms_codes': get_header_dms_codes(
+                             {'En': get_bhp_soundex(header)})})
+    assert families.find_one({'UnitId': 0})['dms_codes'] == {'En': ['479400']}
+    assert sorted(get_similar_strings('Shwarts', families)) == \
+        ['schwartz', 'schwarz']
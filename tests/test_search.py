@@ -97,7 +97,9 @@ def assert_suggest_response(client, collection, string,
         assert expected_error_message in res.data
     if expected_json is not None:
         print(res.json)
-        assert expected_json == res.json
+        res_json = dict(res.json)
+        assert isinstance(res_json.pop('took'), int)
+        assert expected_json == res_json
 
 ### utility functions
 
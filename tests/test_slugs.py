@@ -41,8 +41,33 @@ def test_person_collection(client, mock_db):
     res = fetch_items(['person_1'], mock_db)
     assert res[0]['error_code'] == 404
 
-def test_multi_collections(client):
-    pass
+def test_multi_collections(client, mock_db):
+    res = fetch_items(['place_some', 'personality_tester', 'hello',
+                       'person_1;0.I3', 'personality_another-tester'], mock_db)
+    assert len(res) == 5
+    assert res[0]['Slug']['En'] == 'place_some'
+    assert res[1]['Slug']['En'] == 'personality_tester'
+    assert res[2] == {'slug': 'hello', 'error_code': 404,
+                      'msg': "missing an underscore in item's slug"}
+    assert res[3]['name_lc'][0] == 'deady'
+    assert res[4]['error_code'] == 403
+
+def test_movies(client, app, mock_db):
+    movie = {'StatusDesc': 'Completed',
+             'RightsDesc': 'Full',
+             'DisplayStatusDesc':  'free',
+             'UnitText1': {'En': 'a movie'}}
+    mock_db['movies'].insert_many([
+        dict(movie, UnitId=4, Slug={'En': 'video_some'}, MovieFileId='V1',
+             MoviePath='movies/v1.mp4'),
+        dict(movie, UnitId=5, Slug={'En': 'video_other'}, MovieFileId='V2',
+             MoviePath=None),
+    ])
+    with app.app_context():
+        res = fetch_items(['video_some', 'video_other'], mock_db)
+    assert res[0]['video_url'] == \
+        'https://storage.googleapis.com/bhs-movies/V1.mp4'
+    assert res[1]['error_code'] == 404
 
 def test_old_person_slug():
     s = Slug("person_8888.I1")
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from fnmatch import fnmatch
+
+import mock
+
+from bhs_api.cache import LRU
+from bhs_api.suggest import (get_cached_completion, get_hot_prefixes,
+                             normalize_prefix, warm_suggestions,
+                             clear_suggestions)
+
+
+class MockRedis(object):
+    ''' just enough of redis for the suggestions cache '''
+
+    def __init__(self):
+        self.lru = LRU()
+
+    def get(self, key):
+        return self.lru.get(key)
+
+    def set(self, key, value, ex=None):
+        self.lru.set(key, value, ex)
+
+    def scan_iter(self, match):
+        return [key for key in self.lru._data.keys() if fnmatch(key, match)]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.lru.delete(key)
+
+
+def given_suggest_app(app):
+    app.redis = MockRedis()
+    app.es = mock.Mock()
+    app.es.search.return_value = {
+        'took': 3,
+        'suggest': {'header': [{'options': [
+            {'_source': {'Header': {'En': 'Tester'}}}]}]}}
+    return app
+
+
+def test_normalize_prefix():
+    assert normalize_prefix(u'  Te  St ') == u'te st '
+
+
+def test_cached_completion(app):
+    given_suggest_app(app)
+    with app.app_context():
+        assert get_cached_completion('personalities', 'Te') == \
+            (['Tester'], [], 3)
+        # same prefix, served from the cache
+        assert get_cached_completion('personalities', ' te') == \
+            (['Tester'], [], 0)
+        assert app.es.search.call_count == 1
+        get_cached_completion('personalities', 'te', size=3)
+        assert app.es.search.call_count == 2
+
+
+def test_completion_without_redis(app):
+    given_suggest_app(app)
+    app.redis = None
+    with app.app_context():
+        assert get_cached_completion('personalities', 'Te') == \
+            (['Tester'], [], 3)
+        assert warm_suggestions() == 0
+        assert app.es.search.call_count == 1
+
+
+def test_warm_suggestions(app, mock_db):
+    given_suggest_app(app)
+    mock_db['personalities'].update_many({}, {'$set': {'Header.En': 'Tester'}})
+    with app.app_context():
+        # only the visible personality
+        assert get_hot_prefixes('personalities', 'En') == ['t', 'te', 'tes']
+        assert get_hot_prefixes('personalities', 'He') == []
+        warm_suggestions()
+        calls = app.es.search.call_count
+        assert get_cached_completion('personalities', 'TES')[2] == 0
+        assert get_cached_completion('*', 'T')[2] == 0
+        assert app.es.search.call_count == calls
+
+
+def test_clear_suggestions(app):
+    given_suggest_app(app)
+    with app.app_context():
+        get_cached_completion('personalities', 'Te')
+        app.redis.set('item:personality_tester', 'item')
+        assert clear_suggestions(app.redis) == 1
+        assert app.redis.get('item:personality_tester') == 'item'
+        get_cached_completion('personalities', 'Te')
+        assert app.es.search.call_count == 2
+
+
+def test_clear_collection_suggestions(app):
+    given_suggest_app(app)
+    with app.app_context():
+        get_cached_completion('personalities', 'Te')
+        get_cached_completion('places', 'Te')
+        get_cached_completion('*', 'Te')
+        assert clear_suggestions(app.redis, ['personalities']) == 2
+        get_cached_completion('places', 'Te')
+        assert app.es.search.call_count == 3
@@ -1,4 +1,5 @@
 from datetime import datetime
+import collections
 import os
 from migration.family_trees import Gedcom2Persons, THIS_YEAR
 
@@ -52,6 +53,88 @@ def given_mock_gedcom_tree_with_single_person(deceased=True, birth_year=1679, de
     })()
 
 
+class MockElement(object):
+
+    def __init__(self, pointer, tag, value=None, children=(), **attrs):
+        self.pointer = pointer
+        self.tag = tag
+        self.value = value
+        self.children = list(children)
+        self.is_individual = tag == "INDI"
+        self.gender = ""
+        self.deceased = False
+        self.private = False
+        self.name = []
+        self.birth_year = self.death_year = None
+        self.__dict__.update(attrs)
+
+
+def given_mock_person(pointer, name, gender, fams=(), famc=(), deceased=True,
+                      birth_year=1900):
+    links = [MockElement("", "FAMS", f) for f in fams] + \
+            [MockElement("", "FAMC", f) for f in famc]
+    return MockElement(pointer, "INDI", children=links, gender=gender,
+                       deceased=deceased, private=False, name=[name],
+                       birth_year=birth_year, death_year=None)
+
+
+def given_mock_family(pointer, husband=None, wife=None, children=()):
+    members = []
+    if husband:
+        members.append(MockElement("", "HUSB", husband))
+    if wife:
+        members.append(MockElement("", "WIFE", wife))
+    members += [MockElement("", "CHIL", c) for c in children]
+    return MockElement(pointer, "FAM", children=members)
+
+
+class MockGedcomTree(object):
+    ''' a gedcom of a few generations, counts the relatives lookups '''
+
+    def __init__(self):
+        elements = [
+            given_mock_person("@G1@", "grandpa", "M", fams=["@F1@"]),
+            given_mock_person("@G2@", "grandma", "F", fams=["@F1@"]),
+            given_mock_person("@P1@", "father", "M", fams=["@F2@", "@F4@"],
+                              famc=["@F1@"]),
+            given_mock_person("@U1@", "uncle", "M", famc=["@F1@"]),
+            given_mock_person("@P2@", "mother", "F", fams=["@F2@"]),
+            given_mock_person("@P3@", "stepmother", "F", fams=["@F4@"]),
+            given_mock_person("@C1@", "son", "M", fams=["@F3@"],
+                              famc=["@F2@"]),
+            given_mock_person("@C2@", "daughter", "F", famc=["@F2@"]),
+            given_mock_person("@H1@", "half brother", "M", famc=["@F4@"]),
+            given_mock_person("@S1@", "daughter in law", "F", fams=["@F3@"]),
+            given_mock_person("@K1@", "grandson", "M", famc=["@F3@"],
+                              deceased=False, birth_year=THIS_YEAR - 20),
+            given_mock_family("@F1@", "@G1@", "@G2@", ["@P1@", "@U1@"]),
+            # the tree has a missing kid
+            given_mock_family("@F2@", "@P1@", "@P2@", ["@C1@", "@I99@", "@C2@"]),
+            given_mock_family("@F3@", "@C1@", "@S1@", ["@K1@"]),
+            given_mock_family("@F4@", "@P1@", "@P3@", ["@H1@"]),
+        ]
+        self.as_dict = dict((e.pointer, e) for e in elements)
+        self.as_list = [MockElement("", "HEAD")]
+        self.lookups = collections.Counter()
+
+    def families(self, node, attr):
+        self.lookups["families"] += 1
+        return [self.as_dict[i.value] for i in node.children if i.tag == attr]
+
+    def get_family_members(self, family, members_type):
+        self.lookups["get_family_members"] += 1
+        return [self.as_dict[i.value] for i in family.children
+                if i.tag == members_type and i.value in self.as_dict]
+
+    def get_parents(self, e):
+        self.lookups["get_parents"] += 1
+        return [self.as_dict[i.value] for family in self.families(e, "FAMC")
+                for i in family.children if i.tag in ("HUSB", "WIFE")]
+
+    def marriage_years(self, e):
+        return []
+
+
 def gedcom_2_persons(gedcom):
     tree_num = None
     file_id = None
@@ -91,6 +174,44 @@ def test_migrate_trees(mocker):
     assert i9["death_year"] == 1965
 
 
+def test_migrate_trees_failures(mocker):
+    given_mock_migrate_environment(mocker)
+    from scripts.migrate import migrate_trees, migrate_tree
+    cursor = [
+        {"GenTreeNumber": 665, "UpdateDate": datetime(1970, 8, 17, 21, 10, 38), "GenTreePath": "T665.ged"},
+        {"GenTreeNumber": 666, "UpdateDate": datetime(1970, 8, 17, 21, 10, 38), "GenTreePath": "T666.ged"},
+    ]
+    saved_docs = []
+    # a missing tree doesn't stop the migration of the others
+    assert migrate_trees(cursor, on_save=saved_docs.append) == 2
+    assert len(saved_docs) == 62
+    result = migrate_tree(cursor[0], on_save=saved_docs.append)
+    assert result.tree_num == 665
+    assert result.persons == 0
+    assert "No such file" in result.error
+    result = migrate_tree(cursor[1], on_save=saved_docs.append)
+    assert result.persons == 62
+    assert result.error is None
+
+
+
+def test_migrate_tree_errors(mocker):
+    given_mock_migrate_environment(mocker)
+    from scripts.migrate import migrate_tree, migrate_tree_in_worker
+    row = {"GenTreeNumber": 666, "UpdateDate": datetime(1970, 8, 17, 21, 10, 38), "GenTreePath": "T666.ged"}
+    # any parse error fails only its tree
+    mocker.patch("scripts.migrate.Gedcom", side_effect=UnicodeDecodeError("ascii", "", 0, 1, "oops"))
+    result = migrate_tree(row, on_save=lambda data: None)
+    assert result.persons == 0
+    assert "oops" in result.error
+    # the pool workers return a failed result instead of raising
+    mocker.patch("scripts.migrate.migrate_tree", side_effect=ValueError("broken"))
+    result = migrate_tree_in_worker((row, None, True, False))
+    assert result.tree_num == 666
+    assert result.file_name.endswith("T666.ged")
+    assert result.error == "broken"
+
+
 def test_gedcom_to_persons():
     # person marked as deceased in gedcom - is deceased, regardless of other attributes
     gedcom = given_mock_gedcom_tree_with_single_person(deceased=True)
@@ -106,3 +227,41 @@ def test_gedcom_to_persons():
     gedcom = given_mock_gedcom_tree_with_single_person(deceased=False, birth_year=THIS_YEAR-60)
     persons_data = gedcom_2_persons(gedcom)
     assert persons_data[0]["deceased"] == False
+
+
+def test_gedcom_to_persons_relatives():
+    gedcom = MockGedcomTree()
+    persons = {}
+    Gedcom2Persons(gedcom, 7, "T7", lambda data: persons.update({data["id"]: data}),
+                   dryrun=True)
+    assert sorted(persons) == ["C1", "C2", "G1", "G2", "H1", "K1", "P1",
+                               "P2", "P3", "S1", "U1"]
+    ids = lambda nodes: [node["id"] for node in nodes]
+    son = persons["C1"]
+    assert ids(son["siblings"]) == ["C2"]
+    assert ids(son["partners"]) == ["S1"]
+    assert ids(son["partners"][0]["children"]) == ["K1"]
+    assert son["partners"][0]["children"][0]["partners"] == []
+    father, mother = son["parents"]
+    assert ids(father["parents"]) == ["G1", "G2"]
+    # the siblings are not repeated as the children of the parents
+    assert ids(father["partners"]) == ["P2", "P3"]
+    assert father["partners"][0]["children"] == []
+    assert ids(father["partners"][1]["children"]) == ["H1"]
+    assert mother["parents"] == []
+    assert ids(mother["partners"]) == ["P1"]
+    # the memoized relatives are copies
+    assert "partners" not in mother["partners"][0]
+    assert "parents" not in persons["P2"]["partners"][0]
+    assert ids(persons["P1"]["partners"][0]["children"]) == ["C1", "C2"]
+    # changing a relative in one doc doesn't change it in the others
+    father["name"].append("changed")
+    assert persons["C2"]["parents"][0]["name"] == ["father"]
+    assert persons["H1"]["parents"][0]["name"] == ["father"]
+    # living persons only keep the whitelisted keys
+    assert "birth_year" not in persons["K1"]
+    assert ids(persons["K1"]["parents"]) == ["C1", "S1"]
+    # the relatives are looked up once per person
+    assert gedcom.lookups["get_parents"] == 11
+    assert gedcom.lookups["get_family_members"] == 4
+